@@ -1,6 +1,7 @@
 from flask import Flask, render_template
 from flask_moment import Moment
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.exc import SQLAlchemyError
 from config import config
 from flask_login import LoginManager
 import flask_excel as excel
@@ -80,6 +81,12 @@ loginmanager.session_protection = 'strong'
 moment = Moment()
 db = SQLAlchemy()
 
+from .models.KnockingSupervisor import KnockingSupervisor
+supervisor = KnockingSupervisor()
+
+from .models.ScriptGenerator import ScriptGenerator
+script_generator = ScriptGenerator()
+
 
 def create_app(config_name):
     """创建Flask应用实例
@@ -102,6 +109,17 @@ def create_app(config_name):
     moment.init_app(app)
     db.init_app(app)
     loginmanager.init_app(app)
+    # 升级后为已有的敲门规则表补齐新增的列，须在监听进程对账读取规则之前完成
+    from .models.KnockingRule import KnockingRule
+    with app.app_context():
+        try:
+            added = KnockingRule.upgrade_schema(db.engine)
+        except SQLAlchemyError as e:
+            app.logger.warning("检查敲门规则表结构失败: %s", e)
+        else:
+            if added:
+                app.logger.info("敲门规则表已补充列: %s", ', '.join(added))
+    supervisor.init_app(app)
 
     # 注册蓝图
     from .base import base as base_blueprint
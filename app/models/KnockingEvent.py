@@ -0,0 +1,36 @@
+from .. import db
+from datetime import datetime
+
+class KnockingEvent(db.Model):
+    """端口敲门审计事件模型
+
+    记录监听进程产生的敲门成功、密码错误、超时、步骤错误、封禁和手动撤销事件，
+    由监听进程批量写入（见 knocking_events.py），Web端只读查询。
+    """
+    __tablename__ = 'sys_knocking_event'
+    __table_args__ = (
+        db.Index('idx_knocking_event_time', 'event_time'),
+        db.Index('idx_knocking_event_rule_time', 'rule_id', 'event_time'),
+        db.Index('idx_knocking_event_ip_time', 'source_ip', 'event_time'),
+        db.Index('idx_knocking_event_type_time', 'event_type', 'event_time'),
+    )
+
+    id = db.Column(db.BigInteger().with_variant(db.Integer, 'sqlite'), primary_key=True, autoincrement=True)  # 事件ID，自增主键
+    rule_id = db.Column(db.String(32), nullable=True, comment='规则ID')  # 产生事件的敲门规则
+    event_type = db.Column(db.String(16), nullable=False, comment='事件类型')  # success/auth_failed/timeout/invalid_step/banned/revoked
+    source_ip = db.Column(db.String(64), nullable=False, comment='源地址')  # 敲门客户端地址
+    target_port = db.Column(db.Integer, nullable=True, comment='目标端口')  # 规则开放的目标端口
+    detail = db.Column(db.String(255), nullable=True, comment='详情')  # 事件补充说明
+    event_time = db.Column(db.DateTime, nullable=False, default=datetime.now, comment='事件时间')  # 事件发生时间
+
+    def to_json(self):
+        """将事件对象转换为JSON格式，时间字段格式：YYYY-MM-DD HH:MM:SS"""
+        return {
+            'id': self.id,
+            'ruleId': self.rule_id,
+            'eventType': self.event_type,
+            'sourceIp': self.source_ip,
+            'targetPort': self.target_port,
+            'detail': self.detail,
+            'eventTime': self.event_time.strftime('%Y-%m-%d %H:%M:%S') if self.event_time else None
+        }
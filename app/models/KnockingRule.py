@@ -1,5 +1,6 @@
 from .. import db
 from datetime import datetime
+from sqlalchemy import inspect, text
 
 class KnockingRule(db.Model):
     """端口敲门规则模型
@@ -15,6 +16,7 @@ class KnockingRule(db.Model):
     time_window = db.Column(db.Integer, nullable=False, comment='等待时间(秒)')  # 端口敲门序列的最大完成时间窗口
     timeout = db.Column(db.Integer, nullable=False, comment='超时时间(秒)')  # 认证成功后的会话超时时间
     password_hash = db.Column(db.String(255), nullable=False, comment='密码哈希')  # 认证密码的哈希值
+    auth_mode = db.Column(db.String(16), nullable=False, default='md5', comment='认证方式（md5静态 totp时间片）')  # 最终包认证方式
     status = db.Column(db.String(1), nullable=False, default='1', comment='状态（0停用 1正常）')  # 规则状态
     create_by = db.Column(db.String(64), nullable=True, comment='创建者')  # 规则创建人
     create_time = db.Column(db.DateTime, nullable=True, default=datetime.now, comment='创建时间')  # 规则创建时间
@@ -28,6 +30,7 @@ class KnockingRule(db.Model):
         Returns：
         - 时间字段格式：YYYY-MM-DD HH:MM:SS
         - 状态字段值：0表示停用，1表示正常
+        - 认证方式：md5表示静态密码哈希，totp表示基于时间片的一次性令牌
         """
         json_data = {
             'id': self.id,
@@ -35,6 +38,7 @@ class KnockingRule(db.Model):
             'targetPort': self.target_port,
             'timeWindow': self.time_window,
             'timeout': self.timeout,
+            'authMode': self.auth_mode,
             'status': self.status,
             'createBy': self.create_by,
             'createTime': self.create_time.strftime('%Y-%m-%d %H:%M:%S') if self.create_time else None,
@@ -42,4 +46,33 @@ class KnockingRule(db.Model):
             'updateTime': self.update_time.strftime('%Y-%m-%d %H:%M:%S') if self.update_time else None,
             'remark': self.remark
         }
-        return json_data
\ No newline at end of file
+        return json_data
+
+    # 表创建后新增的列及其 ADD COLUMN 定义，旧版本安装升级时据此补齐
+    UPGRADE_COLUMNS = {
+        'auth_mode': "VARCHAR(16) NOT NULL DEFAULT 'md5'",
+    }
+
+    @classmethod
+    def upgrade_schema(cls, engine):
+        """为旧版本创建的 sys_knocking_rule 表补充新增的列
+
+        db.sql 使用 CREATE TABLE IF NOT EXISTS，已有安装升级后表结构不变，查询规则会因缺少新列失败。
+        表不存在（尚未初始化）时不做处理，重复执行无副作用。
+
+        Args:
+            engine: 数据库引擎
+
+        Returns:
+            list: 本次补充的列名
+        """
+        inspector = inspect(engine)
+        if not inspector.has_table(cls.__tablename__):
+            return []
+        existing = {column['name'] for column in inspector.get_columns(cls.__tablename__)}
+        added = [name for name in cls.UPGRADE_COLUMNS if name not in existing]
+        if added:
+            with engine.begin() as conn:
+                for name in added:
+                    conn.execute(text(f"ALTER TABLE {cls.__tablename__} ADD COLUMN {name} {cls.UPGRADE_COLUMNS[name]}"))
+        return added
@@ -0,0 +1,899 @@
+# coding:utf-8
+"""
+端口敲门监听进程管理模块
+
+由 KnockingSupervisor 统一持有所有规则的监听进程（knocking_cmd.py），取代原先的PID文件：
+- 启动、停止、重启规则对应的监听进程；敲门端口直接或间接重叠的规则共用一个监听进程，
+  同一个数据包只在一棵前缀树中查找一次，组内其他规则通过 --rules-file 传入
+- 热更新、停用、启用和删除都按单条规则下发给所在的监听进程，不影响组内其他规则
+- 监听进程异常退出时按指数退避自动拉起
+- 规则参数修改时通过控制套接字热更新监听进程，无法热更新时回退为重启
+- 规则停用/启用时通过控制套接字暂停/恢复监听进程，批量操作并发下发，不逐条启停进程
+- 停止和重启在后台线程中并行执行：先SIGTERM，有界等待退出后再SIGKILL，请求线程不等待
+- 应用启动时按 sys_knocking_rule 中启用的规则对账：接管同一规则的存量进程并热更新为
+  数据库中的参数，结束无主或不可热更新参数不一致的进程，补齐缺失的进程
+- 向规则列表接口提供每条规则的存活状态、运行时长和重启次数
+
+监听进程以独立会话启动，Web进程重启不会中断已开放的授权，重启后通过对账重新接管。
+监听进程自身重启时按 KNOCKING_STATE_DIR 下的授权日志接管未到期的授权；删除规则时先停用
+该规则撤销其授权，再结束进程或把规则从所在的监听进程中移除。
+同一时间只应有一个Web进程启用监听进程管理（KNOCKING_SUPERVISOR_AUTOSTART）。
+
+监听进程以组内最小的规则ID命名（控制套接字和授权日志的文件名），新规则的端口与一个运行中的
+监听进程重叠时热添加到该进程；与多个监听进程重叠、或修改后的端口与其他监听进程重叠时，
+停止这些进程并合并为一个新进程，授权由新进程按各成员的授权日志接管。
+"""
+
+import hashlib
+import json
+import logging
+import os
+import subprocess
+import sys
+import time
+from threading import Event, Lock, Thread
+
+from concurrent.futures import ThreadPoolExecutor
+
+import psutil
+
+from urllib.parse import urlencode
+
+from .knocking_control import ControlClient, ControlError
+
+# 监听进程脚本路径
+LISTENER_SCRIPT = os.path.join(os.path.dirname(__file__), 'knocking_cmd.py')
+
+# 可通过控制套接字 /reload 热更新的命令行参数
+RELOADABLE_OPTIONS = ('-pl', '-p', '-w', '-t', '-passwd', '--auth-scheme')
+
+
+# 可通过控制套接字 /pause、/resume 切换的命令行开关
+RELOADABLE_FLAGS = ('--paused',)
+
+# 只在监听进程启动时生效的命令行参数，接管存量进程时不比较
+STARTUP_OPTIONS = ('--adopt-journal',)
+
+
+def static_args(cmd):
+    """去掉可热更新参数后的命令行，用于判断存量进程能否通过热更新接管"""
+    result = []
+    skip = False
+    for arg in cmd[1:]:
+        if skip:
+            skip = False
+        elif arg in RELOADABLE_OPTIONS or arg in STARTUP_OPTIONS:
+            skip = True
+        elif arg not in RELOADABLE_FLAGS:
+            result.append(arg)
+    return result
+
+
+def sequence_ports(sequence):
+    """敲门序列字符串（格式同 -pl）用到的端口集合"""
+    return {item.split(':')[0].strip() for item in (sequence or '').split(',') if item.strip()}
+
+
+def group_rules(rules):
+    """把敲门端口直接或间接重叠的规则划分为一组
+
+    Args:
+        rules: {规则ID: 端口集合}
+
+    Returns:
+        list: 每组的规则ID集合
+    """
+    groups = []
+    for rule_id, ports in rules.items():
+        ids, merged = {rule_id}, set(ports)
+        rest = []
+        # 已有的组两两不重叠，只需与规则自身的端口比较
+        for group_ids, group_ports in groups:
+            if group_ports & ports:
+                ids |= group_ids
+                merged |= group_ports
+            else:
+                rest.append((group_ids, group_ports))
+        groups = rest + [(ids, merged)]
+    return [ids for ids, _ in groups]
+
+
+class ListenerProcess:
+    """一个监听进程的记录，敲门端口重叠的规则共用一个监听进程
+
+    Attributes:
+        rule_id: 监听进程名称，即作为命令行规则启动的规则ID，决定控制套接字和授权日志的文件名
+        rules: 进程服务的规则 {规则ID: 规则快照}，见 KnockingSupervisor.snapshot()
+        paused_rules: 已停用的规则ID集合（进程保留但不处理这些规则的敲门）
+        adopt: 启动时需一并接管授权日志的其他名称（组改名后旧名称的授权日志）
+        cmd: 启动命令，由 KnockingSupervisor 按规则快照生成
+        proc: 进程对象（psutil.Popen或接管的psutil.Process），未运行时为None
+        started: 最近一次启动时间戳
+        restarts: 异常退出后自动重启的次数
+        failures: 连续异常退出次数，用于计算退避时间
+        next_start: 计划重新启动的时间戳
+        last_exit: 最近一次退出码
+        restarting: 是否正在等待旧进程退出后按新参数启动
+    """
+
+    def __init__(self, rule_id, rules, paused_rules=()):
+        self.rule_id = rule_id
+        self.rules = dict(rules)
+        self.paused_rules = set(paused_rules)
+        self.adopt = set()
+        self.cmd = None
+        self.proc = None
+        self.started = None
+        self.restarts = 0
+        self.failures = 0
+        self.next_start = None
+        self.last_exit = None
+        self.restarting = False
+
+    def alive(self):
+        """进程是否仍在运行（僵尸进程视为已退出）"""
+        if self.proc is None:
+            return False
+        if isinstance(self.proc, psutil.Popen):
+            return self.proc.poll() is None
+        try:
+            return self.proc.is_running() and self.proc.status() != psutil.STATUS_ZOMBIE
+        except psutil.NoSuchProcess:
+            return False
+
+    def exit_code(self):
+        if isinstance(self.proc, psutil.Popen):
+            return self.proc.poll()
+        return None
+
+    def status(self, rule_id=None):
+        """运行状态，paused 为 rule_id 对应规则（默认为命令行规则）是否已停用"""
+        alive = self.alive()
+        return {
+            'alive': alive,
+            'pid': self.proc.pid if alive else None,
+            'uptime': round(time.time() - self.started) if alive and self.started else 0,
+            'restarts': self.restarts,
+            'lastExitCode': self.last_exit,
+            'restarting': self.restarting,
+            'paused': (self.rule_id if rule_id is None else rule_id) in self.paused_rules,
+            'listenerId': self.rule_id,
+        }
+
+
+class KnockingSupervisor:
+    """监听进程管理器
+
+    以Flask扩展的方式初始化：模块级实例在 create_app 中调用 init_app(app)。
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self.listeners = {}
+        self.lock = Lock()
+        self._stopped = Event()
+        self._thread = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """读取配置，启用时在后台线程中对账并开始监控
+
+        相关配置：
+        - KNOCKING_RUN_DIR: 控制套接字等运行时文件目录
+        - KNOCKING_LOG_FILE: 监听进程标准输出重定向的日志文件
+        - KNOCKING_STATE_DIR: 监听进程授权日志目录，为空时监听进程退出即撤销全部授权
+        - KNOCKING_EVENT_LOG: 是否让监听进程把审计事件写入 sys_knocking_event 表
+        - KNOCKING_SUPERVISOR_AUTOSTART: 是否在应用启动时对账并拉起监听进程
+        - KNOCKING_RESTART_BACKOFF / KNOCKING_RESTART_BACKOFF_MAX: 重启退避的初始值和上限（秒）
+        - KNOCKING_STOP_TIMEOUT: 停止时等待监听进程自行退出的时间（秒），超时后强制结束
+        """
+        self.app = app
+        app.extensions['knocking_supervisor'] = self
+        self.run_dir = app.config.get('KNOCKING_RUN_DIR', '/var/run/authbase_knocking')
+        self.log_file = app.config.get('KNOCKING_LOG_FILE', '/var/log/authbase/knocking.log')
+        self.state_dir = app.config.get('KNOCKING_STATE_DIR')
+        self.event_log = app.config.get('KNOCKING_EVENT_LOG', False)
+        self.backoff = app.config.get('KNOCKING_RESTART_BACKOFF', 1)
+        self.backoff_max = app.config.get('KNOCKING_RESTART_BACKOFF_MAX', 60)
+        self.stop_timeout = app.config.get('KNOCKING_STOP_TIMEOUT', 5)
+        # 运行超过该时长后退出视为偶发故障，退避从初始值重新计算
+        self.stable_time = max(self.backoff_max, 60)
+        self.poll_interval = 1.0
+
+        if not app.config.get('KNOCKING_SUPERVISOR_AUTOSTART', False):
+            return
+        # 调试模式下重载器的父进程不处理请求，只在实际服务的子进程中管理监听进程
+        if app.debug and os.environ.get('WERKZEUG_RUN_MAIN') != 'true':
+            return
+        self._ensure_directories()
+        self._start_monitor(reconcile=True)
+
+    def _ensure_directories(self):
+        for path in (self.run_dir, os.path.dirname(self.log_file), self.state_dir):
+            if path and not os.path.exists(path):
+                os.makedirs(path, mode=0o755, exist_ok=True)
+
+    def _socket_path(self, name):
+        return os.path.join(self.run_dir, f"{name}.sock")
+
+    def control_socket_path(self, rule_id):
+        """规则所在监听进程的控制套接字路径"""
+        listener = self.listeners.get(rule_id)
+        return self._socket_path(rule_id if listener is None else listener.rule_id)
+
+    def rules_file_path(self, name, rule_ids):
+        """监听进程 --rules-file 的路径，文件名带组成员的摘要，组成变化后命令行随之变化"""
+        digest = hashlib.md5(','.join(sorted(rule_ids)).encode('utf-8')).hexdigest()[:8]
+        return os.path.join(self.run_dir, f"{name}.{digest}.rules.json")
+
+    def command(self, rule):
+        """构造规则对应的监听进程启动命令
+
+        Args:
+            rule: KnockingRule 实例
+
+        Returns:
+            list: 可直接传给subprocess.Popen的参数列表
+        """
+        config = self.app.config
+        cmd = [
+            # 'sudo',  # 需要root权限
+            sys.executable,
+            LISTENER_SCRIPT,
+            '-pl', rule.port_sequence,
+            '-p', str(rule.target_port),
+            '-w', str(rule.time_window),
+            '-t', str(rule.timeout),
+            '-passwd', rule.password_hash,
+            '-fw', config.get('KNOCKING_FIREWALL_BACKEND', 'firewalld'),
+            '--auth-scheme', rule.auth_mode or 'md5',
+            '--log-level', config.get('KNOCKING_LOG_LEVEL', 'INFO'),
+            '--rule-id', rule.id,
+            '--control-socket', self._socket_path(rule.id)
+        ]
+        if self.state_dir:
+            cmd += ['--state-dir', self.state_dir]
+        workers = int(config.get('KNOCKING_LISTENER_WORKERS', 1))
+        if workers > 1:
+            cmd += ['--workers', str(workers)]
+        return cmd
+
+    @staticmethod
+    def reload_payload(rule):
+        """监听进程 /reload 接口的请求体，也是 --rules-file 中的一项"""
+        return {
+            'rule_id': rule.id,
+            'port_list': rule.port_sequence,
+            'target_port': rule.target_port,
+            'window': rule.time_window,
+            'timeout': rule.timeout,
+            'password': rule.password_hash,
+            'auth_scheme': rule.auth_mode or 'md5',
+        }
+
+    def snapshot(self, rule):
+        """规则的启动命令和参数快照
+
+        监听进程崩溃后按快照重新拉起，记录中不持有数据库对象。
+
+        Returns:
+            dict: cmd（作为命令行规则时的启动命令）、payload（见 reload_payload()）、ports（敲门端口集合）
+        """
+        payload = self.reload_payload(rule)
+        return {'cmd': self.command(rule), 'payload': payload, 'ports': sequence_ports(payload['port_list'])}
+
+    def _assemble(self, listener):
+        """按规则快照生成监听进程的启动命令
+
+        名称对应的规则作为命令行规则，组内其他规则写入 --rules-file（启动时由 _spawn 生成）。
+        """
+        cmd = list(listener.rules[listener.rule_id]['cmd'])
+        if len(listener.rules) > 1:
+            cmd += ['--rules-file', self.rules_file_path(listener.rule_id, listener.rules)]
+        for name in sorted(listener.adopt):
+            cmd += ['--adopt-journal', name]
+        listener.cmd = cmd
+
+    def _write_rules_file(self, listener):
+        """写入组内其他规则的参数，文件含密码摘要，只允许属主读写"""
+        path = self.rules_file_path(listener.rule_id, listener.rules)
+        items = [dict(snapshot['payload'], paused=rule_id in listener.paused_rules)
+                 for rule_id, snapshot in listener.rules.items() if rule_id != listener.rule_id]
+        tmp = path + '.tmp'
+        with open(os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w', encoding='utf-8') as f:
+            json.dump(items, f, ensure_ascii=False)
+        os.replace(tmp, path)
+
+    @staticmethod
+    def _discard(listener):
+        """删除不再使用的 --rules-file"""
+        if listener.cmd and '--rules-file' in listener.cmd:
+            try:
+                os.remove(listener.cmd[listener.cmd.index('--rules-file') + 1])
+            except OSError:
+                pass
+
+    def _distinct(self):
+        """全部监听进程记录（组内各规则指向同一条记录），调用方需持有 self.lock"""
+        return list({id(listener): listener for listener in self.listeners.values()}.values())
+
+    def _peers(self, ports, exclude=None):
+        """敲门端口与 ports 重叠的监听进程，调用方需持有 self.lock"""
+        return [listener for listener in self._distinct() if listener is not exclude and
+                any(snapshot['ports'] & ports for snapshot in listener.rules.values())]
+
+    def _control(self, name, path, body=None, method='POST'):
+        """向运行中的监听进程发送控制请求
+
+        Args:
+            name: 监听进程名称（ListenerProcess.rule_id）
+
+        Returns:
+            bool: 是否成功
+        """
+        try:
+            ControlClient(self._socket_path(name)).request(method, path, body)
+            return True
+        except ControlError as e:
+            logging.warning(f"监听进程 {name} 的控制请求 {method} {path} 失败: {str(e)}")
+            return False
+
+    def _spawn(self, listener):
+        """启动监听进程，调用方需持有 self.lock"""
+        self._ensure_directories()
+        if len(listener.rules) > 1:
+            self._write_rules_file(listener)
+        env = dict(os.environ)
+        if self.event_log and self.app.config.get('SQLALCHEMY_DATABASE_URI'):
+            # 连接串含密码，通过环境变量传递，不出现在进程命令行中
+            env['AUTHBASE_EVENT_DB_URI'] = self.app.config['SQLALCHEMY_DATABASE_URI']
+        with open(self.log_file, 'a') as log:
+            listener.proc = psutil.Popen(
+                listener.cmd + ['--paused'] if listener.rule_id in listener.paused_rules else listener.cmd,
+                env=env,
+                stdout=log,
+                stderr=subprocess.STDOUT,
+                # 独立会话，Web进程退出或收到Ctrl-C时不影响监听进程
+                start_new_session=(os.name != 'nt'),
+                creationflags=subprocess.CREATE_NEW_PROCESS_GROUP if os.name == 'nt' else 0
+            )
+        listener.started = time.time()
+        listener.next_start = None
+        logging.info(f"启动规则 {', '.join(listener.rules)} 的监听进程 {listener.proc.pid}")
+
+    def start(self, rule):
+        """启动规则的监听进程，已在运行时直接返回
+
+        敲门端口与一个运行中的监听进程重叠时热添加到该进程，与多个重叠时合并重启。
+
+        Args:
+            rule: KnockingRule 实例
+
+        Returns:
+            int: 监听进程PID，正在重启时返回None
+        """
+        snapshot = self.snapshot(rule)
+        with self.lock:
+            listener = self.listeners.get(rule.id)
+            if listener is not None and listener.alive():
+                return listener.proc.pid
+            if listener is not None and listener.restarting:
+                return None
+            peers = self._peers(snapshot['ports'], exclude=listener)
+            if listener is None and not peers:
+                listener = ListenerProcess(rule.id, {rule.id: snapshot})
+                self._assemble(listener)
+                self.listeners[rule.id] = listener
+                self._spawn(listener)
+                pid = listener.proc.pid
+            else:
+                pid = None
+            joinable = listener is None and len(peers) == 1 and peers[0].alive() and not peers[0].restarting
+        if pid is not None:
+            self._start_monitor()
+            return pid
+        if joinable:
+            pid = self._join(peers[0], rule.id, snapshot)
+            if pid is not None:
+                return pid
+        return self._rebuild(rule.id, snapshot)
+
+    def _join(self, listener, rule_id, snapshot):
+        """通过控制套接字把规则热添加到运行中的监听进程
+
+        Returns:
+            int: 监听进程PID，失败时返回None
+        """
+        if not self._control(listener.rule_id, '/reload', snapshot['payload']):
+            return None
+        with self.lock:
+            if self.listeners.get(listener.rule_id) is not listener or not listener.alive():
+                return None
+            listener.rules[rule_id] = snapshot
+            listener.paused_rules.discard(rule_id)
+            self._assemble(listener)
+            self.listeners[rule_id] = listener
+            pid = listener.proc.pid
+        logging.info(f"规则 {rule_id} 已加入监听进程 {listener.rule_id}")
+        return pid
+
+    def _regroup(self, olds, rules, paused_rules, adopt=()):
+        """用一个新的监听进程记录取代 olds，调用方需持有 self.lock
+
+        新进程以组内最小的规则ID命名。旧进程都已退出时立即启动，否则标记为等待重启，
+        由调用方通过 _replace() 在后台停止旧进程后启动。
+
+        Returns:
+            tuple: (新的 ListenerProcess, 需要先停止的旧进程列表)
+        """
+        listener = ListenerProcess(min(rules), rules, paused_rules)
+        listener.adopt = set(adopt)
+        listener.restarts = max([old.restarts for old in olds], default=0)
+        self._assemble(listener)
+        for old in olds:
+            self._discard(old)
+            for rule_id in old.rules:
+                if self.listeners.get(rule_id) is old:
+                    del self.listeners[rule_id]
+        for rule_id in rules:
+            self.listeners[rule_id] = listener
+        procs = [old.proc for old in olds if old.alive()]
+        if procs:
+            listener.restarting = True
+        else:
+            self._spawn(listener)
+        return listener, procs
+
+    def _replace(self, listener, procs, wait=False):
+        """停止旧进程，全部退出后启动 listener，保证抓包和防火墙资源已释放
+
+        Returns:
+            bool: wait为True时表示旧进程是否均已退出，否则总是True
+        """
+        if not procs:
+            return True
+
+        def start_new():
+            with self.lock:
+                # 等待期间规则可能已被停止或再次修改
+                if listener.restarting and self.listeners.get(listener.rule_id) is listener:
+                    listener.restarting = False
+                    try:
+                        self._spawn(listener)
+                    except OSError as e:
+                        listener.next_start = time.time() + self.backoff
+                        logging.error(f"启动监听进程 {listener.rule_id} 失败: {str(e)}")
+        return self._shutdown(procs, wait=wait, then=start_new)
+
+    def _rebuild(self, rule_id, snapshot):
+        """按规则的最新快照重启其所在的监听进程并启用该规则
+
+        敲门端口与其他监听进程重叠时一并停止，合并为一个新进程。
+
+        Returns:
+            int: 新进程PID，需要等待旧进程退出时返回None
+        """
+        with self.lock:
+            own = self.listeners.get(rule_id)
+            olds = ([own] if own is not None else []) + self._peers(snapshot['ports'], exclude=own)
+            rules, paused_rules = {}, set()
+            for old in olds:
+                rules.update(old.rules)
+                paused_rules |= old.paused_rules
+            rules[rule_id] = snapshot
+            paused_rules.discard(rule_id)
+            listener, procs = self._regroup(olds, rules, paused_rules)
+            pid = None if procs else listener.proc.pid
+        self._start_monitor()
+        self._replace(listener, procs)
+        return pid
+
+    def restart(self, rule):
+        """按规则的最新参数重启其所在的监听进程
+
+        旧进程在后台停止，退出后再启动新进程，保证抓包和防火墙资源已释放；调用方不等待。
+        """
+        self._rebuild(rule.id, self.snapshot(rule))
+
+    def _running(self, rule, snapshot):
+        """规则所在的监听进程及其状态
+
+        Returns:
+            tuple: (ListenerProcess或None, 进程是否运行中且未在重启,
+                    修改后的敲门端口是否与其他监听进程重叠而需要合并重启)
+        """
+        with self.lock:
+            listener = self.listeners.get(rule.id)
+            running = listener is not None and listener.alive() and not listener.restarting
+            return listener, running, bool(self._peers(snapshot['ports'], exclude=listener))
+
+    def _update(self, listener, snapshots, paused):
+        """控制请求成功后更新记录，进程崩溃后按新参数和状态拉起
+
+        Args:
+            snapshots: {规则ID: 参数快照}
+            paused: 这些规则是否处于停用状态
+        """
+        with self.lock:
+            listener.rules.update(snapshots)
+            if paused:
+                listener.paused_rules.update(snapshots)
+            else:
+                listener.paused_rules.difference_update(snapshots)
+            self._assemble(listener)
+
+    def reload(self, rule):
+        """按规则的最新参数更新监听进程
+
+        监听进程运行中时通过控制套接字热更新，保留已开放的授权和进行中的敲门状态；
+        进程未运行或热更新失败时回退为重启。
+
+        Returns:
+            bool: 是否为热更新
+        """
+        snapshot = self.snapshot(rule)
+        listener, running, merge = self._running(rule, snapshot)
+        if running and not merge and self._control(listener.rule_id, '/reload', snapshot['payload']):
+            self._update(listener, {rule.id: snapshot}, rule.id in listener.paused_rules)
+            logging.info(f"规则 {rule.id} 的监听进程已热更新")
+            return True
+        self.restart(rule)
+        return False
+
+    def pause(self, rule):
+        """停用规则：运行中的监听进程停止处理该规则，保留进程以便快速恢复
+
+        进程未运行或无法暂停时停止该规则。
+
+        Returns:
+            bool: 是否通过控制套接字暂停
+        """
+        snapshot = self.snapshot(rule)
+        listener, running, _ = self._running(rule, snapshot)
+        if running and self._control(listener.rule_id, '/pause', {'rule_id': rule.id}):
+            self._update(listener, {rule.id: snapshot}, True)
+            return True
+        self.stop(rule.id)
+        return False
+
+    def resume(self, rule):
+        """启用规则：暂停中的规则按最新参数恢复，未运行时启动监听进程
+
+        Returns:
+            bool: 是否通过控制套接字恢复（包括运行中进程的热更新）
+        """
+        snapshot = self.snapshot(rule)
+        listener, running, merge = self._running(rule, snapshot)
+        if not running:
+            self.start(rule)
+            return False
+        if rule.id not in listener.paused_rules:
+            return self.reload(rule)
+        if not merge and self._control(listener.rule_id, '/resume', snapshot['payload']):
+            self._update(listener, {rule.id: snapshot}, False)
+            return True
+        self.restart(rule)
+        return False
+
+    def sync(self, rule):
+        """按规则状态暂停或恢复监听进程"""
+        if rule.status == '1':
+            return self.resume(rule)
+        return self.pause(rule)
+
+    def _batches(self, rules, enabled):
+        """按监听进程分组可直接切换状态的规则
+
+        规则所在进程运行中、参数与记录一致且无需合并重启时可以合并切换，启用时还要求规则当前处于停用状态；
+        其余规则需要热更新、启动或重启，逐条处理。
+
+        Returns:
+            tuple: ([(ListenerProcess, {规则ID: 参数快照}), ...], [需要逐条处理的规则, ...])
+        """
+        snapshots = {rule.id: self.snapshot(rule) for rule in rules}
+        groups = {}
+        single = []
+        with self.lock:
+            for rule in rules:
+                snapshot = snapshots[rule.id]
+                listener = self.listeners.get(rule.id)
+                if (listener is None or not listener.alive() or listener.restarting
+                        or listener.rules.get(rule.id) != snapshot
+                        or (enabled and rule.id not in listener.paused_rules)
+                        or self._peers(snapshot['ports'], exclude=listener)):
+                    single.append(rule)
+                    continue
+                groups.setdefault(id(listener), (listener, {}))[1][rule.id] = snapshot
+        return list(groups.values()), single
+
+    def set_enabled(self, rules, enabled):
+        """批量启用或停用规则
+
+        同一监听进程中的规则合并为一次 /pause 或 /resume 请求（rule_id 为ID列表），前缀树只重建一次；
+        各监听进程的请求并发下发。请求失败或无法合并的规则按 pause()/resume() 逐条处理。
+
+        Args:
+            rules: KnockingRule 实例列表
+            enabled: True为启用，False为停用
+        """
+        if not rules:
+            return
+        batches, single = self._batches(rules, enabled)
+        by_id = {rule.id: rule for rule in rules}
+
+        def toggle(batch):
+            listener, snapshots = batch
+            if self._control(listener.rule_id, '/resume' if enabled else '/pause', {'rule_id': sorted(snapshots)}):
+                self._update(listener, snapshots, not enabled)
+                return
+            for rule_id in snapshots:
+                (self.resume if enabled else self.pause)(by_id[rule_id])
+
+        tasks = [(toggle, batch) for batch in batches]
+        tasks += [(self.resume if enabled else self.pause, rule) for rule in single]
+        with ThreadPoolExecutor(max_workers=min(16, len(tasks))) as pool:
+            list(pool.map(lambda task: task[0](task[1]), tasks))
+
+    def stop(self, rule_id, wait=False, revoke=False):
+        """停止规则并不再自动拉起
+
+        规则独占监听进程时结束进程；组内还有其他规则时只从进程中移除该规则，
+        移除的是命令行规则时按剩余规则改名重启。
+
+        Args:
+            rule_id: 规则ID
+            wait: 是否等待进程退出；默认在后台停止后立即返回
+            revoke: 是否先撤销该规则已开放的授权；否则授权由授权日志保留到期
+
+        Returns:
+            bool: wait为True时表示进程是否均已退出，否则总是True
+        """
+        with self.lock:
+            listener = self.listeners.pop(rule_id, None)
+            if listener is None:
+                return True
+            listener.rules.pop(rule_id, None)
+            paused = rule_id in listener.paused_rules
+            listener.paused_rules.discard(rule_id)
+            alive = listener.alive()
+            if not listener.rules:
+                self._discard(listener)
+            elif not alive:
+                # 等待拉起的监听进程按剩余规则启动
+                if rule_id == listener.rule_id:
+                    listener.rule_id = min(listener.rules)
+                    if self.state_dir:
+                        listener.adopt.add(rule_id)
+                self._assemble(listener)
+        if not alive:
+            return True
+        if revoke and not paused:
+            # 暂停会撤销该规则的全部授权，撤销请求在进程退出前由防火墙工作线程执行完毕
+            self._control(listener.rule_id, '/pause', {'rule_id': rule_id})
+        if not listener.rules:
+            return self._shutdown([listener.proc], wait=wait)
+
+        if rule_id != listener.rule_id and \
+                self._control(listener.rule_id, '/rules?' + urlencode({'rule_id': rule_id}), method='DELETE'):
+            with self.lock:
+                self._assemble(listener)
+            logging.info(f"规则 {rule_id} 已从监听进程 {listener.rule_id} 中移除")
+            return True
+        with self.lock:
+            # 改名后由新进程接管旧名称下的授权日志
+            adopt = {listener.rule_id} if self.state_dir and min(listener.rules) != listener.rule_id else ()
+            new, procs = self._regroup([listener], listener.rules, listener.paused_rules, adopt)
+        return self._replace(new, procs, wait=wait)
+
+    def stop_all(self, wait=False):
+        """并行停止全部监听进程
+
+        Args:
+            wait: 是否等待进程退出
+
+        Returns:
+            bool: wait为True时表示进程是否均已退出，否则总是True
+        """
+        with self.lock:
+            listeners, self.listeners = self._distinct(), {}
+            for listener in listeners:
+                self._discard(listener)
+        procs = [listener.proc for listener in listeners if listener.alive()]
+        if not procs:
+            return True
+        return self._shutdown(procs, wait=wait)
+
+    def _shutdown(self, procs, wait=False, then=None):
+        """停止一组进程，wait为False时在后台线程中执行
+
+        Args:
+            procs: psutil进程对象列表
+            wait: 是否阻塞到进程全部退出
+            then: 进程全部退出后调用的回调
+        """
+        def run():
+            result = self._terminate(procs, self.stop_timeout)
+            if then is not None:
+                then()
+            return result
+
+        if wait:
+            return run()
+        Thread(target=run, name='knocking-shutdown', daemon=True).start()
+        return True
+
+    @staticmethod
+    def _terminate(procs, timeout=5):
+        """先向全部进程发送SIGTERM让监听进程撤销授权后退出，超时仍未退出的再SIGKILL
+
+        所有进程并行等待，总耗时不超过两倍timeout。
+
+        Returns:
+            bool: 进程是否均已退出
+        """
+        def send(proc, action):
+            try:
+                getattr(proc, action)()
+                return True
+            except psutil.NoSuchProcess:
+                return False
+            except psutil.AccessDenied:
+                logging.error(f"权限不足，无法终止进程 {proc.pid}")
+                return False
+
+        procs = [proc for proc in procs if send(proc, 'terminate')]
+        gone, alive = psutil.wait_procs(procs, timeout=timeout)
+        for proc in gone:
+            logging.info(f"监听进程 {proc.pid} 已正常退出")
+        if not alive:
+            return True
+
+        for proc in alive:
+            logging.warning(f"监听进程 {proc.pid} 未在 {timeout} 秒内响应SIGTERM，将发送SIGKILL强制终止")
+            send(proc, 'kill')
+        gone, alive = psutil.wait_procs(alive, timeout=timeout)
+        for proc in alive:
+            logging.error(f"无法终止进程 {proc.pid}")
+        return not alive
+
+    def status(self, rule_id):
+        """规则所在监听进程的运行状态
+
+        Returns:
+            dict: alive、pid、uptime（秒）、restarts、lastExitCode、paused（该规则是否已停用）、
+                listenerId（监听进程名称，组内规则相同）
+        """
+        with self.lock:
+            listener = self.listeners.get(rule_id)
+            if listener is None:
+                return {'alive': False, 'pid': None, 'uptime': 0, 'restarts': 0, 'lastExitCode': None}
+            return listener.status(rule_id)
+
+    def reconcile(self):
+        """按数据库中的规则对账监听进程
+
+        敲门端口重叠的规则划分为一组，组内有启用的规则时需要一个监听进程，停用的规则作为停用成员。
+        """
+        from .KnockingRule import KnockingRule
+
+        try:
+            with self.app.app_context():
+                rules = KnockingRule.query.all()
+                snapshots = {rule.id: self.snapshot(rule) for rule in rules}
+                enabled = {rule.id for rule in rules if rule.status == '1'}
+        except Exception as e:
+            logging.error(f"读取敲门规则失败，跳过监听进程对账: {str(e)}")
+            return
+        groups = [ids for ids in group_rules({rule_id: s['ports'] for rule_id, s in snapshots.items()})
+                  if ids & enabled]
+        group_of = {rule_id: index for index, ids in enumerate(groups) for rule_id in ids}
+
+        def candidate(name, ids):
+            listener = ListenerProcess(name, {rule_id: snapshots[rule_id] for rule_id in sorted(ids)},
+                                       ids - enabled)
+            self._assemble(listener)
+            return listener
+
+        # 接管以组内某条规则命名、组成和不可热更新参数一致的存量进程，并行结束其余的监听进程
+        adopted = {}
+        stale = []
+        for proc in psutil.process_iter(['pid', 'cmdline']):
+            cmdline = proc.info['cmdline'] or []
+            if not any(arg.endswith('knocking_cmd.py') for arg in cmdline):
+                continue
+            rule_id = cmdline[cmdline.index('--rule-id') + 1] if '--rule-id' in cmdline[:-1] else None
+            index = group_of.get(rule_id)
+            if index is not None and index not in adopted:
+                listener = candidate(rule_id, groups[index])
+                if static_args(cmdline) == static_args(listener.cmd) and self._sync(listener, cmdline):
+                    listener.proc = proc
+                    adopted[index] = listener
+                    continue
+            logging.warning(f"结束无主的监听进程 {proc.pid}: {' '.join(cmdline)}")
+            stale.append(proc)
+        if stale:
+            # 等待旧进程释放抓包和防火墙资源后再启动新进程
+            self._terminate(stale, self.stop_timeout)
+
+        with self.lock:
+            for index, ids in enumerate(groups):
+                if any(rule_id in self.listeners for rule_id in ids):
+                    continue
+                listener = adopted.get(index) or candidate(min(ids), ids)
+                for rule_id in ids:
+                    self.listeners[rule_id] = listener
+                if index in adopted:
+                    listener.started = listener.proc.create_time()
+                    logging.info(f"接管规则 {', '.join(listener.rules)} 的监听进程 {listener.proc.pid}")
+                else:
+                    try:
+                        self._spawn(listener)
+                    except OSError as e:
+                        logging.error(f"启动监听进程 {listener.rule_id} 失败: {str(e)}")
+                        listener.next_start = time.time() + self.backoff
+
+    def _sync(self, listener, cmdline):
+        """把接管的存量进程同步为数据库中的参数和启用状态
+
+        Returns:
+            bool: 是否同步成功
+        """
+        if len(listener.rules) == 1 and cmdline[1:] == listener.cmd[1:]:
+            return True
+        # 命令行参数不一致时（曾被热更新、暂停，或规则在Web进程停止期间被修改），恢复并同步为数据库中的参数；
+        # 规则组的成员参数在 --rules-file 中，逐条同步
+        for rule_id, snapshot in listener.rules.items():
+            if rule_id in listener.paused_rules:
+                ok = self._control(listener.rule_id, '/pause', {'rule_id': rule_id})
+            else:
+                ok = self._control(listener.rule_id, '/resume', snapshot['payload'])
+            if not ok:
+                return False
+        return True
+
+    def _start_monitor(self, reconcile=False):
+        with self.lock:
+            if self._thread is not None:
+                return
+            self._thread = Thread(target=self._monitor, args=(reconcile,),
+                                  name='knocking-supervisor', daemon=True)
+            self._thread.start()
+
+    def _monitor(self, reconcile):
+        if reconcile:
+            self.reconcile()
+        while not self._stopped.wait(self.poll_interval):
+            try:
+                self.check()
+            except Exception as e:
+                logging.error(f"监听进程巡检失败: {str(e)}")
+
+    def check(self):
+        """巡检一次：记录异常退出的进程，并拉起到达重启时间的进程"""
+        now = time.time()
+        with self.lock:
+            for listener in self._distinct():
+                if listener.proc is not None:
+                    if listener.alive():
+                        continue
+                    listener.last_exit = listener.exit_code()
+                    if listener.started and now - listener.started >= self.stable_time:
+                        listener.failures = 0
+                    listener.failures += 1
+                    delay = min(self.backoff_max, self.backoff * 2 ** (listener.failures - 1))
+                    listener.proc = None
+                    listener.next_start = now + delay
+                    logging.error(f"监听进程 {listener.rule_id} 异常退出（退出码 {listener.last_exit}），"
+                                  f"{delay} 秒后重启")
+                    continue
+
+                if listener.next_start is not None and listener.next_start <= now:
+                    listener.restarts += 1
+                    try:
+                        self._spawn(listener)
+                    except OSError as e:
+                        listener.failures += 1
+                        listener.next_start = now + min(self.backoff_max,
+                                                        self.backoff * 2 ** (listener.failures - 1))
+                        logging.error(f"重启监听进程 {listener.rule_id} 失败: {str(e)}")
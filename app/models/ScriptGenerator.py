@@ -1,46 +1,115 @@
 # coding:utf-8
 # by 川普
 
+import ipaddress
 import os
 import re
-import shutil
-from tempfile import NamedTemporaryFile, mkdtemp
-from zipfile import ZipFile
+import struct
+import time
+import zlib
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from io import BytesIO
+from threading import Lock
+from zipfile import ZIP_DEFLATED, ZIP_STORED, ZipFile, ZipInfo
+
+# ZIP 本地文件头、中央目录项和目录结束记录，字段含义见 PKWARE APPNOTE 4.3.7/4.3.12/4.3.16
+LOCAL_HEADER = struct.Struct('<4s5H3L2H')
+CENTRAL_HEADER = struct.Struct('<4s6H3L5H2L')
+END_OF_CENTRAL_DIR = struct.Struct('<4s4H2LH')
+
+# 主机名：以点分隔的字母数字标签，标签不以连字符开头或结尾（RFC 1123）
+HOSTNAME_PATTERN = re.compile(
+    r'^(?=.{1,253}$)[A-Za-z0-9](?:[A-Za-z0-9-]{0,61}[A-Za-z0-9])?(?:\.[A-Za-z0-9](?:[A-Za-z0-9-]{0,61}[A-Za-z0-9])?)*$')
 
 class ScriptGenerator:
     """客户端脚本生成器
-    
+
     用于生成不同版本的端口敲门客户端脚本，支持Python、EXE和Bash版本。
     可以根据用户提供的参数动态替换脚本中的配置。
-    
+
+    模板文件只在首次使用或文件修改后读取一次，生成结果全部在内存中构造，不落盘。
+    EXE程序包的EXE和说明文件只压缩一次得到公共部分，每次下载只在其后追加不压缩的start.txt
+    和新的中央目录，公共部分原样输出。
+    build() 按 (规则, 目标主机, 脚本类型) 缓存生成结果，规则的端口序列、认证方式或所用模板文件
+    变化时自动失效，修改或删除规则时也可以调用 invalidate() 主动清除。iter_bundle() 并发生成多条规则、多个主机的
+    脚本，按完成顺序流式写入一个ZIP文件。应用内使用 app.script_generator 单例。
+
     Attributes:
         SCRIPT_DIR (str): 脚本文件所在目录
         PYTHON_TEMPLATE (str): Python版本脚本模板路径
         EXE_TEMPLATE (str): EXE版本程序路径
         BASH_TEMPLATE (str): Bash版本脚本模板路径
         START_TEMPLATE (str): EXE启动配置模板路径
+        max_cache_bytes (int): 生成结果缓存的总大小上限，超出时淘汰最久未使用的结果
     """
-    
-    def __init__(self):
+
+    # 脚本类型对应的下载文件名
+    FILENAMES = {
+        'python': 'knockclient.py',
+        'exe': 'knockclient_exe.zip',
+        'bash': 'knockclient.sh',
+    }
+
+    PYTHON_PATTERNS = (
+        re.compile(r'SERVER_IP = .*\n'),
+        re.compile(r'KNOCK_SEQUENCE = \[.*?\]', re.DOTALL),
+        re.compile(r"AUTH_MODE = .*\n"),
+    )
+    BASH_PATTERNS = (
+        re.compile(r'SERVER_IP=.*\n'),
+        re.compile(r'KNOCK_SEQUENCE=\(.*?\)', re.DOTALL),
+        re.compile(r'AUTH_MODE=.*\n'),
+    )
+
+    def __init__(self, max_cache_bytes=64 * 1024 * 1024):
         self.SCRIPT_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'script')
         self.PYTHON_TEMPLATE = os.path.join(self.SCRIPT_DIR, 'client.py')
         self.EXE_TEMPLATE = os.path.join(self.SCRIPT_DIR, 'PortKnockProConfig.exe')
         self.BASH_TEMPLATE = os.path.join(self.SCRIPT_DIR, 'client.sh')
         self.START_TEMPLATE = os.path.join(self.SCRIPT_DIR, 'start.txt')
-    
+        self.max_cache_bytes = max_cache_bytes
+        self._templates = {}
+        self._exe_base = None
+        self._artifacts = OrderedDict()
+        self._cache_bytes = 0
+        self._lock = Lock()
+
+    def _template(self, path, binary=False):
+        """读取模板文件，按修改时间缓存
+
+        Args:
+            path (str): 模板文件路径
+            binary (bool): 是否按字节读取
+
+        Returns:
+            str|bytes: 模板内容
+        """
+        mtime = os.stat(path).st_mtime_ns
+        cached = self._templates.get(path)
+        if cached is None or cached[0] != mtime:
+            if binary:
+                with open(path, 'rb') as f:
+                    content = f.read()
+            else:
+                with open(path, 'r', encoding='utf-8') as f:
+                    content = f.read()
+            cached = self._templates[path] = (mtime, content)
+        return cached[1]
+
     def _format_port_sequence(self, port_sequence, script_type='python'):
         """格式化端口序列为不同脚本类型需要的格式
-        
+
         Args:
             port_sequence (str): 原始端口序列字符串，格式如 "1201:TCP,2301:UDP"
             script_type (str): 脚本类型，可选值：python, exe, bash
-            
+
         Returns:
             str: 格式化后的端口序列字符串
         """
         if script_type == 'python':
             # Python格式: [(port, 'PROTO'), ...]
-            pairs = [f"({port}, '{proto}')" for port, proto in 
+            pairs = [f"({port}, '{proto}')" for port, proto in
                     [item.split(':') for item in port_sequence.split(',')]]
             return '[\n    ' + ',\n    '.join(pairs) + '\n]'
         elif script_type == 'exe':
@@ -48,109 +117,271 @@ class ScriptGenerator:
             return port_sequence
         else:  # bash
             # Bash格式: "port proto"
-            pairs = [f'"{port} {proto.lower()}"' for port, proto in 
+            pairs = [f'"{port} {proto.lower()}"' for port, proto in
                     [item.split(':') for item in port_sequence.split(',')]]
             return '(' + ' '.join(pairs) + ')'
-    
-    def generate_python_script(self, host, port_sequence):
+
+    def generate_python_script(self, host, port_sequence, auth_mode='md5'):
         """生成Python版本的客户端脚本
-        
+
         Args:
             host (str): 目标服务器IP地址
             port_sequence (str): 端口序列
-            
+            auth_mode (str): 认证方式，md5或totp
+
         Returns:
-            str: 生成的临时文件路径
+            bytes: 脚本内容（UTF-8）
         """
-        with open(self.PYTHON_TEMPLATE, 'r', encoding='utf-8') as f:
-            content = f.read()
-        
+        server_ip, knock_sequence, mode = self.PYTHON_PATTERNS
+        content = self._template(self.PYTHON_TEMPLATE)
+
         # 替换配置参数
-        content = re.sub(
-            r'SERVER_IP = .*\n',
-            f"SERVER_IP = '{host}'\n",
-            content
-        )
-        content = re.sub(
-            r'KNOCK_SEQUENCE = \[.*?\]',
-            f"KNOCK_SEQUENCE = {self._format_port_sequence(port_sequence)}",
-            content,
-            flags=re.DOTALL
-        )
-        
-        # 创建临时文件
-        temp_file = NamedTemporaryFile(delete=False, suffix='.py')
-        with open(temp_file.name, 'w', encoding='utf-8') as f:
-            f.write(content)
-        
-        return temp_file.name
-    
-    def generate_exe_package(self, host, port_sequence):
+        content = server_ip.sub(lambda m: f"SERVER_IP = '{host}'\n", content)
+        content = knock_sequence.sub(
+            lambda m: f"KNOCK_SEQUENCE = {self._format_port_sequence(port_sequence)}", content)
+        content = mode.sub(lambda m: f"AUTH_MODE = '{auth_mode}'\n", content)
+        return content.encode('utf-8')
+
+    def _template_stamp(self, script_type):
+        """脚本类型所用模板文件的修改时间，模板修改后据此重新生成
+
+        Returns:
+            tuple: 各模板文件的 st_mtime_ns
+        """
+        if script_type == 'exe':
+            paths = (self.EXE_TEMPLATE, os.path.join(self.SCRIPT_DIR, 'instructions.txt'))
+        else:
+            paths = (self.PYTHON_TEMPLATE if script_type == 'python' else self.BASH_TEMPLATE,)
+        return tuple(os.stat(path).st_mtime_ns for path in paths)
+
+    def _exe_package_base(self):
+        """EXE程序包的公共部分，EXE或说明文件修改后重新压缩
+
+        Returns:
+            tuple: (各文件数据 bytes, 中央目录 bytes, 文件数)
+        """
+        instructions = os.path.join(self.SCRIPT_DIR, 'instructions.txt')
+        stamp = self._template_stamp('exe')
+        base = self._exe_base
+        if base is None or base[0] != stamp:
+            buffer = BytesIO()
+            with ZipFile(buffer, 'w', ZIP_DEFLATED) as zipf:
+                zipf.write(self.EXE_TEMPLATE, 'PortKnockProConfig.exe')
+                zipf.write(instructions, 'instructions.txt')
+            data = buffer.getvalue()
+            end = END_OF_CENTRAL_DIR.unpack_from(data, len(data) - END_OF_CENTRAL_DIR.size)
+            count, size, offset = end[4], end[5], end[6]
+            base = self._exe_base = (stamp, data[:offset], data[offset:offset + size], count)
+        return base[1:]
+
+    def exe_package_parts(self, host, port_sequence, auth_mode='md5'):
+        """生成EXE版本的客户端程序包，按顺序输出各部分即为完整的ZIP文件
+
+        Args:
+            host (str): 目标服务器IP地址
+            port_sequence (str): 端口序列
+            auth_mode (str): 认证方式，md5或totp，写入start.txt第三行
+
+        Returns:
+            list: [公共部分 bytes, start.txt及中央目录 bytes]，公共部分在多次调用间共享
+        """
+        body, central, count = self._exe_package_base()
+
+        # 生成启动配置文件，以不压缩方式追加在公共部分之后
+        start_content = f'{host}\n"{port_sequence}"\n{auth_mode}'.encode('utf-8')
+        name = b'start.txt'
+        crc = zlib.crc32(start_content)
+        now = time.localtime()
+        dos_time = now.tm_hour << 11 | now.tm_min << 5 | now.tm_sec // 2
+        dos_date = (now.tm_year - 1980) << 9 | now.tm_mon << 5 | now.tm_mday
+        size = len(start_content)
+
+        local = LOCAL_HEADER.pack(b'PK\x03\x04', 20, 0, 0, dos_time, dos_date, crc, size, size, len(name), 0)
+        entry = CENTRAL_HEADER.pack(b'PK\x01\x02', 3 << 8 | 20, 20, 0, 0, dos_time, dos_date, crc, size, size,
+                                    len(name), 0, 0, 0, 0, 0o100644 << 16, len(body)) + name
+        directory_offset = len(body) + len(local) + len(name) + size
+        end = END_OF_CENTRAL_DIR.pack(b'PK\x05\x06', 0, 0, count + 1, count + 1,
+                                      len(central) + len(entry), directory_offset, 0)
+        return [body, b''.join((local, name, start_content, central, entry, end))]
+
+    def generate_exe_package(self, host, port_sequence, auth_mode='md5'):
         """生成EXE版本的客户端程序包
-        
+
         Args:
             host (str): 目标服务器IP地址
             port_sequence (str): 端口序列
-            
+            auth_mode (str): 认证方式，md5或totp，写入start.txt第三行
+
         Returns:
-            str: 生成的ZIP文件路径
+            bytes: ZIP文件内容
         """
-        # 创建临时目录
-        temp_dir = mkdtemp()
-        
-        # 复制EXE文件
-        exe_path = os.path.join(temp_dir, 'PortKnockProConfig.exe')
-        shutil.copy2(self.EXE_TEMPLATE, exe_path)
-        
-        # 复制说明文件
-        instructions_path = os.path.join(temp_dir, 'instructions.txt')
-        shutil.copy2(os.path.join(self.SCRIPT_DIR, 'instructions.txt'), instructions_path)
-        
-        # 生成启动配置文件
-        start_content = f'{host}\n"{port_sequence}"'
-        
-        start_path = os.path.join(temp_dir, 'start.txt')
-        with open(start_path, 'w', encoding='utf-8') as f:
-            f.write(start_content)
-        
-        # 创建ZIP文件
-        zip_path = os.path.join(temp_dir, 'knockclient_exe.zip')
-        with ZipFile(zip_path, 'w') as zipf:
-            zipf.write(exe_path, os.path.basename(exe_path))
-            zipf.write(instructions_path, os.path.basename(instructions_path))
-            zipf.write(start_path, os.path.basename(start_path))
-        
-        return zip_path
-    
-    def generate_bash_script(self, host, port_sequence):
+        return b''.join(self.exe_package_parts(host, port_sequence, auth_mode))
+
+    def generate_bash_script(self, host, port_sequence, auth_mode='md5'):
         """生成Bash版本的客户端脚本
-        
+
         Args:
             host (str): 目标服务器IP地址
             port_sequence (str): 端口序列
-            
+            auth_mode (str): 认证方式，md5或totp
+
         Returns:
-            str: 生成的临时文件路径
+            bytes: 脚本内容（UTF-8）
         """
-        with open(self.BASH_TEMPLATE, 'r', encoding='utf-8') as f:
-            content = f.read()
-        
+        server_ip, knock_sequence, mode = self.BASH_PATTERNS
+        content = self._template(self.BASH_TEMPLATE)
+
         # 替换配置参数
-        content = re.sub(
-            r'SERVER_IP=.*\n',
-            f"SERVER_IP='{host}'\n",
-            content
-        )
-        content = re.sub(
-            r'KNOCK_SEQUENCE=\(.*?\)',
-            f"KNOCK_SEQUENCE={self._format_port_sequence(port_sequence, 'bash')}",
-            content,
-            flags=re.DOTALL
-        )
-        
-        # 创建临时文件
-        temp_file = NamedTemporaryFile(delete=False, suffix='.sh')
-        with open(temp_file.name, 'w', encoding='utf-8') as f:
-            f.write(content)
-        
-        return temp_file.name
\ No newline at end of file
+        content = server_ip.sub(lambda m: f"SERVER_IP='{host}'\n", content)
+        content = knock_sequence.sub(
+            lambda m: f"KNOCK_SEQUENCE={self._format_port_sequence(port_sequence, 'bash')}", content)
+        content = mode.sub(lambda m: f'AUTH_MODE="{auth_mode}"\n', content)
+        return content.encode('utf-8')
+
+    @staticmethod
+    def normalize_host(host):
+        """校验目标主机，返回规范形式
+
+        目标主机会写入脚本的 SERVER_IP 和批量下载ZIP内的路径，只接受IP地址或主机名。
+
+        Args:
+            host (str): 目标服务器IP地址或主机名
+
+        Returns:
+            str: IP地址的规范文本或小写的主机名
+
+        Raises:
+            ValueError: 不是IP地址或合法的主机名
+        """
+        if isinstance(host, str):
+            try:
+                return str(ipaddress.ip_address(host))
+            except ValueError:
+                if HOSTNAME_PATTERN.match(host):
+                    return host.lower()
+        raise ValueError(f'无效的目标主机: {host!r}')
+
+    def build(self, rule, host, script_type):
+        """生成并缓存规则的客户端脚本
+
+        Args:
+            rule: 敲门规则（KnockingRule）
+            host (str): 目标服务器IP地址或主机名，见 normalize_host()
+            script_type (str): 脚本类型，python、exe或bash
+
+        Returns:
+            tuple: (按顺序拼接即为文件内容的 bytes 列表, 下载文件名)
+
+        Raises:
+            ValueError: 目标主机无效
+        """
+        host = self.normalize_host(host)
+        key = (rule.id, host, script_type)
+        # 规则参数或模板文件变化后缓存失效，模板只比较修改时间，不重新读取
+        fingerprint = (rule.port_sequence, rule.auth_mode, self._template_stamp(script_type))
+        with self._lock:
+            cached = self._artifacts.get(key)
+            if cached is not None and cached[0] == fingerprint:
+                self._artifacts.move_to_end(key)
+                return cached[1], self.FILENAMES[script_type]
+
+        if script_type == 'exe':
+            parts = self.exe_package_parts(host, rule.port_sequence, rule.auth_mode)
+            # 公共部分由所有EXE下载共享，只按追加部分计入缓存大小
+            size = len(parts[-1])
+        else:
+            generate = self.generate_python_script if script_type == 'python' else self.generate_bash_script
+            parts = [generate(host, rule.port_sequence, rule.auth_mode)]
+            size = len(parts[0])
+
+        with self._lock:
+            self._discard(key)
+            if size <= self.max_cache_bytes:
+                self._artifacts[key] = (fingerprint, parts, size)
+                self._cache_bytes += size
+                while self._cache_bytes > self.max_cache_bytes:
+                    self._discard(next(iter(self._artifacts)))
+        return parts, self.FILENAMES[script_type]
+
+    def _discard(self, key):
+        """移除一条缓存，调用方需持有 self._lock"""
+        cached = self._artifacts.pop(key, None)
+        if cached is not None:
+            self._cache_bytes -= cached[2]
+
+    def invalidate(self, rule_id=None):
+        """清除规则的缓存结果，rule_id为None时清除全部"""
+        with self._lock:
+            for key in [k for k in self._artifacts if rule_id is None or k[0] == rule_id]:
+                self._discard(key)
+
+    def iter_bundle(self, rules, hosts, script_types, workers=4):
+        """并发生成多条规则、多个主机的客户端脚本，流式输出为一个ZIP文件
+
+        每个脚本生成完成后立即写入ZIP并输出，同时生成中的任务不超过 workers 的两倍，
+        整个ZIP不会驻留在内存中。生成失败的脚本记录在 errors.txt 中，不中断其余脚本。
+
+        Args:
+            rules (list): 敲门规则列表
+            hosts (list): 目标服务器地址列表，调用方应先用 normalize_host() 校验
+            script_types (list): 脚本类型列表，python、exe或bash
+            workers (int): 并发生成的线程数
+
+        Yields:
+            bytes: ZIP文件内容的分块
+        """
+        stream = _ChunkStream()
+        jobs = iter([(rule, host, script_type) for rule in rules for host in hosts for script_type in script_types])
+        errors = []
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='script-bundle') as pool, \
+                ZipFile(stream, 'w', ZIP_DEFLATED) as zipf:
+            pending = {}
+            while True:
+                for rule, host, script_type in jobs:
+                    pending[pool.submit(self.build, rule, host, script_type)] = (rule, host, script_type)
+                    if len(pending) >= 2 * workers:
+                        break
+                if not pending:
+                    break
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    rule, host, script_type = pending.pop(future)
+                    try:
+                        parts, filename = future.result()
+                    except Exception as e:
+                        errors.append(f'{rule.id} {host} {script_type}: {e}')
+                        continue
+                    # 路径只使用校验后的主机（build() 对无效主机抛出异常，不会走到这里）；
+                    # IPv6地址中的冒号和区域标识符的百分号在Windows文件名中不合法
+                    path_host = re.sub(r'[:%]', '_', self.normalize_host(host))
+                    info = ZipInfo(f"{rule.id}/{path_host}/{filename}", time.localtime()[:6])
+                    # EXE程序包本身已压缩，原样存入
+                    info.compress_type = ZIP_STORED if script_type == 'exe' else ZIP_DEFLATED
+                    info.file_size = sum(len(part) for part in parts)
+                    with zipf.open(info, 'w') as f:
+                        for part in parts:
+                            f.write(part)
+                            yield from stream.drain()
+            if errors:
+                zipf.writestr('errors.txt', '\n'.join(errors) + '\n')
+        yield from stream.drain()
+
+
+class _ChunkStream:
+    """只写不可寻址的输出流，缓存写入的数据直到被取走"""
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        """取走已写入的数据，没有数据时返回空列表"""
+        chunks = [b''.join(self._chunks)] if self._chunks else []
+        self._chunks.clear()
+        return chunks
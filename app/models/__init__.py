@@ -9,3 +9,4 @@ from .DictData import DictData
 from .DictType import DictType
 from .Config import Config
 from .KnockingRule import KnockingRule
+from .KnockingEvent import KnockingEvent
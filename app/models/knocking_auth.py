@@ -0,0 +1,210 @@
+# coding:utf-8
+"""
+端口敲门最终包认证模块
+
+每条规则在启动时构造一个认证器(Verifier)，预先计算好期望的载荷，数据包处理路径只调用
+verify(payload)。认证器通过 VERIFIERS 注册，新增认证方案无需修改 knocking_cmd.py 的处理逻辑。
+
+载荷比较统一使用 hmac.compare_digest，且不对载荷做复制：长度明显不符的包直接拒绝，
+带填充（以太网最小帧补零、末尾换行等）的载荷通过计算有效区间后用 memoryview 比较。
+
+支持的认证方案：
+- md5: 载荷为密码MD5的十六进制字符串，静态不变（历史方案）
+- totp: 载荷为 HMAC-SHA256(密码MD5, 时间片序号) 十六进制的前32位，随时间片变化，
+  服务端维护当前时间片前后的有效令牌窗口和已使用令牌的重放缓存
+"""
+
+import hashlib
+import hmac
+import struct
+import time
+from collections import OrderedDict
+from threading import Event, Lock, Thread
+
+# 载荷两端允许出现的填充字符：空字节和空白字符
+_PADDING = frozenset(b'\x00 \t\r\n\x0b\x0c')
+
+
+def trim_bounds(payload):
+    """计算去除两端填充字符后的有效区间
+
+    Args:
+        payload: 原始载荷
+
+    Returns:
+        tuple: (start, end)，有效载荷为 payload[start:end]
+    """
+    start, end = 0, len(payload)
+    while start < end and payload[start] in _PADDING:
+        start += 1
+    while end > start and payload[end - 1] in _PADDING:
+        end -= 1
+    return start, end
+
+
+class PasswordVerifier:
+    """最终包认证器基类
+
+    Attributes:
+        scheme: 认证方案名称，对应命令行 --auth-scheme 参数
+        max_padding: 允许的最大填充字节数，超出直接拒绝
+    """
+    scheme = None
+    max_padding = 64
+
+    def verify(self, payload):
+        """校验最终包载荷
+
+        Args:
+            payload: 最终包的传输层载荷(bytes)
+
+        Returns:
+            bool: 认证是否通过
+        """
+        raise NotImplementedError
+
+    def _match(self, payload, expected):
+        """在容忍两端填充的前提下常量时间比较载荷与期望值"""
+        length = len(expected)
+        size = len(payload)
+        if size < length or size > length + self.max_padding:
+            return False
+        if size == length:
+            return hmac.compare_digest(payload, expected)
+        start, end = trim_bounds(payload)
+        if end - start != length:
+            return False
+        return hmac.compare_digest(memoryview(payload)[start:end], expected)
+
+    def close(self):
+        """释放认证器持有的资源"""
+
+
+class Md5HexVerifier(PasswordVerifier):
+    """静态MD5认证：最终包载荷为密码MD5的十六进制字符串（与历史版本兼容）"""
+    scheme = 'md5'
+
+    def __init__(self, secret):
+        """
+        Args:
+            secret: 密码的MD5十六进制字符串（即规则中存储的 password_hash）
+        """
+        self.expected = secret.encode('utf-8')
+
+    def verify(self, payload):
+        return self._match(payload, self.expected)
+
+
+def totp_token(secret, counter):
+    """计算指定时间片的认证令牌（客户端与服务端共用的算法）
+
+    Args:
+        secret: 密码MD5的十六进制字符串
+        counter: 时间片序号，即 int(unix时间 / 时间片长度)
+
+    Returns:
+        bytes: 32位十六进制令牌
+    """
+    digest = hmac.new(secret.encode('utf-8'), struct.pack('>Q', counter), hashlib.sha256).hexdigest()
+    return digest[:32].encode('ascii')
+
+
+class HmacTotpVerifier(PasswordVerifier):
+    """基于时间片的HMAC认证
+
+    有效令牌窗口由后台定时线程在每个时间片开始时重新计算，数据包处理路径只与窗口内
+    少量预计算令牌比较。认证成功的令牌记入有界重放缓存，同一令牌在窗口内只能使用一次。
+
+    Attributes:
+        step: 时间片长度（秒）
+        skew: 允许的前后时间片偏移数，用于容忍时钟误差
+    """
+    scheme = 'totp'
+
+    def __init__(self, secret, step=30, skew=1, replay_size=1024, clock=time.time, autostart=True):
+        """
+        Args:
+            secret: 密码MD5的十六进制字符串
+            step: 时间片长度（秒）
+            skew: 允许的前后时间片偏移数
+            replay_size: 重放缓存的最大条目数
+            clock: 时间函数，便于测试
+            autostart: 是否启动定时刷新线程
+        """
+        self.secret = secret
+        self.step = step
+        self.skew = skew
+        self.replay_size = replay_size
+        self.clock = clock
+        self.tokens = ()
+        self._used = OrderedDict()
+        self._lock = Lock()
+        self._stopped = Event()
+        self.refresh()
+        if autostart:
+            Thread(target=self._refresh_loop, name='totp-refresh', daemon=True).start()
+
+    def refresh(self):
+        """重新计算有效令牌窗口，并清理已移出窗口的重放记录"""
+        counter = int(self.clock() // self.step)
+        self.tokens = tuple(
+            (c, totp_token(self.secret, c)) for c in range(counter - self.skew, counter + self.skew + 1)
+        )
+        oldest = counter - self.skew
+        with self._lock:
+            for token in [t for t, c in self._used.items() if c < oldest]:
+                del self._used[token]
+
+    def _refresh_loop(self):
+        while True:
+            # 等待到下一个时间片开始
+            delay = self.step - (self.clock() % self.step)
+            if self._stopped.wait(delay):
+                return
+            self.refresh()
+
+    def verify(self, payload):
+        matched = None
+        for counter, token in self.tokens:
+            if self._match(payload, token):
+                matched = (counter, token)
+        if matched is None:
+            return False
+        counter, token = matched
+        with self._lock:
+            if token in self._used:
+                return False
+            self._used[token] = counter
+            if len(self._used) > self.replay_size:
+                self._used.popitem(last=False)
+        return True
+
+    def close(self):
+        self._stopped.set()
+
+
+VERIFIERS = {
+    Md5HexVerifier.scheme: Md5HexVerifier,
+    HmacTotpVerifier.scheme: HmacTotpVerifier,
+}
+
+
+def create_verifier(scheme, secret, totp_step=30):
+    """根据认证方案创建认证器
+
+    Args:
+        scheme: 认证方案名称，取值见 VERIFIERS
+        secret: 规则密钥（密码的MD5十六进制字符串）
+        totp_step: totp方案的时间片长度（秒）
+
+    Returns:
+        PasswordVerifier: 认证器实例
+
+    Raises:
+        ValueError: 未知的认证方案
+    """
+    if scheme not in VERIFIERS:
+        raise ValueError(f"未知的认证方案: {scheme}")
+    if scheme == HmacTotpVerifier.scheme:
+        return HmacTotpVerifier(secret, step=totp_step)
+    return VERIFIERS[scheme](secret)
@@ -7,6 +7,7 @@
 该模块实现了一个增强型的端口敲门(Port Knocking)认证服务，通过监听特定端口序列的访问来动态管理防火墙规则。
 主要特点：
 - 支持TCP/UDP混合的敲门序列
+- 同时支持IPv4和IPv6客户端
 - 基于时间窗口的序列验证
 - 最终包密码验证机制
 - 自动超时的防火墙规则管理
@@ -23,35 +24,146 @@
 使用方法：
     python knocking_cmd.py -pl "1201:TCP,2301:UDP,3401:TCP" -p 22 -passwd "yourpassword" -w 10 -t 30
 
+防火墙后端通过 -fw 选择（firewalld/nftables/ipset/memory），见 knocking_firewall.py。
+指定 --control-socket 时在该Unix套接字上提供 /metrics（Prometheus文本格式）和 /stats（JSON），
+并可通过 POST /reload 热更新敲门序列、时间窗口、有效期和密码，无需重启进程；
+POST /pause、POST /resume 用于规则停用和启用（请求体中的 rule_id 可以是列表，一次切换多条规则），
+停用期间进程保留但不处理敲门。
+环境变量 AUTHBASE_EVENT_DB_URI 指定数据库时，敲门成功、失败、超时等审计事件批量写入 sys_knocking_event 表，
+数据库不可用期间暂存到 --state-dir 下的溢出文件，见 knocking_events.py。
+指定 --workers N（N>1）时以多进程分片模式运行：主进程抓包并按源地址网段分发给N个工作进程，
+每个工作进程运行独立的状态机，控制接口行为不变，见 knocking_shard.py。
+GET /grants 列出当前授权（?ip=前缀&offset=&limit=），DELETE /grants?ip=... 立即撤销指定源地址的授权。
+指定 --rules-file 时同一进程同时服务文件中列出的其他规则，所有规则的敲门序列编译为一棵前缀树，
+每个数据包只查找一次即可推进全部候选规则，序列可以共享前缀，见 knocking_dispatch.py。
+
 需要root权限运行。
 
 作者: Trump
 """
 
 from scapy.all import *
-from threading import Lock, Thread
+from threading import Event, Lock, Thread
 import time
-import subprocess
-from shlex import quote
+import queue
 import argparse
+import json
 import logging
+import re
 import sys
 import os
-from logging.handlers import TimedRotatingFileHandler
+import signal
+import socket
+from logging.handlers import QueueHandler, QueueListener, TimedRotatingFileHandler
+from knocking_firewall import BACKENDS, FirewallWorker, GrantJournal, create_backend, merge_journals
+from knocking_auth import VERIFIERS, create_verifier
+from knocking_guard import KnockGuard
+from knocking_metrics import MetricsRegistry
+from knocking_control import ControlServer
+from knocking_events import EventWriter
+from knocking_dispatch import KnockTrie
+from knocking_shard import ShardDispatcher, ShardedControl, receive_frames, shard_of_address
+from scapy.arch.linux import attach_filter
+
+
+class EventRateLimitFilter(logging.Filter):
+    """按事件类型限制日志频率的过滤器
+
+    以日志的格式模板（record.msg）作为事件类型，每个统计周期内每种事件最多放行
+    rate 条，其余丢弃并计数；周期结束时由 flush() 输出一条"已抑制 N 条"的汇总。
+    挂在 QueueHandler 上，被抑制的日志不会进入队列。
+    """
+
+    def __init__(self, rate=20, interval=60):
+        super().__init__()
+        self.rate = rate
+        self.interval = interval
+        self.counts = {}
+        self.suppressed = {}
+        self.lock = Lock()
+
+    def filter(self, record):
+        if self.rate <= 0 or record.levelno >= logging.ERROR:
+            return True
+        key = record.msg
+        with self.lock:
+            count = self.counts.get(key, 0) + 1
+            self.counts[key] = count
+            if count <= self.rate:
+                return True
+            self.suppressed[key] = self.suppressed.get(key, 0) + 1
+            return False
+
+    def flush(self):
+        """结束当前统计周期，输出被抑制事件的汇总"""
+        with self.lock:
+            suppressed, self.suppressed, self.counts = self.suppressed, {}, {}
+        for key, count in suppressed.items():
+            logger.warning("过去 %s 秒内抑制了 %s 条日志：%s", self.interval, count, key)
+
+
+class LazyQueueHandler(QueueHandler):
+    """只入队不格式化的QueueHandler
+
+    标准QueueHandler会在入队前格式化消息，这里把格式化推迟到监听线程。
+    队列仅在进程内使用，日志参数无需序列化。
+    """
+
+    def prepare(self, record):
+        return record
 
 
-def setup_logging():
+class LogFlusher(Thread):
+    """定期触发日志汇总的后台线程"""
+
+    def __init__(self, rate_filter):
+        super().__init__(name='log-flusher', daemon=True)
+        self.rate_filter = rate_filter
+        self.stopped = Event()
+
+    def run(self):
+        while not self.stopped.wait(self.rate_filter.interval):
+            self.rate_filter.flush()
+
+    def stop(self):
+        self.stopped.set()
+        self.rate_filter.flush()
+
+
+class LoggingRuntime:
+    """日志运行时：持有后台队列监听器和汇总线程，退出时统一停止"""
+
+    def __init__(self, listener, flusher):
+        self.listener = listener
+        self.flusher = flusher
+
+    def stop(self):
+        self.flusher.stop()
+        if self.listener is not None:
+            self.listener.stop()
+
+
+def setup_logging(level='INFO', log_file='knocking_cmd.log', rate=20, interval=60):
     """设置日志记录器
     
     配置日志记录的格式和输出方式：
     1. 控制台输出：简单的时间和消息格式
     2. 文件输出：带日期的详细日志，支持每日轮转
     
+    数据包处理线程只把日志记录放入内存队列（QueueHandler），格式化和磁盘写入
+    由 QueueListener 的后台线程完成；同一事件类型的日志按周期限流。
+    
+    Args:
+        level: 日志级别名称，如 DEBUG/INFO/WARNING
+        log_file: 日志文件路径
+        rate: 每个统计周期内每种事件最多记录的条数，0表示不限流
+        interval: 限流统计周期（秒）
+    
     Returns:
-        logging.Logger: 配置好的日志记录器实例
+        LoggingRuntime: 日志运行时，进程退出前需调用 stop()
     """
-    logger = logging.getLogger()
-    logger.setLevel(logging.DEBUG)  # 开启调试模式
+    root = logging.getLogger()
+    root.setLevel(getattr(logging, str(level).upper(), logging.INFO))
 
     # 控制台日志格式
     console_formatter = logging.Formatter('[%(asctime)s] %(message)s', datefmt='%H:%M:%S')
@@ -60,7 +172,7 @@ def setup_logging():
 
     # 文件日志处理器（带轮转）
     file_handler = TimedRotatingFileHandler(
-        filename='knocking_cmd.log',
+        filename=log_file,
         when='midnight',  # 每天午夜轮转
         interval=1,  # 轮转间隔为1天
         backupCount=30,  # 保留30天的日志
@@ -84,12 +196,41 @@ def setup_logging():
     file_formatter = logging.Formatter('[%(asctime)s] %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
     file_handler.setFormatter(file_formatter)
 
-    logger.addHandler(console_handler)
-    logger.addHandler(file_handler)
-    return logger
+    # 热路径只入队，I/O 在监听线程中完成
+    log_queue = queue.SimpleQueue()
+    queue_handler = LazyQueueHandler(log_queue)
+    rate_filter = EventRateLimitFilter(rate=rate, interval=interval)
+    queue_handler.addFilter(rate_filter)
+    root.addHandler(queue_handler)
+
+    listener = QueueListener(log_queue, console_handler, file_handler, respect_handler_level=True)
+    listener.start()
+    flusher = LogFlusher(rate_filter)
+    flusher.start()
+    return LoggingRuntime(listener, flusher)
 
 
-logger = setup_logging()
+def setup_shard_logging(log_queue, level='INFO', rate=20, interval=60):
+    """分片工作进程的日志设置
+
+    日志记录经多进程队列交给主进程统一写入控制台和文件，避免多个进程轮转同一日志文件；
+    按事件类型限流在工作进程内完成。
+
+    Returns:
+        LoggingRuntime: 日志运行时，进程退出前需调用 stop()
+    """
+    root = logging.getLogger()
+    root.setLevel(getattr(logging, str(level).upper(), logging.INFO))
+    queue_handler = QueueHandler(log_queue)
+    rate_filter = EventRateLimitFilter(rate=rate, interval=interval)
+    queue_handler.addFilter(rate_filter)
+    root.addHandler(queue_handler)
+    flusher = LogFlusher(rate_filter)
+    flusher.start()
+    return LoggingRuntime(None, flusher)
+
+
+logger = logging.getLogger('knocking_cmd')
 
 
 def parse_knock_sequence(seq_str):
@@ -121,7 +262,7 @@ def parse_knock_sequence(seq_str):
         raise argparse.ArgumentTypeError("无效的敲门序列格式，示例：1201:TCP,2301:UDP,3401:TCP")
 
 
-def parse_arguments():
+def parse_arguments(argv=None):
     """解析命令行参数
     
     配置和解析命令行参数，包括：
@@ -131,6 +272,14 @@ def parse_arguments():
     - 时间窗口
     - 规则超时时间
     - 防火墙区域
+    - 防火墙后端
+    - 最终包认证方案
+    - 限流与封禁参数
+    - 日志参数
+    - 规则ID与控制套接字
+    
+    Args:
+        argv: 参数列表，为None时读取 sys.argv（基准测试等场景直接传入）
     
     Returns:
         argparse.Namespace: 解析后的参数对象
@@ -158,7 +307,165 @@ def parse_arguments():
     parser.add_argument('-z', '--zone',
                         default='public',
                         help='防火墙区域')
-    return parser.parse_args()
+    parser.add_argument('-fw', '--firewall',
+                        choices=sorted(BACKENDS),
+                        default='firewalld',
+                        help='防火墙后端')
+    parser.add_argument('--nft-table',
+                        default='authbase',
+                        help='nftables后端使用的表名')
+    parser.add_argument('--auth-scheme',
+                        choices=sorted(VERIFIERS),
+                        default='md5',
+                        help='最终包认证方案')
+    parser.add_argument('--totp-step',
+                        type=int,
+                        default=30,
+                        help='totp认证方案的时间片长度（秒）')
+    parser.add_argument('--rate-limit',
+                        type=float,
+                        default=20,
+                        help='单个源地址每秒允许的敲门包数，0表示不限流')
+    parser.add_argument('--subnet-rate-limit',
+                        type=float,
+                        default=200,
+                        help='单个/24源网段每秒允许的敲门包数，0表示不限流')
+    parser.add_argument('--ban-threshold',
+                        type=int,
+                        default=10,
+                        help='每分钟允许的失败次数，超过后封禁源地址，0表示不封禁')
+    parser.add_argument('--ban-time',
+                        type=int,
+                        default=300,
+                        help='封禁时长（秒）')
+    parser.add_argument('--log-level',
+                        default='INFO',
+                        choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'],
+                        help='日志级别')
+    parser.add_argument('--log-file',
+                        default='knocking_cmd.log',
+                        help='日志文件路径')
+    parser.add_argument('--log-rate',
+                        type=int,
+                        default=20,
+                        help='每个统计周期内每种日志事件最多记录的条数，0表示不限流')
+    parser.add_argument('--log-interval',
+                        type=int,
+                        default=60,
+                        help='日志限流统计周期（秒）')
+    parser.add_argument('--rule-id',
+                        default='',
+                        help='对应的敲门规则ID，用于统计信息标识')
+    parser.add_argument('--control-socket',
+                        default=None,
+                        help='控制与指标接口的Unix套接字路径，不指定则不启用')
+    parser.add_argument('--paused',
+                        action='store_true',
+                        help='以停用状态启动，收到 /resume 后开始处理敲门')
+    parser.add_argument('--workers',
+                        type=int,
+                        default=1,
+                        help='分片工作进程数，大于1时主进程只抓包并按源地址网段分发给工作进程')
+    parser.add_argument('--state-dir',
+                        default=None,
+                        help='授权日志目录，指定后已开放的授权在监听进程重启后继续有效并按期撤销')
+    parser.add_argument('--rules-file',
+                        default=None,
+                        help='同一进程额外服务的规则列表（JSON），与命令行规则共用抓包和状态表')
+    parser.add_argument('--adopt-journal',
+                        action='append',
+                        default=[],
+                        help='启动时一并接管的其他名称的授权日志，可重复指定（规则组改名后由管理进程传入）')
+    return parser.parse_args(argv)
+
+
+def load_rules_file(path, args):
+    """读取额外规则列表
+
+    文件内容为JSON数组，每项可包含 rule_id、port_list（字符串格式同 -pl）、target_port、
+    window、timeout、password、auth_scheme、totp_step、paused（是否以停用状态启动），
+    未提供的项沿用命令行参数。
+
+    Args:
+        path: 规则文件路径
+        args: 命令行参数
+
+    Returns:
+        list: 每条规则的参数对象（argparse.Namespace）
+
+    Raises:
+        ValueError: 文件内容无效
+    """
+    with open(path, encoding='utf-8') as f:
+        items = json.load(f)
+    if not isinstance(items, list):
+        raise ValueError('规则文件内容必须为JSON数组')
+    rules = []
+    seen = {args.rule_id}
+    for item in items:
+        rule = argparse.Namespace(**vars(args))
+        try:
+            rule.rule_id = str(item.get('rule_id', ''))
+            rule.paused = bool(item.get('paused', False))
+            rule.port_list = parse_knock_sequence(str(item['port_list']))
+            for key in ('target_port', 'window', 'timeout', 'totp_step'):
+                if key in item:
+                    setattr(rule, key, int(item[key]))
+            for key in ('password', 'auth_scheme'):
+                if key in item:
+                    setattr(rule, key, str(item[key]))
+        except (AttributeError, KeyError, TypeError, argparse.ArgumentTypeError) as e:
+            raise ValueError(f'规则文件 {path} 中的规则无效: {item!r}') from e
+        if rule.rule_id in seen:
+            raise ValueError(f'规则文件 {path} 中的规则ID重复: {rule.rule_id!r}')
+        seen.add(rule.rule_id)
+        rules.append(rule)
+    return rules
+
+
+# 规则停用时使用的BPF过滤器，不会匹配任何数据包
+PAUSED_FILTER = 'tcp and udp'
+
+
+def knock_filter(port_list):
+    """生成只捕获敲门端口TCP/UDP包的BPF过滤器，port_list 为 (端口, 协议) 的任意可迭代对象
+
+    libpcap中的 tcp/udp 分别等价于 ip proto tcp or ip6 proto tcp（udp同理），dst port 也同时
+    适用于两个地址族，因此同一个过滤器覆盖IPv4和IPv6的敲门包。
+    """
+    ports = sorted({str(p[0]) for p in port_list})
+    return f"(tcp or udp) and (dst port {' or '.join(ports)})"
+
+
+class RuleConfig:
+    """规则运行参数快照
+
+    规则参数编译进 KnockStateMachine.trie，热更新时整体重建前缀树，
+    数据包处理路径只读取一次 trie，不会出现新旧参数混用的情况。
+
+    Attributes:
+        args: 规则的参数对象，热更新时在其副本上修改
+        rule_id: 规则ID
+        port_list: 敲门序列 [(端口, 协议)]
+        target_port: 目标开放端口
+        window: 时间窗口（秒）
+        timeout: 规则有效期（秒）
+        verifier: 最终包认证器
+        bpf_filter: BPF过滤器表达式
+    """
+
+    def __init__(self, args):
+        self.args = args
+        self.rule_id = args.rule_id
+        self.port_list = args.port_list
+        self.target_port = args.target_port
+        self.window = args.window
+        self.timeout = args.timeout
+
+        self.bpf_filter = knock_filter(args.port_list)
+
+        # 预先构造认证器，数据包处理路径只做比较
+        self.verifier = create_verifier(args.auth_scheme, args.password, totp_step=args.totp_step)
 
 
 class KnockStateMachine:
@@ -171,29 +478,228 @@ class KnockStateMachine:
     
     Attributes:
         args: 命令行参数对象
-        clients: 记录客户端状态的字典
+        clients: 记录客户端状态的字典，以源地址的二进制形式（IPv4 4字节、IPv6 16字节）为键
         lock: 线程同步锁
-        firewall_rules: 当前活动的防火墙规则集合
-        bpf_filter: BPF过滤器表达式
-        expected_password: 预期的认证密码
+        guard: 限流与封禁控制，在状态机之前过滤数据包
+        firewall: 防火墙后端实例
+        firewall_worker: 异步应用防火墙变更的工作线程
+        firewall_rules: 当前活动的防火墙规则 {(ip, 端口): 到期时间戳}
+        grant_times: 授权时间 {(ip, 端口): 时间戳}，从授权日志恢复的授权没有记录
+        grant_rules: 授权所属的规则 {(ip, 端口): 规则ID}，从授权日志恢复的授权按目标端口归属
+        config: 命令行规则的参数（RuleConfig），热更新时整体替换
+        rules: 本进程服务的全部规则 {规则ID: RuleConfig}，包括命令行规则和 --rules-file 中的规则
+        paused_rules: 已停用的规则ID集合
+        trie: 启用中规则的敲门序列编译成的前缀树（KnockTrie），热更新时整体替换
+        metrics: 运行指标注册表
+        on_filter_changed: 抓包套接字应使用的BPF过滤器变化时的回调 on_filter_changed(新过滤器)
+        paused: 全部规则是否都已停用
+        journal: 授权日志（GrantJournal），未指定 --state-dir 时为None
+        events: 审计事件写入器（EventWriter），未配置 AUTHBASE_EVENT_DB_URI 时为None
     """
-    def __init__(self, args):
+    def __init__(self, args, firewall=None):
         """初始化状态机
         
         Args:
             args: 包含配置参数的对象
+            firewall: 防火墙后端，为None时按 args.firewall 创建
         """
         self.args = args
         self.clients = {}
         self.lock = Lock()
-        self.firewall_rules = set()
+        self.firewall_rules = {}
+        self.grant_times = {}
+        self.grant_rules = {}
+        self.started = time.time()
+        self._setup_metrics()
+        self.guard = KnockGuard(
+            rate=args.rate_limit,
+            burst=args.rate_limit * 2,
+            subnet_rate=args.subnet_rate_limit,
+            subnet_burst=args.subnet_rate_limit * 2,
+            ban_threshold=args.ban_threshold,
+            ban_time=args.ban_time
+        )
+
+        rules_file = getattr(args, 'rules_file', None)
+        rule_args = [args] + (load_rules_file(rules_file, args) if rules_file else [])
+        self.rules = {item.rule_id: RuleConfig(item) for item in rule_args}
+        self.paused_rules = {item.rule_id for item in rule_args if getattr(item, 'paused', False)}
+        self.on_filter_changed = None
+        self._install(self.rules, self.paused_rules, *self._compile(self.rules, self.paused_rules))
 
-        # 生成BPF过滤器，只捕获目标端口的TCP/UDP包
-        ports = {str(p[0]) for p in args.port_list}
-        self.bpf_filter = f"(tcp or udp) and (dst port {' or '.join(ports)})"
+        if firewall is None:
+            firewall = create_backend(args.firewall, zone=args.zone, table=args.nft_table,
+                                      timeout=args.timeout)
+            firewall.setup(sorted({rule.target_port for rule in self.rules.values()}))
+        self.firewall = firewall
+        self.setup_ports = {rule.target_port for rule in self.rules.values()}
+        self.journal = None
+        self.events = None
+        state_dir = getattr(args, 'state_dir', None)
+        name = args.rule_id or f'port-{args.target_port}'
+        if getattr(args, 'shard', None) is not None:
+            name = f'{name}.{args.shard}'
+        event_db = os.environ.get('AUTHBASE_EVENT_DB_URI')
+        if event_db:
+            spill_path = os.path.join(state_dir, f'{name}.events') if state_dir else None
+            self.events = EventWriter(event_db, rule_id=args.rule_id, spill_path=spill_path).start()
+        if state_dir:
+            self.journal = GrantJournal(os.path.join(state_dir, f'{name}.grants'),
+                                        prune_expired=firewall.kernel_timeout)
+        self.firewall_worker = FirewallWorker(
+            firewall,
+            on_failed=self._grant_failed,
+            on_revoked=self._grant_revoked,
+            on_granted=self._grant_applied,
+            journal=self.journal
+        )
+        if self.journal is not None:
+            self._restore_grants()
+        self.firewall_worker.start()
 
-        # 预加载密码
-        self.expected_password = args.password.encode('utf-8')
+    def _restore_grants(self):
+        """按授权日志恢复上一个监听进程留下的授权
+
+        - 未到期且目标端口未变的授权继续有效，按原到期时间安排撤销
+        - 已到期或目标端口已变更的授权立即撤销
+        - 防火墙中仍存在、日志中出现过但已不在有效期内的规则视为遗留规则一并撤销；
+          日志中从未出现过的规则不是本规则添加的，不做处理
+        """
+        entries, known = self.journal.load()
+        now = time.time()
+        # 授权日志不记录规则ID，恢复的授权归属到目标端口相同的第一条规则
+        owners = {}
+        for rule in self.rules.values():
+            owners.setdefault(rule.target_port, rule.rule_id)
+        kernel_timeout = self.firewall.kernel_timeout
+        stale = set()
+        for (ip, p), expires in entries.items():
+            if p in owners and expires > now:
+                self.firewall_rules[(ip, p)] = expires
+                self.grant_rules[(ip, p)] = owners[p]
+                if not kernel_timeout:
+                    self.firewall_worker.schedule_revoke(ip, p, expires - now)
+            elif kernel_timeout and p in owners:
+                # 内核已自行删除过期条目，只需从日志中去掉
+                self.journal.entries.pop((ip, p), None)
+            else:
+                stale.add((ip, p))
+
+        for p in {p for _, p in known}:
+            try:
+                present = self.firewall.list_grants(p)
+            except Exception as e:
+                logger.error(f"读取端口 {p} 的防火墙规则失败: {str(e)}")
+                continue
+            for ip in present or ():
+                if (ip, p) in known and (ip, p) not in self.firewall_rules:
+                    stale.add((ip, p))
+
+        for ip, p in stale:
+            self.firewall_worker.submit_revoke(ip, p)
+        try:
+            self.journal.compact()
+        except OSError as e:
+            logger.error(f"压缩授权日志失败: {str(e)}")
+        logger.info(f"已恢复 {len(self.firewall_rules)} 条授权，待撤销遗留授权 {len(stale)} 条")
+
+    @staticmethod
+    def _compile(rules, paused_rules):
+        """按启用中的规则构造前缀树和BPF过滤器
+
+        全部规则都已停用时按全部规则构造，数据包由 paused 标志直接丢弃。
+
+        Returns:
+            tuple: (KnockTrie, BPF过滤器)
+        """
+        active = [rule for rule in rules.values() if rule.rule_id not in paused_rules]
+        trie = KnockTrie(active or list(rules.values()))
+        return trie, knock_filter(trie.steps)
+
+    def _install(self, rules, paused_rules, trie, bpf_filter):
+        """整体替换规则集合和前缀树。调用方需持有 self.lock（初始化时除外）
+
+        只保留已完成步骤在新前缀树中仍然存在的客户端，全部规则停用时清空客户端。
+
+        Returns:
+            int: 被重置的客户端数
+        """
+        self.rules, self.paused_rules = rules, paused_rules
+        self.config = rules[self.args.rule_id]
+        self.trie, self._bpf_filter = trie, bpf_filter
+        self.paused = len(paused_rules) == len(rules)
+        if self.paused:
+            dropped = list(self.clients)
+        else:
+            dropped = []
+            for key, client in self.clients.items():
+                node = trie.find(client['node'].path)
+                if node is None:
+                    dropped.append(key)
+                else:
+                    client['node'] = node
+        for key in dropped:
+            del self.clients[key]
+        return len(dropped)
+
+    def _rule_ids(self, rule_id):
+        """控制请求中的规则ID（单个或列表），未指定时表示本进程的全部规则。调用方需持有 self.lock
+
+        Raises:
+            ValueError: 规则不在本进程中
+        """
+        if rule_id is None:
+            return set(self.rules)
+        ids = {str(item) for item in rule_id} if isinstance(rule_id, (list, tuple, set)) else {str(rule_id)}
+        missing = ids - set(self.rules)
+        if missing:
+            raise ValueError(f"规则 {', '.join(sorted(missing))} 不在本监听进程中")
+        return ids
+
+    def _notify_filter(self, old_filter):
+        """抓包套接字应使用的过滤器变化时通知 on_filter_changed"""
+        active = self.active_filter
+        if active != old_filter and self.on_filter_changed is not None:
+            self.on_filter_changed(active)
+
+    @property
+    def bpf_filter(self):
+        return self._bpf_filter
+
+    @property
+    def verifier(self):
+        return self.config.verifier
+
+    @property
+    def active_filter(self):
+        """抓包套接字当前应使用的BPF过滤器"""
+        return PAUSED_FILTER if self.paused else self._bpf_filter
+
+    def _setup_metrics(self):
+        """注册运行指标
+
+        数据包路径上的计数器在持有 self.lock 时更新；其余指标在读取时从各组件的统计量计算。
+        """
+        self.metrics = m = MetricsRegistry()
+        self.packets_seen = m.counter('packets_total', '收到的敲门端口数据包数', ('port', 'proto'))
+        self.completions = m.counter('sequence_completions_total', '完成敲门序列并通过认证的次数')
+        self.password_failures = m.counter('password_failures_total', '最终包认证失败次数')
+        self.timeouts = m.counter('timeouts_total', '超出时间窗口的敲门次数')
+        self.invalid_steps = m.counter('invalid_steps_total', '端口或协议不符的敲门次数')
+        m.gauge_fn('clients', '进行中的客户端敲门状态数', lambda: len(self.clients))
+        m.gauge_fn('active_grants', '当前有效的端口授权数', self._active_grants)
+        m.counter_fn('guard_dropped_total', '被准入控制丢弃的数据包数',
+                     lambda: {('rate_limited',): self.guard.rate_limited, ('banned',): self.guard.ban_dropped},
+                     ('reason',))
+        m.counter_fn('bans_total', '累计封禁源地址次数', lambda: self.guard.bans)
+        m.gauge_fn('firewall_queue_depth', '等待应用的防火墙变更数', lambda: self.firewall_worker.pending())
+        m.counter_fn('firewall_changes_total', '已处理的防火墙变更数',
+                     lambda: {('applied',): self.firewall_worker.applied, ('failed',): self.firewall_worker.failed},
+                     ('result',))
+        m.counter_fn('events_total', '已处理的审计事件数',
+                     lambda: {(k,): v for k, v in self.events.stats().items() if k != 'pending'} if self.events else {},
+                     ('result',))
+        self.grant_latency = m.histogram('firewall_grant_latency_seconds', '认证成功到防火墙规则生效的延迟')
 
     def process_packet(self, pkt):
         """数据包处理核心逻辑
@@ -201,204 +707,652 @@ class KnockStateMachine:
         处理流程：
         1. 解析IP协议层基本信息
         2. 分离TCP/UDP协议头和载荷数据
-        3. 验证端口序列顺序和时间窗口
-        4. 在最终步骤进行密码验证
+        3. 在前缀树中查找 (端口, 协议)，一次推进该客户端的全部候选规则并验证时间窗口
+        4. 到达某条规则序列的结尾时进行最终包认证
         5. 通过验证后添加临时防火墙规则
         
+        客户端状态只记录当前所在的前缀树节点。每一步的间隔按经过该节点的规则中最长的时间窗口判断，
+        到达结尾时再按完成的规则自身的时间窗口判断。结尾节点上的规则都认证失败、且还有更长的规则
+        经过该节点时，客户端继续沿前缀树前进。
+        
         Args:
             pkt: scapy捕获的数据包对象
         """
-        if not IP in pkt:
+        if self.paused:
             return
 
-        src_ip = pkt[IP].src  # 获取源IP地址
+        # IPv4和IPv6走同一条路径：状态表和准入控制以二进制地址为键，文本形式只用于日志和防火墙
+        if IP in pkt:
+            src_ip = pkt[IP].src  # 获取源IP地址
+            key = socket.inet_aton(src_ip)
+        elif IPv6 in pkt:
+            src_ip = pkt[IPv6].src
+            key = socket.inet_pton(socket.AF_INET6, src_ip)
+        else:
+            return
         current_time = time.time()
-        proto, port, payload = None, None, b''
+        trie = self.trie
 
-        # 协议解析逻辑（同时处理TCP和UDP协议）
+        # 协议解析逻辑（同时处理TCP和UDP协议），载荷只在最终步骤按需提取
         if TCP in pkt:
             proto = 'TCP'
-            port = pkt[TCP].dport
-            payload = bytes(pkt[TCP].payload)  # 获取TCP层全部负载
-            
+            layer = pkt[TCP]
         elif UDP in pkt:
             proto = 'UDP'
-            port = pkt[UDP].dport
-            payload = bytes(pkt[UDP].payload)  # 获取UDP层全部负载
-
+            layer = pkt[UDP]
         else:
             return
-
-        # 规范化处理二进制负载
-        payload = payload.replace(b'\x00', b'').strip()  # 清理空字节和空白字符
+        port = layer.dport
 
         with self.lock:  # 线程安全的状态更新
-            # 调试日志：显示收到包的信息
-            logger.debug(f"收到 {proto}/{port} 来自 {src_ip} 载荷长度：{len(payload)}")
-
-            client = self.clients.get(src_ip)
-            if not client:
-                # 检查是否是第一个敲门包
-                if len(self.args.port_list) > 0 and \
-                        port == self.args.port_list[0][0] and \
-                        proto == self.args.port_list[0][1]:
-                    # 初始化新的客户端状态
-                    self.clients[src_ip] = {
-                        'step': 1,  # 当前步骤
-                        'start_time': current_time  # 开始时间
-                    }
-                    logger.info(f"初始化客户端 {src_ip}")
+            self.packets_seen.inc(port, proto)
+
+            # 限流和封禁检查，被拒绝的包不进入状态机也不记录日志
+            if not self.guard.allow(key, current_time):
                 return
+
+            # 调试日志：显示收到包的信息
+            logger.debug("收到 %s/%s 来自 %s", proto, port, src_ip)
+
+            client = self.clients.get(key)
+            if client is None:
+                node = trie.root
+                elapsed = 0
             else:
+                node = client['node']
+                elapsed = current_time - client['start_time']
                 # 检查时间窗口
-                if current_time - client['start_time'] > self.args.window:
-                    logger.warning(f"客户端 {src_ip} 超时")
-                    del self.clients[src_ip]
+                if elapsed > node.window:
+                    logger.warning("客户端 %s 超时", src_ip)
+                    self.timeouts.inc()
+                    self._reject(key, src_ip, current_time, 'timeout', node.rule)
                     return
 
-                # 获取当前步骤期望值
-                current_step = client['step']
-                try:
-                    expected_port, expected_proto = self.args.port_list[current_step]
-                except IndexError:
-                    logger.error(f"客户端 {src_ip} 步骤越界")
-                    del self.clients[src_ip]
+            # 协议/端口验证：一次查找同时推进所有经过该节点的规则
+            child = node.children.get((port, proto))
+            if child is None:
+                if client is not None:
+                    expected = '|'.join(f'{step[1]}/{step[0]}' for step in node.children)
+                    logger.warning("无效步骤 %s 期望 %s", src_ip, expected)
+                    self.invalid_steps.inc()
+                    self._reject(key, src_ip, current_time, 'invalid_step', node.rule,
+                                 f'收到 {proto}/{port} 期望 {expected}')
+                return
+
+            # 有规则在此结束：最终步骤密码验证
+            if child.rules:
+                payload = bytes(layer.payload)  # 获取传输层全部负载（含填充）
+                logger.debug("最终步骤验证 %s 载荷长度：%s", src_ip, len(payload))
+                for config in child.rules:
+                    if elapsed <= config.window and config.verifier.verify(payload):
+                        logger.info("密码验证成功 %s", src_ip)
+                        # 完成序列
+                        self.completions.inc()
+                        self._activate_firewall(src_ip, config)
+                        self._event('success', src_ip, config)
+                        self.clients.pop(key, None)
+                        return
+                if not child.children:
+                    logger.warning("密码验证失败 %s", src_ip)
+                    self.password_failures.inc()
+                    self._reject(key, src_ip, current_time, 'auth_failed', child.rule)
                     return
 
-                # 协议/端口验证
-                if port == expected_port and proto == expected_proto:
-                    # 最终步骤密码验证
-                    if current_step == len(self.args.port_list) - 1:
-                        logger.debug(f"最终步骤验证 {src_ip} 载荷内容：{payload[:16]}...")
-                        if payload != self.expected_password:
-                            logger.warning(f"密码验证失败 {src_ip}")
-                            del self.clients[src_ip]
-                            return
-                        logger.info(f"密码验证成功 {src_ip}")
-
-                    # 更新步骤
-                    client['step'] += 1
-                    client['start_time'] = current_time
-
-                    # 完成序列
-                    if client['step'] == len(self.args.port_list):
-                        self._activate_firewall(src_ip)
-                        del self.clients[src_ip]
-                else:
-                    logger.warning(f"无效步骤 {src_ip} 期望 {expected_proto}/{expected_port}")
-                    del self.clients[src_ip]
+            # 更新步骤
+            if client is None:
+                # 初始化新的客户端状态
+                self.clients[key] = {
+                    'node': child,  # 当前所在的前缀树节点
+                    'start_time': current_time  # 上一步的时间
+                }
+                logger.info("初始化客户端 %s", src_ip)
+            else:
+                client['node'] = child
+                client['start_time'] = current_time
+
+    def _reject(self, key, ip, now, event_type, config, detail=None):
+        """敲门失败：清除客户端状态，记录审计事件并计入失败次数。调用方需持有 self.lock
 
-    def _activate_firewall(self, ip):
+        Args:
+            key: 源地址的二进制形式
+            ip: 源地址的文本形式
+        """
+        self.clients.pop(key, None)
+        self._event(event_type, ip, config, detail)
+        if self.guard.record_failure(key, now):
+            self._event('banned', ip, config, f'封禁 {self.guard.ban_time} 秒')
+
+    def _event(self, event_type, ip, config, detail=None):
+        if self.events is not None:
+            self.events.record(event_type, ip, config.target_port, detail, rule_id=config.rule_id)
+
+    def _activate_firewall(self, ip, config):
         """添加临时防火墙规则
         
-        使用firewall-cmd创建富规则，允许特定IP访问目标端口
+        只更新内存中的授权记录，实际的防火墙变更交给工作线程异步执行，
+        数据包处理路径不会等待防火墙命令。调用方需持有 self.lock。
         
         Args:
             ip: 要授权的客户端IP地址
+            config: 处理该数据包时使用的规则参数
         """
-        if (ip, self.args.target_port) in self.firewall_rules:
+        key = (ip, config.target_port)
+        now = time.time()
+        if self.firewall_rules.get(key, 0) > now:
             return
 
+        if self.firewall.kernel_timeout:
+            # 内核负责过期，没有撤销回调清理记录，这里顺带清理已过期的条目
+            for expired in [k for k, t in self.firewall_rules.items() if t <= now]:
+                del self.firewall_rules[expired]
+                self.grant_times.pop(expired, None)
+                self.grant_rules.pop(expired, None)
+
+        self.firewall_rules[key] = now + config.timeout
+        self.grant_times[key] = now
+        self.grant_rules[key] = config.rule_id
+        self.firewall_worker.submit_grant(ip, config.target_port, config.timeout)
+
+    def _grant_failed(self, ip, port):
+        """授权应用失败时清除内存记录，允许客户端重新敲门"""
+        with self.lock:
+            self.firewall_rules.pop((ip, port), None)
+            self.grant_times.pop((ip, port), None)
+            self.grant_rules.pop((ip, port), None)
+
+    def _grant_revoked(self, ip, port):
+        """撤销完成后清除内存记录"""
+        with self.lock:
+            if self.firewall_rules.get((ip, port), 0) <= time.time():
+                self.firewall_rules.pop((ip, port), None)
+                self.grant_times.pop((ip, port), None)
+                self.grant_rules.pop((ip, port), None)
+
+    def reload(self, changes):
+        """热更新一条规则的参数
+
+        整体替换该规则的 RuleConfig 并重建前缀树：已开放的授权保持到原定到期时间，
+        敲门进度在新前缀树中仍然存在的客户端保留状态，其余客户端需重新敲门。
+        敲门端口变化时通过 on_filter_changed 在原抓包套接字上替换BPF过滤器。
+        本进程中没有该规则时按请求参数添加规则，其余项沿用命令行参数。
+
+        Args:
+            changes: 要修改的参数，可包含 rule_id（默认为命令行规则）、port_list（字符串格式同 -pl）、
+                target_port、window、timeout、password、auth_scheme、totp_step，未提供的保持不变
+
+        Returns:
+            dict: 更新结果摘要
+
+        Raises:
+            ValueError: 参数无效
+        """
+        if isinstance(changes.get('rule_id'), (list, tuple)):
+            raise ValueError('修改规则参数时只能指定一条规则')
+        rule_id = self.args.rule_id if changes.get('rule_id') is None else str(changes['rule_id'])
+        old = self.rules.get(rule_id)
+        if old is None and not {'port_list', 'password'} <= set(changes):
+            raise ValueError(f'规则 {rule_id} 不在本监听进程中，添加规则需提供 port_list 和 password')
+        args = argparse.Namespace(**vars(self.args if old is None else old.args))
+        args.rule_id = rule_id
         try:
-            # 转义IP和端口，防止命令注入
-            ip_escaped = quote(ip)
-            port_escaped = quote(str(self.args.target_port))
-
-            # 使用firewall-cmd添加富规则
-            add_cmd = [
-                'firewall-cmd',
-                f'--zone={self.args.zone}',
-                '--add-rich-rule',
-                f'rule family="ipv4" source address="{ip_escaped}" '
-                f'port port="{port_escaped}" protocol="tcp" accept'
-            ]
-
-            subprocess.run(add_cmd, check=True)
-            self.firewall_rules.add((ip, self.args.target_port))
-            logger.info(f"开放端口 {self.args.target_port} 给 {ip}")
-
-            # 启动定时删除线程
-            Thread(target=self._remove_firewall, args=(ip,)).start()
-        except subprocess.CalledProcessError as e:
-            logger.error(f"防火墙添加失败: {str(e)}")
-
-    def _remove_firewall(self, ip):
-        """移除临时防火墙规则
-        
-        在超时后自动删除之前添加的防火墙规则
-        
+            if 'port_list' in changes:
+                args.port_list = parse_knock_sequence(str(changes['port_list']))
+            for key in ('target_port', 'window', 'timeout', 'totp_step'):
+                if key in changes:
+                    setattr(args, key, int(changes[key]))
+            for key in ('password', 'auth_scheme'):
+                if key in changes:
+                    setattr(args, key, str(changes[key]))
+            config = RuleConfig(args)
+        except (TypeError, argparse.ArgumentTypeError) as e:
+            raise ValueError(str(e)) from e
+
+        if config.target_port not in self.setup_ports:
+            self.firewall.setup([config.target_port])
+            self.setup_ports.add(config.target_port)
+
+        with self.lock:
+            old_filter = self.active_filter
+            rules = dict(self.rules)
+            rules[rule_id] = config
+            if rule_id == self.args.rule_id:
+                self.args = args
+            dropped = self._install(rules, self.paused_rules, *self._compile(rules, self.paused_rules))
+
+        self._notify_filter(old_filter)
+        if old is not None:
+            old.verifier.close()
+        logger.info("规则 %s 参数已热更新：敲门序列 %s 目标端口 %s，重置 %s 个进行中的客户端",
+                    rule_id, args.port_list, args.target_port, dropped)
+        return {'reset_clients': dropped, 'bpf_filter': self._bpf_filter, 'paused': self.paused}
+
+    def pause(self, rule_id=None):
+        """停用规则：不再处理其敲门包，撤销其已开放的授权
+
+        规则从前缀树中移除，只经过该规则的客户端进度被清空；全部规则停用后抓包套接字
+        切换为不匹配任何包的过滤器。撤销的授权按开放它的规则记录 revoked 审计事件。
+
+        Args:
+            rule_id: 要停用的规则ID或ID列表，为None时停用本进程的全部规则
+
+        Returns:
+            dict: 撤销的授权数
+
+        Raises:
+            ValueError: 规则不在本进程中
+        """
+        with self.lock:
+            ids = self._rule_ids(rule_id)
+            old_filter = self.active_filter
+            paused_rules = self.paused_rules | ids
+            self._install(self.rules, paused_rules, *self._compile(self.rules, paused_rules))
+            if rule_id is None:
+                keys = list(self.firewall_rules)
+            else:
+                keys = [key for key in self.firewall_rules if self.grant_rules.get(key) in ids]
+            grants = []
+            for key in keys:
+                del self.firewall_rules[key]
+                self.grant_times.pop(key, None)
+                grants.append((key, self.grant_rules.pop(key, None)))
+        self._notify_filter(old_filter)
+        for (ip, port), owner in grants:
+            self.firewall_worker.submit_revoke(ip, port)
+            if self.events is not None:
+                self.events.record('revoked', ip, port, '规则停用', rule_id=owner)
+        logger.info("规则 %s 已停用，撤销 %s 个授权", ', '.join(sorted(ids)), len(grants))
+        return {'revoked': len(grants), 'paused': self.paused, 'bpf_filter': self._bpf_filter}
+
+    def resume(self, changes=None):
+        """启用规则，可同时热更新规则参数
+
+        Args:
+            changes: 同 reload()，未指定 rule_id 时启用全部规则；只有 rule_id 时沿用当前参数，
+                此时 rule_id 也可以是ID列表，一次启用多条规则
+
+        Raises:
+            ValueError: 参数无效或规则不在本进程中
+        """
+        changes = changes or {}
+        if set(changes) - {'rule_id'}:
+            self.reload(changes)
+        with self.lock:
+            ids = self._rule_ids(changes.get('rule_id'))
+            old_filter = self.active_filter
+            paused_rules = self.paused_rules - ids
+            self._install(self.rules, paused_rules, *self._compile(self.rules, paused_rules))
+        self._notify_filter(old_filter)
+        logger.info("规则 %s 已启用", ', '.join(sorted(ids)))
+        return {'bpf_filter': self._bpf_filter, 'paused': self.paused}
+
+    def remove_rule(self, rule_id):
+        """从本进程中移除规则，命令行规则不能移除
+
+        已开放的授权保留到原定到期时间，需要立即撤销时先调用 pause(rule_id)。
+
+        Raises:
+            ValueError: 规则为命令行规则或不在本进程中
+        """
+        with self.lock:
+            ids = self._rule_ids(rule_id)
+            if self.args.rule_id in ids:
+                raise ValueError('不能移除命令行指定的规则')
+            old_filter = self.active_filter
+            removed = self.rules[str(rule_id)]
+            rules = {key: rule for key, rule in self.rules.items() if key not in ids}
+            paused_rules = self.paused_rules - ids
+            self._install(rules, paused_rules, *self._compile(rules, paused_rules))
+        self._notify_filter(old_filter)
+        removed.verifier.close()
+        logger.info("规则 %s 已从监听进程中移除", rule_id)
+        return {'rules': len(rules), 'bpf_filter': self._bpf_filter, 'paused': self.paused}
+
+    def list_grants(self, ip=None, offset=0, limit=None, rule_id=None):
+        """列出未到期的授权，按到期时间升序
+
+        直接读取内存中的授权记录，不访问防火墙。
+
+        Args:
+            ip: 只返回源地址以此开头的授权
+            offset: 跳过的条数
+            limit: 最多返回的条数，None表示不限
+            rule_id: 只返回该规则开放的授权，None表示全部规则
+
+        Returns:
+            dict: {'total': 符合条件的总数, 'grants': [{ip, port, granted_at, expires_at}, ...]}
+        """
+        now = time.time()
+        with self.lock:
+            items = [(key, expires, self.grant_times.get(key))
+                     for key, expires in self.firewall_rules.items()
+                     if expires > now and (not ip or key[0].startswith(ip))
+                     and (rule_id is None or self.grant_rules.get(key) == rule_id)]
+        items.sort(key=lambda item: item[1])
+        end = None if limit is None else offset + limit
+        return {
+            'total': len(items),
+            'grants': [{'ip': key[0], 'port': key[1], 'granted_at': granted, 'expires_at': expires}
+                       for key, expires, granted in items[offset:end]],
+        }
+
+    def revoke_grants(self, ips, rule_id=None):
+        """立即撤销指定源地址的授权
+
         Args:
-            ip: 要移除规则的客户端IP地址
+            ips: 源地址列表
+            rule_id: 只撤销该规则开放的授权，None表示全部规则
+
+        Returns:
+            dict: 撤销的授权数
         """
-        time.sleep(self.args.timeout)
+        ips = set(ips)
+        with self.lock:
+            keys = [key for key in self.firewall_rules
+                    if key[0] in ips and (rule_id is None or self.grant_rules.get(key) == rule_id)]
+            # 一个进程服务多条规则，审计事件记在开放该授权的规则名下
+            owners = {}
+            for key in keys:
+                del self.firewall_rules[key]
+                self.grant_times.pop(key, None)
+                owners[key] = self.grant_rules.pop(key, None)
+        for ip, port in keys:
+            self.firewall_worker.submit_revoke(ip, port)
+            if self.events is not None:
+                self.events.record('revoked', ip, port, '手动撤销', rule_id=owners[(ip, port)])
+        logger.info("手动撤销授权 %s", ', '.join(f'{ip}:{port}' for ip, port in keys) or '（无）')
+        return {'revoked': len(keys)}
+
+    def _grants_route(self, query, body):
+        try:
+            offset = int(query.get('offset', ['0'])[0])
+            limit = int(query['limit'][0]) if 'limit' in query else None
+        except ValueError:
+            return 400, {'msg': 'offset和limit必须为整数'}
+        if offset < 0 or (limit is not None and limit < 0):
+            return 400, {'msg': 'offset和limit不能为负数'}
+        return 200, self.list_grants(query.get('ip', [None])[0], offset, limit, query.get('rule_id', [None])[0])
+
+    def _revoke_route(self, query, body):
+        ips = query.get('ip', [])
+        if not ips:
+            return 400, {'msg': '缺少参数ip'}
+        return 200, self.revoke_grants(ips, query.get('rule_id', [None])[0])
+
+    def _reload_route(self, query, body):
+        try:
+            return 200, self.reload(body or {})
+        except ValueError as e:
+            return 400, {'msg': str(e)}
+
+    def _pause_route(self, query, body):
         try:
-            # 转义IP和端口
-            ip_escaped = quote(ip)
-            port_escaped = quote(str(self.args.target_port))
-
-            # 移除防火墙规则
-            del_cmd = [
-                'firewall-cmd',
-                f'--zone={self.args.zone}',
-                '--remove-rich-rule',
-                f'rule family="ipv4" source address="{ip_escaped}" '
-                f'port port="{port_escaped}" protocol="tcp" accept'
-            ]
-
-            subprocess.run(del_cmd, check=True)
-            self.firewall_rules.discard((ip, self.args.target_port))
-            logger.info(f"关闭 {ip} 对 {self.args.target_port}端口 的访问权限")
-        except subprocess.CalledProcessError as e:
-            logger.error(f"防火墙规则移除失败: {str(e)}")
+            return 200, self.pause((body or {}).get('rule_id'))
+        except ValueError as e:
+            return 400, {'msg': str(e)}
+
+    def _resume_route(self, query, body):
+        try:
+            return 200, self.resume(body)
+        except ValueError as e:
+            return 400, {'msg': str(e)}
+
+    def _remove_route(self, query, body):
+        if not query.get('rule_id'):
+            return 400, {'msg': '缺少参数rule_id'}
+        try:
+            return 200, self.remove_rule(query['rule_id'][0])
+        except ValueError as e:
+            return 400, {'msg': str(e)}
+
+    def _grant_applied(self, ip, port, latency):
+        """授权生效后记录延迟"""
+        self.grant_latency.observe(latency)
+
+    def _active_grants(self):
+        now = time.time()
+        with self.lock:
+            return sum(1 for expires in self.firewall_rules.values() if expires > now)
+
+    def stats(self):
+        """运行统计快照，供控制接口 /stats 返回"""
+        return {
+            'rule_id': self.args.rule_id,
+            'pid': os.getpid(),
+            'uptime': round(time.time() - self.started, 1),
+            'paused': self.paused,
+            'rules': list(self.rules),
+            'paused_rules': sorted(self.paused_rules),
+            'metrics': self.metrics.snapshot(),
+            'guard': self.guard.stats(),
+            'firewall': self.firewall_worker.stats(),
+        }
+
+    def control_routes(self):
+        """控制接口路由表，见 knocking_control.ControlServer"""
+        return {
+            ('GET', '/metrics'): lambda query, body: (200, self.metrics.render()),
+            ('GET', '/stats'): lambda query, body: (200, self.stats()),
+            ('POST', '/reload'): self._reload_route,
+            ('POST', '/pause'): self._pause_route,
+            ('POST', '/resume'): self._resume_route,
+            ('DELETE', '/rules'): self._remove_route,
+            ('GET', '/grants'): self._grants_route,
+            ('DELETE', '/grants'): self._revoke_route,
+        }
+
+    def close(self):
+        """停止防火墙工作线程
+
+        未启用授权日志时撤销尚未到期的授权；启用时保留授权，由下一个监听进程按日志接管。
+        """
+        self.firewall_worker.stop(revoke_pending=self.journal is None)
+        self.firewall.close()
+        for rule in self.rules.values():
+            rule.verifier.close()
+        if self.events is not None:
+            self.events.close()
+
+
+def adopt_journals(args):
+    """把旧布局遗留的授权日志并入本次启动使用的授权日志
+
+    单进程模式使用 <名称>.grants，分片模式第i个工作进程使用 <名称>.<i>.grants。
+    工作进程数减少或切换模式后，不属于当前布局的日志按源地址并入对应的日志，
+    由各进程启动时统一恢复或撤销其中的授权，见 merge_journals()。须在启动状态机之前调用。
+    --rules-file 中各规则和 --adopt-journal 指定名称的日志是合并进本进程的规则组留下的，一并接管。
+
+    Returns:
+        int: 迁移的记录数
+    """
+    state_dir = getattr(args, 'state_dir', None)
+    if not state_dir or not os.path.isdir(state_dir):
+        return 0
+    name = args.rule_id or f'port-{args.target_port}'
+    workers = args.workers if args.workers > 1 else 0
+    if workers:
+        current = {os.path.join(state_dir, f'{name}.{index}.grants') for index in range(workers)}
+
+        def target_of(ip):
+            return os.path.join(state_dir, f'{name}.{shard_of_address(ip, workers)}.grants')
+    else:
+        single = os.path.join(state_dir, f'{name}.grants')
+        current = {single}
+
+        def target_of(ip):
+            return single
+
+    names = {name} | set(getattr(args, 'adopt_journal', None) or ())
+    if getattr(args, 'rules_file', None):
+        names.update(rule.rule_id for rule in load_rules_file(args.rules_file, args) if rule.rule_id)
+    pattern = re.compile('(' + '|'.join(re.escape(item) for item in sorted(names)) + r')(\.\d+)?\.grants')
+    orphans = [os.path.join(state_dir, filename) for filename in os.listdir(state_dir)
+               if pattern.fullmatch(filename) and os.path.join(state_dir, filename) not in current]
+    if not orphans:
+        return 0
+    moved = merge_journals(orphans, target_of)
+    logger.info(f"已将遗留授权日志 {[os.path.basename(p) for p in orphans]} 中的 {moved} 条记录并入当前授权日志")
+    return moved
+
+
+def run_shard(index, args, conn, log_queue):
+    """分片工作进程入口
+
+    从主进程的管道读取以太网帧交给本分片的状态机处理，主进程通知退出或管道关闭时结束。
+    控制套接字为 <--control-socket>.<分片号>，授权日志和审计事件溢出文件名带分片号后缀。
+
+    Args:
+        index: 分片号
+        args: 主进程的命令行参数
+        conn: 接收帧的管道
+        log_queue: 发往主进程的日志队列
+    """
+    # Ctrl-C由主进程处理；SIGTERM按正常退出处理，保证授权日志落盘
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    log_runtime = setup_shard_logging(log_queue, args.log_level, args.log_rate, args.log_interval)
+
+    args.shard = index
+    if args.control_socket:
+        args.control_socket = f'{args.control_socket}.{index}'
+    fsm = None
+    control = None
+    code = 0
+    try:
+        # 防火墙初始化已由主进程完成
+        firewall = create_backend(args.firewall, zone=args.zone, table=args.nft_table, timeout=args.timeout)
+        fsm = KnockStateMachine(args, firewall=firewall)
+        if args.control_socket:
+            control = ControlServer(args.control_socket, fsm.control_routes()).start()
+        for frame in receive_frames(conn):
+            fsm.process_packet(Ether(frame))
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    except Exception:
+        logger.exception("分片 %s 致命错误:", index)
+        code = 1
+    finally:
+        if control is not None:
+            control.close()
+        if fsm is not None:
+            fsm.close()
+        log_runtime.stop()
+    sys.exit(code)
+
+
+def serve_sharded(args):
+    """多进程分片模式：主进程抓包分发，状态机在工作进程中运行"""
+    firewall = create_backend(args.firewall, zone=args.zone, table=args.nft_table, timeout=args.timeout)
+    rules = [args] + (load_rules_file(args.rules_file, args) if args.rules_file else [])
+    firewall.setup(sorted({rule.target_port for rule in rules}))
+    firewall.close()
+
+    dispatcher = ShardDispatcher(run_shard, args, args.workers).start()
+    control = None
+    sharded = None
+    try:
+        # 与工作进程的状态机一致：只捕获启用中规则的敲门端口
+        active = [rule for rule in rules if not getattr(rule, 'paused', False)]
+        bpf_filter = knock_filter(step for rule in active for step in rule.port_list) if active else PAUSED_FILTER
+        sniff_socket = conf.L2listen(filter=bpf_filter, promisc=False)
+        if args.control_socket:
+            sharded = ShardedControl(
+                [f'{args.control_socket}.{index}' for index in range(args.workers)],
+                paused=not active,
+                paused_filter=PAUSED_FILTER,
+                on_filter_changed=lambda bpf: attach_filter(sniff_socket.ins, bpf, sniff_socket.iface))
+            control = ControlServer(args.control_socket, sharded.routes()).start()
+        dispatcher.serve(sniff_socket)
+    finally:
+        if control is not None:
+            control.close()
+        if sharded is not None:
+            sharded.close()
+        dispatcher.close()
 
 
 def main():
     """主函数
     
     程序入口点，负责：
-    1. 检查权限
-    2. 解析参数
+    1. 解析参数并初始化日志
+    2. 检查权限
     3. 初始化状态机
     4. 启动数据包捕获
+    
+    Returns:
+        int: 进程退出码
     """
-    # 检查root权限
-    if os.geteuid() != 0:
-        logger.error("需要root权限运行")
-        sys.exit(1)
-
     # 解析命令行参数
     args = parse_arguments()
-    logger.info(f"""
+    log_runtime = setup_logging(args.log_level, args.log_file, args.log_rate, args.log_interval)
+
+    fsm = None
+    control = None
+    try:
+        # 检查root权限
+        if os.geteuid() != 0:
+            logger.error("需要root权限运行")
+            return 1
+
+        logger.info(f"""
     === 服务启动参数 ===
     敲门序列：{args.port_list}
     目标端口：{args.target_port}
     时间窗口：{args.window}秒
     规则有效期：{args.timeout}秒
     防火墙区域：{args.zone}
+    防火墙后端：{args.firewall}
+    认证方案：{args.auth_scheme}
+    停用状态：{args.paused}
+    工作进程：{args.workers}
+    额外规则：{args.rules_file or '无'}
+    日志级别：{args.log_level}
     ===================
     """)
 
-    # 设置Scapy性能参数
-    # conf.iface = "ens33"  # 指定监听网卡
-    # conf.sniff_promisc = 0  # 关闭混杂模式
+        # 设置Scapy性能参数
+        # conf.iface = "ens33"  # 指定监听网卡
+        # conf.sniff_promisc = 0  # 关闭混杂模式
 
-    # 创建并启动状态机
-    fsm = KnockStateMachine(args)
-    sniff(prn=fsm.process_packet,
-          filter=fsm.bpf_filter,
-          store=0,  # 不保存数据包
-          promisc=False)  # 非混杂模式
+        # SIGTERM按正常退出处理，保证撤销已开放的端口
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
 
+        # 工作进程数或运行模式变化后，旧授权日志中的授权由接管对应源地址的进程恢复或撤销
+        try:
+            adopt_journals(args)
+        except (OSError, ValueError) as e:
+            logger.error(f"合并遗留授权日志失败: {str(e)}")
 
-if __name__ == "__main__":
-    try:
-        main()
-    except KeyboardInterrupt:
+        if args.workers > 1:
+            serve_sharded(args)
+            return 0
+
+        # 创建并启动状态机
+        fsm = KnockStateMachine(args)
+
+        # 自行打开抓包套接字，热更新时直接在该套接字上替换BPF过滤器
+        sniff_socket = conf.L2listen(filter=fsm.active_filter, promisc=False)  # 非混杂模式
+        fsm.on_filter_changed = lambda bpf: attach_filter(sniff_socket.ins, bpf, sniff_socket.iface)
+
+        if args.control_socket:
+            control = ControlServer(args.control_socket, fsm.control_routes()).start()
+        sniff(prn=fsm.process_packet,
+              opened_socket=sniff_socket,
+              store=0)  # 不保存数据包
+        return 0
+    except (KeyboardInterrupt, SystemExit):
         logger.info("服务已手动停止")
-        sys.exit(0)
-    except Exception as e:
+        return 0
+    except Exception:
         logger.exception("致命错误:")
-        sys.exit(1)
-
+        return 1
+    finally:
+        if control is not None:
+            control.close()
+        if fsm is not None:
+            fsm.close()
+        log_runtime.stop()
 
 
+if __name__ == "__main__":
+    sys.exit(main())
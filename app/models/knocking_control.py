@@ -0,0 +1,179 @@
+# coding:utf-8
+"""
+端口敲门监听进程控制通道
+
+监听进程在本地Unix套接字上提供一个极简的HTTP/JSON接口，管理端通过 ControlClient 访问，
+用于读取指标等运行时信息。只监听Unix套接字，不对外暴露端口。
+
+本模块只依赖标准库，既被 knocking_cmd.py 以脚本方式导入，也被Flask端以包方式导入。
+"""
+
+import http.client
+import json
+import os
+import socket
+import socketserver
+from http.server import BaseHTTPRequestHandler
+from threading import Thread
+from urllib.parse import parse_qs, urlsplit
+
+
+class ControlError(Exception):
+    """控制通道访问失败
+
+    Attributes:
+        status: 对端返回的HTTP状态码，连接失败或超时时为None
+    """
+
+    def __init__(self, msg, status=None):
+        super().__init__(msg)
+        self.status = status
+
+
+class _ControlHandler(BaseHTTPRequestHandler):
+    """把请求分发给 ControlServer.routes 中注册的处理函数
+
+    处理函数签名为 handler(query, body)，返回 (状态码, 响应体)；
+    响应体为str时按纯文本返回，其余按JSON返回。
+    """
+
+    def _dispatch(self, method):
+        url = urlsplit(self.path)
+        handler = self.server.routes.get((method, url.path))
+        if handler is None:
+            self._send(404, {'msg': 'not found'})
+            return
+        body = None
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            try:
+                body = json.loads(self.rfile.read(length))
+            except ValueError:
+                self._send(400, {'msg': 'invalid json'})
+                return
+        try:
+            status, payload = handler(parse_qs(url.query), body)
+        except Exception as e:
+            status, payload = 500, {'msg': str(e)}
+        self._send(status, payload)
+
+    def _send(self, status, payload):
+        if isinstance(payload, str):
+            data = payload.encode('utf-8')
+            content_type = 'text/plain; version=0.0.4; charset=utf-8'
+        else:
+            data = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+            content_type = 'application/json'
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        self._dispatch('GET')
+
+    def do_POST(self):
+        self._dispatch('POST')
+
+    def do_DELETE(self):
+        self._dispatch('DELETE')
+
+    def address_string(self):
+        return 'unix'
+
+    def log_message(self, format, *args):
+        # 控制请求不写入监听日志
+        pass
+
+
+class ControlServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """基于Unix套接字的控制服务
+
+    Attributes:
+        routes: {(方法, 路径): 处理函数}
+    """
+    daemon_threads = True
+
+    def __init__(self, path, routes):
+        if os.path.exists(path):
+            os.unlink(path)
+        self.path = path
+        self.routes = routes
+        super().__init__(path, _ControlHandler)
+        os.chmod(path, 0o660)
+
+    def start(self):
+        Thread(target=self.serve_forever, name='control-server', daemon=True).start()
+        return self
+
+    def close(self):
+        self.shutdown()
+        self.server_close()
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path, timeout):
+        super().__init__('localhost', timeout=timeout)
+        self.unix_path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.unix_path)
+
+
+class ControlClient:
+    """控制通道客户端"""
+
+    def __init__(self, path, timeout=2.0):
+        """
+        Args:
+            path: 监听进程的控制套接字路径
+            timeout: 单次请求超时时间（秒）
+        """
+        self.path = path
+        self.timeout = timeout
+
+    def request(self, method, path, body=None):
+        """发送请求
+
+        Returns:
+            JSON响应解析后的对象，纯文本响应返回str
+
+        Raises:
+            ControlError: 连接失败、超时或返回非2xx状态码
+        """
+        conn = _UnixHTTPConnection(self.path, self.timeout)
+        try:
+            data = json.dumps(body).encode('utf-8') if body is not None else None
+            headers = {'Content-Type': 'application/json'} if data is not None else {}
+            conn.request(method, path, body=data, headers=headers)
+            response = conn.getresponse()
+            raw = response.read()
+        except (OSError, http.client.HTTPException) as e:
+            raise ControlError(f"控制通道 {self.path} 访问失败: {str(e)}") from e
+        finally:
+            conn.close()
+
+        if response.getheader('Content-Type', '').startswith('application/json'):
+            payload = json.loads(raw)
+        else:
+            payload = raw.decode('utf-8')
+        if not 200 <= response.status < 300:
+            msg = payload.get('msg') if isinstance(payload, dict) else payload
+            raise ControlError(f"控制请求 {method} {path} 失败({response.status}): {msg}", response.status)
+        return payload
+
+    def get(self, path):
+        return self.request('GET', path)
+
+    def post(self, path, body=None):
+        return self.request('POST', path, body if body is not None else {})
+
+    def delete(self, path):
+        return self.request('DELETE', path)
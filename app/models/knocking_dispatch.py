@@ -0,0 +1,77 @@
+# coding:utf-8
+"""
+端口敲门序列分发索引
+
+把一个监听进程负责的全部规则的敲门序列编译成一棵以 (端口, 协议) 为边的前缀树：
+- 每个客户端只记录当前所在的节点，每个数据包只做一次字典查找即可同时推进所有候选规则
+- 共享前缀的规则共用同一段路径，例如 1201:TCP,2301:UDP 与 1201:TCP,3401:TCP
+- 序列在某个节点结束的规则挂在该节点上，到达时用各自的认证器校验最终包；
+  一条规则的序列是另一条的前缀时，校验不通过的客户端可以继续走向更长的序列
+
+前缀树在构造后不再修改，热更新时整体重建并替换，数据包处理路径无需加锁读取。
+"""
+
+
+class TrieNode:
+    """前缀树节点
+
+    Attributes:
+        path: 从根到本节点的敲门步骤元组
+        children: {(端口, 协议): 子节点}
+        rules: 敲门序列在本节点结束的规则
+        window: 从本节点走向下一步允许的最长间隔（秒），取经过本节点继续向下的规则中的最大值
+        rule: 经过本节点的第一条规则，用于失败事件的归属
+    """
+    __slots__ = ('path', 'children', 'rules', 'window', 'rule')
+
+    def __init__(self, path):
+        self.path = path
+        self.children = {}
+        self.rules = []
+        self.window = 0
+        self.rule = None
+
+
+class KnockTrie:
+    """敲门序列前缀树
+
+    Attributes:
+        root: 根节点
+        rules: 编译进来的规则
+        steps: 全部规则用到的 (端口, 协议) 集合
+    """
+
+    def __init__(self, rules):
+        """
+        Args:
+            rules: 规则列表，每条规则需有 port_list（[(端口, 协议)]）和 window 属性
+        """
+        self.root = TrieNode(())
+        self.rules = list(rules)
+        self.steps = set()
+        for rule in self.rules:
+            self._insert(rule)
+
+    def _insert(self, rule):
+        node = self.root
+        for step in rule.port_list:
+            node.window = max(node.window, rule.window)
+            if node.rule is None:
+                node.rule = rule
+            child = node.children.get(step)
+            if child is None:
+                child = node.children[step] = TrieNode(node.path + (step,))
+            node = child
+            self.steps.add(step)
+        if node.rule is None:
+            node.rule = rule
+        node.rules.append(rule)
+
+    def find(self, path):
+        """按步骤元组查找节点，不存在时返回None"""
+        node = self.root
+        for step in path:
+            node = node.children.get(step)
+            if node is None:
+                return None
+        return node
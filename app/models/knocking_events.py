@@ -0,0 +1,216 @@
+# coding:utf-8
+"""
+端口敲门审计事件写入模块
+
+监听进程把敲门成功、密码错误、超时、步骤错误、封禁和手动撤销等事件写入 sys_knocking_event 表：
+- record() 只把事件放入有界缓冲区，数据包处理路径不等待数据库
+- 后台线程攒够一批或到达刷新间隔后用一条多行 INSERT 写入
+- 数据库不可用时事件追加到本地溢出文件（JSON Lines），恢复后先补写溢出文件再写新事件
+- 缓冲区满时丢弃最早的事件并计数，内存占用有上限
+
+数据库通过 SQLAlchemy Core 访问，连接串由环境变量 AUTHBASE_EVENT_DB_URI 传入（见 KnockingSupervisor），
+不出现在进程命令行中。表结构与 app/models/KnockingEvent.py 保持一致。
+"""
+
+import json
+import logging
+import os
+import time
+from collections import deque
+from datetime import datetime
+from threading import Condition, Thread
+
+logger = logging.getLogger(__name__)
+
+# 事件类型
+EVENT_TYPES = ('success', 'auth_failed', 'timeout', 'invalid_step', 'banned', 'revoked')
+
+
+def event_table(metadata):
+    """sys_knocking_event 表定义（SQLAlchemy Core）"""
+    from sqlalchemy import BigInteger, Column, DateTime, Integer, String, Table
+    return Table(
+        'sys_knocking_event', metadata,
+        Column('id', BigInteger().with_variant(Integer, 'sqlite'), primary_key=True, autoincrement=True),
+        Column('rule_id', String(32)),
+        Column('event_type', String(16), nullable=False),
+        Column('source_ip', String(64), nullable=False),
+        Column('target_port', Integer),
+        Column('detail', String(255)),
+        Column('event_time', DateTime, nullable=False),
+    )
+
+
+class EventWriter:
+    """批量异步写入审计事件
+
+    Attributes:
+        written: 已写入数据库的事件数
+        spilled: 写入溢出文件的事件数
+        dropped: 因缓冲区满或无法落盘而丢弃的事件数
+    """
+
+    def __init__(self, url, rule_id='', spill_path=None, batch_size=200, flush_interval=1.0,
+                 max_buffer=10000, retry_interval=30, engine=None):
+        """
+        Args:
+            url: 数据库连接串
+            rule_id: 事件所属的规则ID
+            spill_path: 溢出文件路径，为None时数据库不可用期间的事件直接丢弃
+            batch_size: 单条INSERT的最大行数
+            flush_interval: 缓冲区未满时的最长写入间隔（秒）
+            max_buffer: 缓冲区最多保留的事件数
+            retry_interval: 数据库写入失败后多久再重试（秒）
+            engine: 已创建的SQLAlchemy引擎，提供时忽略url
+        """
+        self.rule_id = rule_id
+        self.spill_path = spill_path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_buffer = max_buffer
+        self.retry_interval = retry_interval
+        self.written = 0
+        self.spilled = 0
+        self.dropped = 0
+        self._retry_at = 0
+        self._buffer = deque()
+        self._cond = Condition()
+        self._stopping = False
+        self._engine = engine
+        self._table = None
+        try:
+            from sqlalchemy import MetaData, create_engine
+            if self._engine is None:
+                self._engine = create_engine(url, pool_pre_ping=True)
+            self._table = event_table(MetaData())
+        except Exception as e:
+            # 缺少SQLAlchemy或连接串无效时只写溢出文件
+            logger.error("审计事件数据库不可用: %s", e)
+            self._engine = None
+        self._thread = Thread(target=self._run, name='event-writer', daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def record(self, event_type, source_ip, target_port=None, detail=None, rule_id=None):
+        """记录一条事件（非阻塞），rule_id 为空时使用构造时指定的规则ID"""
+        event = {
+            'rule_id': rule_id or self.rule_id,
+            'event_type': event_type,
+            'source_ip': source_ip,
+            'target_port': target_port,
+            'detail': detail[:255] if detail else detail,
+            'event_time': datetime.now(),
+        }
+        with self._cond:
+            if len(self._buffer) >= self.max_buffer:
+                self._buffer.popleft()
+                self.dropped += 1
+            self._buffer.append(event)
+            if len(self._buffer) >= self.batch_size:
+                self._cond.notify()
+
+    def pending(self):
+        return len(self._buffer)
+
+    def _take(self):
+        with self._cond:
+            if not self._stopping and len(self._buffer) < self.batch_size:
+                self._cond.wait(self.flush_interval)
+            events = list(self._buffer)
+            self._buffer.clear()
+            return events
+
+    def _run(self):
+        while True:
+            events = self._take()
+            if events:
+                self._write(events)
+            if self._stopping and not self._buffer:
+                return
+
+    def _insert(self, events):
+        with self._engine.begin() as conn:
+            for i in range(0, len(events), self.batch_size):
+                conn.execute(self._table.insert().values(events[i:i + self.batch_size]))
+
+    def _write(self, events):
+        """写入数据库，失败时转入溢出文件"""
+        if self._engine is not None and time.monotonic() >= self._retry_at:
+            try:
+                self._replay_spill()
+                self._insert(events)
+                self.written += len(events)
+                return
+            except Exception as e:
+                logger.error("写入审计事件失败，%s 秒后重试: %s", self.retry_interval, e)
+                self._retry_at = time.monotonic() + self.retry_interval
+        self._spill(events)
+
+    def _spill(self, events):
+        if not self.spill_path:
+            self.dropped += len(events)
+            return
+        try:
+            os.makedirs(os.path.dirname(self.spill_path) or '.', exist_ok=True)
+            with open(self.spill_path, 'a', encoding='utf-8') as f:
+                for event in events:
+                    f.write(json.dumps(dict(event, event_time=event['event_time'].isoformat()),
+                                       ensure_ascii=False) + '\n')
+            self.spilled += len(events)
+        except OSError as e:
+            logger.error("写入审计事件溢出文件失败: %s", e)
+            self.dropped += len(events)
+
+    def _replay_spill(self):
+        """把溢出文件中的事件补写入数据库，成功的部分从文件中移除"""
+        if not self.spill_path or not os.path.exists(self.spill_path):
+            return
+        events = []
+        with open(self.spill_path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    event = json.loads(line)
+                    event['event_time'] = datetime.fromisoformat(event['event_time'])
+                except (ValueError, KeyError, TypeError):
+                    continue
+                events.append(event)
+        done = 0
+        try:
+            for i in range(0, len(events), self.batch_size):
+                self._insert(events[i:i + self.batch_size])
+                done = i + self.batch_size
+        finally:
+            if done >= len(events):
+                os.remove(self.spill_path)
+            elif done:
+                tmp = self.spill_path + '.tmp'
+                with open(tmp, 'w', encoding='utf-8') as f:
+                    for event in events[done:]:
+                        f.write(json.dumps(dict(event, event_time=event['event_time'].isoformat()),
+                                           ensure_ascii=False) + '\n')
+                os.replace(tmp, self.spill_path)
+        self.written += len(events)
+        if events:
+            logger.info("已补写 %s 条溢出的审计事件", len(events))
+
+    def stats(self):
+        return {
+            'written': self.written,
+            'spilled': self.spilled,
+            'dropped': self.dropped,
+            'pending': self.pending(),
+        }
+
+    def close(self, timeout=10):
+        """写出缓冲区中剩余的事件并停止线程"""
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+        if self._thread.is_alive():
+            self._thread.join(timeout)
+        elif self._buffer:
+            self._write(self._take())
+        if self._engine is not None:
+            self._engine.dispose()
@@ -0,0 +1,878 @@
+# coding:utf-8
+"""
+端口敲门防火墙后端模块
+
+将"为某个源地址临时开放目标端口"抽象为可替换的防火墙后端，供 knocking_cmd.py 使用。
+支持的后端：
+- firewalld: 通过 firewall-cmd 添加/删除富规则（原有实现），到期需由用户态撤销
+- nftables: 将源地址加入带 timeout 的命名集合，由内核自动过期；多条变更合并为一次 nft -f 事务
+- ipset: 无nftables的主机使用，通过常驻的 ipset 交互进程流式写入 add/del 命令，
+  每批之后写入一条应答命令确认生效，条目超时由内核处理
+- memory: 仅在内存中记录授权（dry-run），用于测试和演练
+
+所有后端都实现 apply(ops) 批量接口，ops 为 (动作, IP, 端口, 有效期) 元组列表，
+动作取 'add' 或 'del'。IP 为IPv4或IPv6地址的文本形式，各后端按地址族选择对应的规则或集合。
+
+FirewallWorker 在独立线程中串行调用后端：数据包处理路径只需把授权放入队列，
+不再在持锁状态下等待防火墙命令返回；到期撤销也由该线程按时间堆调度。
+
+GrantJournal 把已生效的授权和撤销追加写入日志文件，监听进程重启后据此恢复到期撤销，
+并清理上一个进程遗留的过期授权；merge_journals 把分片布局变化后无人读取的日志并入当前布局。
+"""
+
+import heapq
+import logging
+import os
+import queue
+import re
+import subprocess
+import time
+from collections import deque
+from shlex import quote
+from threading import Event, Lock, Thread
+
+logger = logging.getLogger(__name__)
+
+
+def address_family(ip):
+    """返回地址族：'ipv6' 或 'ipv4'"""
+    return 'ipv6' if ':' in ip else 'ipv4'
+
+
+class FirewallError(Exception):
+    """防火墙后端操作失败
+
+    Attributes:
+        failed: 后端能定位失败项时为 {变更在ops中的下标: 错误信息}，其余变更已生效；
+            为None时无法区分，由 FirewallWorker 逐条重试定位
+    """
+
+    def __init__(self, message, failed=None):
+        super().__init__(message)
+        self.failed = failed
+
+
+class FirewallBackend:
+    """防火墙后端基类
+
+    子类只需实现 apply()，grant()/revoke() 是单条操作的便捷封装。
+
+    Attributes:
+        name: 后端名称，对应命令行 --firewall 参数
+        kernel_timeout: 为True时授权由内核按有效期自动过期，调用方无需定时撤销
+    """
+    name = None
+    kernel_timeout = False
+
+    def setup(self, ports):
+        """初始化后端所需的表、集合等资源
+
+        Args:
+            ports: 需要保护的目标端口列表
+        """
+
+    def apply(self, ops):
+        """批量应用授权变更
+
+        Args:
+            ops: (action, ip, port, timeout) 元组列表
+
+        Raises:
+            FirewallError: 任意一条变更应用失败时抛出，后端不重试
+        """
+        raise NotImplementedError
+
+    def grant(self, ip, port, timeout):
+        """为ip开放port，有效期timeout秒"""
+        self.apply([('add', ip, port, timeout)])
+
+    def revoke(self, ip, port):
+        """撤销ip对port的访问权限"""
+        self.apply([('del', ip, port, 0)])
+
+    def list_grants(self, port):
+        """列出防火墙中按本后端格式为port开放的源地址
+
+        Returns:
+            set: 源地址集合；后端由内核负责过期、无需清理时返回None
+        """
+        return None
+
+    def teardown(self, ports):
+        """删除 setup() 创建的表、集合等资源，用于测试和基准结束后清理
+
+        Args:
+            ports: setup() 时传入的目标端口列表
+        """
+
+    def close(self):
+        """释放后端持有的资源"""
+
+
+class FirewalldBackend(FirewallBackend):
+    """基于firewalld富规则的后端
+
+    同一批次的添加/删除分别合并为一次 firewall-cmd 调用（firewall-cmd 支持重复的
+    --add-rich-rule/--remove-rich-rule 参数）。富规则不会自动过期，需要调用方定时撤销。
+    """
+    name = 'firewalld'
+
+    def __init__(self, zone='public'):
+        self.zone = zone
+
+    RICH_RULE_PATTERN = re.compile(
+        r'^rule family="ipv[46]" source address="([^"]+)" port port="(\d+)" protocol="tcp" accept$')
+
+    @staticmethod
+    def rich_rule(ip, port):
+        """生成富规则文本，IPv4规则与历史版本一致"""
+        return (f'rule family="{address_family(ip)}" source address="{quote(ip)}" '
+                f'port port="{quote(str(port))}" protocol="tcp" accept')
+
+    def list_grants(self, port):
+        try:
+            output = subprocess.run(['firewall-cmd', f'--zone={self.zone}', '--list-rich-rules'],
+                                    check=True, capture_output=True, text=True).stdout
+        except (subprocess.CalledProcessError, OSError) as e:
+            raise FirewallError(f"firewall-cmd 执行失败: {str(e)}") from e
+        return self.parse_rich_rules(output, port)
+
+    @classmethod
+    def parse_rich_rules(cls, output, port):
+        """从 --list-rich-rules 输出中提取本后端格式、目标端口为port的源地址"""
+        grants = set()
+        for line in output.splitlines():
+            match = cls.RICH_RULE_PATTERN.match(line.strip())
+            if match and int(match.group(2)) == int(port):
+                grants.add(match.group(1))
+        return grants
+
+    def apply(self, ops):
+        adds = [self.rich_rule(ip, port) for action, ip, port, _ in ops if action == 'add']
+        dels = [self.rich_rule(ip, port) for action, ip, port, _ in ops if action == 'del']
+
+        for option, rules in (('--add-rich-rule', adds), ('--remove-rich-rule', dels)):
+            if not rules:
+                continue
+            cmd = ['firewall-cmd', f'--zone={self.zone}']
+            for rule in rules:
+                cmd += [option, rule]
+            try:
+                subprocess.run(cmd, check=True)
+            except (subprocess.CalledProcessError, OSError) as e:
+                raise FirewallError(f"firewall-cmd 执行失败: {str(e)}") from e
+
+
+class NftablesBackend(FirewallBackend):
+    """基于nftables命名集合的后端
+
+    每个目标端口对应集合 knock_<端口>（IPv4）和 knock6_<端口>（IPv6），授权即向集合添加带 timeout 的元素，
+    到期由内核删除，无需用户态定时器。同时维护一条独立的 input 基础链 guard_<端口>：
+    已建立连接和集合内的源地址放行，其余访问目标端口的连接丢弃。
+
+    注意：nftables中accept只结束当前基础链，若主机上的firewalld等仍会丢弃目标端口流量，
+    需要先在其中放行目标端口，由本后端负责访问控制。
+    """
+    name = 'nftables'
+    kernel_timeout = True
+
+    def __init__(self, table='authbase', priority=-10):
+        self.table = table
+        self.priority = priority
+
+    def _set_name(self, port, family='ipv4'):
+        return f"knock{'6' if family == 'ipv6' else ''}_{int(port)}"
+
+    def render_setup(self, ports):
+        """生成初始化表、集合和守护链的nft脚本"""
+        lines = [f"add table inet {self.table}"]
+        for port in ports:
+            port = int(port)
+            chain = f"guard_{port}"
+            lines += [
+                f"add set inet {self.table} {self._set_name(port)} "
+                f"{{ type ipv4_addr; flags timeout; }}",
+                f"add set inet {self.table} {self._set_name(port, 'ipv6')} "
+                f"{{ type ipv6_addr; flags timeout; }}",
+                f"add chain inet {self.table} {chain} "
+                f"{{ type filter hook input priority {self.priority}; policy accept; }}",
+                f"flush chain inet {self.table} {chain}",
+                f"add rule inet {self.table} {chain} tcp dport {port} ct state established,related accept",
+                f"add rule inet {self.table} {chain} tcp dport {port} ip saddr @{self._set_name(port)} accept",
+                f"add rule inet {self.table} {chain} tcp dport {port} "
+                f"ip6 saddr @{self._set_name(port, 'ipv6')} accept",
+                f"add rule inet {self.table} {chain} tcp dport {port} drop",
+            ]
+        return '\n'.join(lines) + '\n'
+
+    def render(self, ops):
+        """将一批变更渲染为单个nft事务脚本"""
+        lines = []
+        for action, ip, port, timeout in ops:
+            set_name = self._set_name(port, address_family(ip))
+            if action == 'add':
+                lines.append(f"add element inet {self.table} {set_name} "
+                             f"{{ {ip} timeout {max(int(timeout), 1)}s }}")
+            else:
+                lines.append(f"delete element inet {self.table} {set_name} {{ {ip} }}")
+        return '\n'.join(lines) + '\n'
+
+    def _run(self, script):
+        try:
+            subprocess.run(['nft', '-f', '-'], input=script, text=True,
+                           capture_output=True, check=True)
+        except subprocess.CalledProcessError as e:
+            raise FirewallError(f"nft 执行失败: {e.stderr.strip() if e.stderr else str(e)}") from e
+        except OSError as e:
+            raise FirewallError(f"nft 执行失败: {str(e)}") from e
+
+    def setup(self, ports):
+        self._run(self.render_setup(ports))
+
+    def teardown(self, ports):
+        for port in ports:
+            port = int(port)
+            # 先删除引用集合的守护链，再删除集合；单项不存在时不影响其余项
+            for line in (f"delete chain inet {self.table} guard_{port}",
+                         f"delete set inet {self.table} {self._set_name(port)}",
+                         f"delete set inet {self.table} {self._set_name(port, 'ipv6')}"):
+                try:
+                    self._run(line + '\n')
+                except FirewallError as e:
+                    logger.warning("清理nftables资源失败: %s", str(e))
+
+    def apply(self, ops):
+        if not ops:
+            return
+        # nft事务是原子的，单条失败（如删除已被内核过期的元素）会使整批回滚，由调用方逐条重试
+        self._run(self.render(ops))
+
+
+class IpsetBackend(FirewallBackend):
+    """基于ipset的后端
+
+    每个目标端口对应集合 knock_<端口>（hash:ip，带timeout），并通过iptables自定义链
+    AUTHBASE_<端口> 引用该集合；IPv6使用集合 knock6_<端口>（family inet6）和ip6tables中的同名链，
+    主机不支持ip6tables时只记录警告，IPv4不受影响。变更通过一个常驻的 `ipset -` 交互进程写入标准输入，
+    不再为每次授权创建新进程；进程意外退出时自动重启。
+
+    交互进程出错时不退出，只向标准错误输出一行错误。每条变更之后追加一条对应答集合 knock_ack 的
+    test 命令，它的结果同样输出到标准错误且带有集合名；读到第i条应答即说明前i条变更已处理完，
+    两条应答之间的其余行都是对应变更的错误。出错时抛出带 failed 的 FirewallError，
+    调用方无需重试即可知道哪些变更失败。
+    """
+    name = 'ipset'
+    kernel_timeout = True
+    ACK_SET = 'knock_ack'
+
+    def __init__(self, default_timeout=30, reply_timeout=5.0):
+        """
+        Args:
+            default_timeout: 集合的默认条目超时（秒）
+            reply_timeout: 等待一批变更应答的最长时间（秒），超时后重启交互进程
+        """
+        self.default_timeout = default_timeout
+        self.reply_timeout = reply_timeout
+        self._proc = None
+        self._replies = None
+        self._lock = Lock()
+
+    def _set_name(self, port, family='ipv4'):
+        return f"knock{'6' if family == 'ipv6' else ''}_{int(port)}"
+
+    @staticmethod
+    def _run(cmd, check=True):
+        try:
+            return subprocess.run(cmd, capture_output=True, text=True, check=check)
+        except subprocess.CalledProcessError as e:
+            raise FirewallError(f"{cmd[0]} 执行失败: {e.stderr.strip() if e.stderr else str(e)}") from e
+        except OSError as e:
+            raise FirewallError(f"{cmd[0]} 执行失败: {str(e)}") from e
+
+    def setup(self, ports):
+        for port in ports:
+            port = int(port)
+            self._setup_family(port, 'iptables', self._set_name(port), 'inet')
+            try:
+                self._setup_family(port, 'ip6tables', self._set_name(port, 'ipv6'), 'inet6')
+            except FirewallError as e:
+                logger.warning("端口 %s 的IPv6规则初始化失败，IPv6敲门将无法开放端口: %s", port, str(e))
+
+    def _setup_family(self, port, iptables, set_name, family):
+        chain = f"AUTHBASE_{port}"
+        self._run(['ipset', 'create', set_name, 'hash:ip', 'family', family,
+                   'timeout', str(self.default_timeout), '-exist'])
+        # 自定义链不存在时创建，存在时清空后重建规则，保证重复启动幂等
+        self._run([iptables, '-N', chain], check=False)
+        self._run([iptables, '-F', chain])
+        base = [iptables, '-A', chain, '-p', 'tcp', '--dport', str(port)]
+        self._run(base + ['-m', 'conntrack', '--ctstate', 'ESTABLISHED,RELATED', '-j', 'ACCEPT'])
+        self._run(base + ['-m', 'set', '--match-set', set_name, 'src', '-j', 'ACCEPT'])
+        self._run(base + ['-j', 'DROP'])
+        jump = ['INPUT', '-p', 'tcp', '--dport', str(port), '-j', chain]
+        if self._run([iptables, '-C'] + jump, check=False).returncode != 0:
+            self._run([iptables, '-I'] + jump[:1] + ['1'] + jump[1:])
+
+    def teardown(self, ports):
+        for port in ports:
+            port = int(port)
+            chain = f"AUTHBASE_{port}"
+            for iptables, set_name in (('iptables', self._set_name(port)),
+                                       ('ip6tables', self._set_name(port, 'ipv6'))):
+                # 依次删除INPUT跳转、自定义链（含DROP规则）和集合，不存在的项忽略
+                jump = ['INPUT', '-p', 'tcp', '--dport', str(port), '-j', chain]
+                try:
+                    while self._run([iptables, '-D'] + jump, check=False).returncode == 0:
+                        pass
+                    self._run([iptables, '-F', chain], check=False)
+                    self._run([iptables, '-X', chain], check=False)
+                    self._run(['ipset', 'destroy', set_name], check=False)
+                except FirewallError as e:
+                    logger.warning("清理 %s 的端口 %s 规则失败: %s", iptables, port, str(e))
+        try:
+            self._run(['ipset', 'destroy', self.ACK_SET], check=False)
+        except FirewallError as e:
+            logger.warning("清理应答集合失败: %s", str(e))
+
+    def _helper(self):
+        """获取常驻的ipset交互进程，不存在或已退出时重新启动，并确保应答集合存在"""
+        if self._proc is None or self._proc.poll() is not None:
+            try:
+                proc = subprocess.Popen(
+                    ['ipset', '-'],
+                    stdin=subprocess.PIPE,
+                    stdout=subprocess.DEVNULL,
+                    stderr=subprocess.PIPE,
+                    text=True,
+                    bufsize=1
+                )
+            except OSError as e:
+                raise FirewallError(f"ipset 进程启动失败: {str(e)}") from e
+            self._proc, self._replies = proc, queue.Queue()
+            Thread(target=self._read_replies, args=(proc, self._replies), daemon=True).start()
+            proc.stdin.write(f"create {self.ACK_SET} hash:ip -exist\n")
+        return self._proc
+
+    @staticmethod
+    def _read_replies(proc, replies):
+        """持续读取ipset进程的标准错误，逐行放入队列，进程退出时放入None"""
+        for line in proc.stderr:
+            line = line.strip()
+            if line:
+                replies.put(line)
+        replies.put(None)
+
+    def _kill(self):
+        """结束交互进程，下一批变更时重新启动"""
+        if self._proc is not None and self._proc.poll() is None:
+            self._proc.kill()
+        self._proc = None
+
+    def render(self, ops):
+        """将一批变更渲染为ipset命令行"""
+        lines = []
+        for action, ip, port, timeout in ops:
+            set_name = self._set_name(port, address_family(ip))
+            if action == 'add':
+                lines.append(f"add {set_name} {ip} timeout {max(int(timeout), 1)} -exist")
+            else:
+                lines.append(f"del {set_name} {ip} -exist")
+        return '\n'.join(lines) + '\n'
+
+    def apply(self, ops):
+        if not ops:
+            return
+        # test 的结果形如 "127.0.0.1 is in set knock_ack." 或 "... is NOT in set knock_ack."
+        probe = f"test {self.ACK_SET} 127.0.0.1\n"
+        script = ''.join(self.render([op]) + probe for op in ops)
+        ack = f"set {self.ACK_SET}."
+        with self._lock:
+            for attempt in range(2):
+                proc = self._helper()
+                try:
+                    proc.stdin.write(script)
+                    proc.stdin.flush()
+                    break
+                except OSError as e:
+                    # 进程已退出，本批尚未写入，重启后重试一次
+                    self._kill()
+                    if attempt:
+                        raise FirewallError(f"ipset 写入失败: {str(e)}") from e
+
+            failed = {}
+            done = 0
+            deadline = time.monotonic() + self.reply_timeout
+            while done < len(ops):
+                try:
+                    line = self._replies.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    self._kill()
+                    line = "ipset 应答超时"
+                if line is None:
+                    self._proc = None
+                    line = "ipset 进程意外退出"
+                if line.endswith(ack):
+                    done += 1
+                elif self._proc is None:
+                    # 进程已不可用，尚未应答的变更全部视为失败
+                    failed.update((i, line) for i in range(done, len(ops)) if i not in failed)
+                    break
+                else:
+                    failed[done] = line
+            if failed:
+                raise FirewallError(f"ipset 执行失败: {'; '.join(sorted(set(failed.values())))}", failed)
+
+    def close(self):
+        with self._lock:
+            if self._proc is not None and self._proc.poll() is None:
+                try:
+                    self._proc.stdin.close()
+                    self._proc.wait(timeout=5)
+                except (OSError, subprocess.TimeoutExpired):
+                    self._proc.kill()
+            self._proc = None
+
+
+class MemoryBackend(FirewallBackend):
+    """内存后端（dry-run）
+
+    不修改系统防火墙，仅记录授权及操作历史，供测试和演练使用。
+
+    Attributes:
+        grants: {(ip, port): 到期时间戳} 当前授权
+        history: 按顺序记录的全部变更
+    """
+    name = 'memory'
+
+    def __init__(self, kernel_timeout=False, clock=time.time):
+        self.kernel_timeout = kernel_timeout
+        self.clock = clock
+        self.grants = {}
+        self.history = []
+
+    def apply(self, ops):
+        now = self.clock()
+        for action, ip, port, timeout in ops:
+            self.history.append((action, ip, port, timeout))
+            if action == 'add':
+                self.grants[(ip, port)] = now + timeout
+                logger.info("[dry-run] 开放端口 %s 给 %s", port, ip)
+            else:
+                self.grants.pop((ip, port), None)
+                logger.info("[dry-run] 关闭 %s 对 %s端口 的访问权限", ip, port)
+
+    def list_grants(self, port):
+        if self.kernel_timeout:
+            return None
+        return {ip for ip, p in self.grants if p == port}
+
+    def active(self, ip, port):
+        """判断授权当前是否有效（kernel_timeout模式下模拟内核过期）"""
+        expires = self.grants.get((ip, port))
+        if expires is None:
+            return False
+        return not self.kernel_timeout or expires > self.clock()
+
+
+BACKENDS = {
+    FirewalldBackend.name: FirewalldBackend,
+    NftablesBackend.name: NftablesBackend,
+    IpsetBackend.name: IpsetBackend,
+    MemoryBackend.name: MemoryBackend,
+}
+
+
+def create_backend(name, zone='public', table='authbase', timeout=30):
+    """根据名称创建防火墙后端
+
+    Args:
+        name: 后端名称，取值见 BACKENDS
+        zone: firewalld区域
+        table: nftables表名
+        timeout: ipset集合的默认条目超时（秒）
+
+    Returns:
+        FirewallBackend: 后端实例
+
+    Raises:
+        ValueError: 未知的后端名称
+    """
+    if name == FirewalldBackend.name:
+        return FirewalldBackend(zone=zone)
+    if name == NftablesBackend.name:
+        return NftablesBackend(table=table)
+    if name == IpsetBackend.name:
+        return IpsetBackend(default_timeout=timeout)
+    if name == MemoryBackend.name:
+        return MemoryBackend()
+    raise ValueError(f"未知的防火墙后端: {name}")
+
+
+class GrantJournal:
+    """授权日志
+
+    追加写入的文本文件，每行一条记录：
+    - "+ IP 端口 到期时间戳"：授权已生效
+    - "- IP 端口"：授权已撤销
+    以最后一条记录为准。进程崩溃可能留下不完整的末行，读取时忽略无法解析的行。
+    记录数超过存量授权数的若干倍时整体重写压缩。
+
+    Attributes:
+        path: 日志文件路径
+        entries: 当前未撤销的授权 {(ip, 端口): 到期时间戳}
+    """
+
+    def __init__(self, path, prune_expired=False, compact_min=1000):
+        """
+        Args:
+            path: 日志文件路径
+            prune_expired: 压缩时是否丢弃已过期但没有撤销记录的授权（内核负责过期的后端使用）
+            compact_min: 触发压缩的最少记录数
+        """
+        self.path = path
+        self.prune_expired = prune_expired
+        self.compact_min = compact_min
+        self.entries = {}
+        self.appended = 0
+        self._pending = []
+        self._file = None
+
+    def load(self):
+        """读取日志文件，返回未撤销的授权 {(ip, 端口): 到期时间戳}
+
+        同时返回日志中出现过的全部 (ip, 端口)，用于判断防火墙中的规则是否由本进程添加。
+
+        Returns:
+            tuple: (entries, known)
+        """
+        entries = {}
+        known = set()
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                for line in f:
+                    parts = line.split()
+                    try:
+                        if parts[0] == '+' and len(parts) == 4:
+                            key = (parts[1], int(parts[2]))
+                            entries[key] = float(parts[3])
+                        elif parts[0] == '-' and len(parts) == 3:
+                            key = (parts[1], int(parts[2]))
+                            entries.pop(key, None)
+                        else:
+                            continue
+                    except (IndexError, ValueError):
+                        continue
+                    known.add(key)
+        except FileNotFoundError:
+            pass
+        self.entries = dict(entries)
+        return entries, known
+
+    def record_grant(self, ip, port, expires):
+        self.entries[(ip, port)] = expires
+        self._pending.append(f"+ {ip} {port} {expires:.3f}\n")
+
+    def record_revoke(self, ip, port):
+        self.entries.pop((ip, port), None)
+        self._pending.append(f"- {ip} {port}\n")
+
+    def flush(self):
+        """把缓冲的记录写入磁盘，必要时压缩"""
+        if not self._pending:
+            return
+        if self._file is None:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            self._file = open(self.path, 'a', encoding='utf-8')
+        self._file.writelines(self._pending)
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self.appended += len(self._pending)
+        self._pending = []
+        if self.appended > max(self.compact_min, 4 * len(self.entries)):
+            self.compact()
+
+    def compact(self):
+        """用当前授权重写日志文件（先写临时文件再原子替换）"""
+        if self.prune_expired:
+            now = time.time()
+            self.entries = {k: v for k, v in self.entries.items() if v > now}
+        tmp = self.path + '.tmp'
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        with open(tmp, 'w', encoding='utf-8') as f:
+            for (ip, port), expires in self.entries.items():
+                f.write(f"+ {ip} {port} {expires:.3f}\n")
+            f.flush()
+            os.fsync(f.fileno())
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        os.replace(tmp, self.path)
+        self.appended = len(self.entries)
+
+    def close(self):
+        self.flush()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def merge_journals(sources, target_of):
+    """把遗留的授权日志并入当前使用的授权日志，然后删除遗留日志
+
+    分片数变化或在分片与单进程模式之间切换后，旧布局的日志不再有进程读取，其中的授权
+    既不会恢复也不会被撤销。启动监听进程之前调用本函数，按源地址把每条记录原样追加到
+    新布局中负责该地址的日志末尾，由该进程启动时统一恢复或撤销。
+
+    Args:
+        sources: 遗留日志路径列表，按修改时间先后处理
+        target_of: target_of(ip) 返回该源地址当前对应的日志路径
+
+    Returns:
+        int: 迁移的记录数
+    """
+    moved = 0
+    for source in sorted(sources, key=os.path.getmtime):
+        lines = {}
+        with open(source, encoding='utf-8') as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) in (3, 4) and parts[0] in '+-':
+                    lines.setdefault(target_of(parts[1]), []).append(line if line.endswith('\n') else line + '\n')
+        for target, records in lines.items():
+            os.makedirs(os.path.dirname(target) or '.', exist_ok=True)
+            with open(target, 'a', encoding='utf-8') as f:
+                f.writelines(records)
+                f.flush()
+                os.fsync(f.fileno())
+            moved += len(records)
+        os.remove(source)
+    return moved
+
+
+class LatencyStats:
+    """延迟统计
+
+    记录累计次数、总耗时、最大值，并保留最近的样本用于计算分位数。
+    """
+
+    def __init__(self, samples=1024):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self._samples = deque(maxlen=samples)
+        self._lock = Lock()
+
+    def observe(self, seconds):
+        with self._lock:
+            self.count += 1
+            self.total += seconds
+            if seconds > self.max:
+                self.max = seconds
+            self._samples.append(seconds)
+
+    def percentile(self, p):
+        """最近样本的p分位数（秒），无样本时返回0"""
+        with self._lock:
+            samples = sorted(self._samples)
+        if not samples:
+            return 0.0
+        index = min(len(samples) - 1, int(len(samples) * p / 100))
+        return samples[index]
+
+    def snapshot(self):
+        """以毫秒为单位返回统计快照"""
+        return {
+            'count': self.count,
+            'avg_ms': round(self.total / self.count * 1000, 3) if self.count else 0.0,
+            'max_ms': round(self.max * 1000, 3),
+            'p50_ms': round(self.percentile(50) * 1000, 3),
+            'p99_ms': round(self.percentile(99) * 1000, 3),
+        }
+
+
+class FirewallWorker:
+    """异步防火墙工作线程
+
+    从队列中取出授权/撤销请求，尽量合并为一批交给后端 apply()。后端不支持内核过期时，
+    授权成功后按到期时间放入时间堆，到期由本线程撤销，替代每个授权一个休眠线程的做法。
+
+    Attributes:
+        backend: 防火墙后端
+        latency: 从认证成功入队到规则生效的延迟统计
+        applied: 成功应用的变更数
+        failed: 应用失败的变更数
+    """
+
+    def __init__(self, backend, batch_size=64, on_failed=None, on_revoked=None, on_granted=None,
+                 journal=None):
+        """
+        Args:
+            backend: 防火墙后端实例
+            batch_size: 单批最多合并的变更数
+            on_failed: 授权失败回调 on_failed(ip, port)，在工作线程中调用
+            on_revoked: 撤销完成回调 on_revoked(ip, port)，在工作线程中调用
+            on_granted: 授权生效回调 on_granted(ip, port, latency)，latency为认证到生效的秒数
+            journal: 授权日志（GrantJournal），为None时不持久化
+        """
+        self.backend = backend
+        self.batch_size = batch_size
+        self.on_failed = on_failed
+        self.on_revoked = on_revoked
+        self.on_granted = on_granted
+        self.journal = journal
+        self.latency = LatencyStats()
+        self.applied = 0
+        self.failed = 0
+        self._queue = queue.Queue()
+        # 到期撤销时间堆 (到期时间, IP, 端口) 与每个授权当前的到期时间；重新授权或提前撤销后，
+        # 堆中旧的条目与 _expiry 不一致，出堆时直接丢弃，不会撤销更新的授权
+        self._timers = []
+        self._expiry = {}
+        self._stopping = Event()
+        self._thread = Thread(target=self._run, name='firewall-worker', daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def submit_grant(self, ip, port, timeout):
+        """提交授权请求（非阻塞）"""
+        self._queue.put(('add', ip, port, timeout, time.monotonic()))
+
+    def submit_revoke(self, ip, port):
+        """提交撤销请求（非阻塞）"""
+        self._queue.put(('del', ip, port, 0, time.monotonic()))
+
+    def schedule_revoke(self, ip, port, delay):
+        """为已生效的授权安排delay秒后撤销，用于恢复上一个进程的授权，须在 start() 之前调用"""
+        self._schedule(ip, port, time.monotonic() + max(0.0, delay))
+
+    def _schedule(self, ip, port, deadline):
+        self._expiry[(ip, port)] = deadline
+        heapq.heappush(self._timers, (deadline, ip, port))
+
+    def pending(self):
+        """队列中等待处理的请求数"""
+        return self._queue.qsize()
+
+    def stats(self):
+        """工作线程统计快照"""
+        return {
+            'queue_depth': self.pending(),
+            'scheduled_revocations': len(self._expiry),
+            'applied': self.applied,
+            'failed': self.failed,
+            'grant_latency': self.latency.snapshot(),
+        }
+
+    def _collect(self):
+        """等待下一批请求，最长等到最近一次撤销到期"""
+        wait = None
+        if self._timers:
+            wait = max(0.0, self._timers[0][0] - time.monotonic())
+        items = []
+        try:
+            items.append(self._queue.get(timeout=wait))
+        except queue.Empty:
+            pass
+        while len(items) < self.batch_size:
+            try:
+                items.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        now = time.monotonic()
+        while self._timers and self._timers[0][0] <= now:
+            deadline, ip, port = heapq.heappop(self._timers)
+            if self._expiry.get((ip, port)) == deadline:
+                del self._expiry[(ip, port)]
+                items.append(('del', ip, port, 0, now))
+        return items
+
+    def _apply(self, items):
+        ops = [item[:4] for item in items]
+        try:
+            self.backend.apply(ops)
+            results = [(item, None) for item in items]
+        except FirewallError as e:
+            if e.failed is not None:
+                results = [(item, e.failed.get(i)) for i, item in enumerate(items)]
+            elif len(items) == 1:
+                results = [(items[0], e)]
+            else:
+                # 后端无法定位失败项时逐条重试，只在这一层重试
+                results = []
+                for item in items:
+                    try:
+                        self.backend.apply([item[:4]])
+                        results.append((item, None))
+                    except FirewallError as err:
+                        results.append((item, err))
+
+        done = time.monotonic()
+        for (action, ip, port, timeout, enqueued), error in results:
+            if error is not None:
+                self.failed += 1
+                if action == 'add':
+                    logger.error("防火墙添加失败: %s", error)
+                    if self.on_failed:
+                        self.on_failed(ip, port)
+                else:
+                    logger.error("防火墙规则移除失败: %s", error)
+                continue
+
+            self.applied += 1
+            if self.journal is not None:
+                if action == 'add':
+                    self.journal.record_grant(ip, port, time.time() + timeout)
+                else:
+                    self.journal.record_revoke(ip, port)
+            if action == 'add':
+                latency = done - enqueued
+                self.latency.observe(latency)
+                logger.info("开放端口 %s 给 %s（认证到生效 %.1fms）", port, ip, latency * 1000)
+                if self.on_granted:
+                    self.on_granted(ip, port, latency)
+                if not self.backend.kernel_timeout:
+                    self._schedule(ip, port, done + timeout)
+            else:
+                logger.info("关闭 %s 对 %s端口 的访问权限", ip, port)
+                # 提前撤销的授权不再等待到期撤销，堆中的旧条目出堆时丢弃
+                self._expiry.pop((ip, port), None)
+                if self.on_revoked:
+                    self.on_revoked(ip, port)
+
+    def _run(self):
+        while not self._stopping.is_set() or not self._queue.empty():
+            items = [item for item in self._collect() if item is not None]
+            if items:
+                self._apply(items)
+                self._flush_journal()
+
+    def _flush_journal(self):
+        if self.journal is None:
+            return
+        try:
+            self.journal.flush()
+        except OSError as e:
+            logger.error("写入授权日志失败: %s", e)
+
+    def stop(self, revoke_pending=True, timeout=10):
+        """停止工作线程
+
+        Args:
+            revoke_pending: 是否立即撤销尚未到期的授权，避免进程退出后残留规则
+            timeout: 等待线程退出的最长时间（秒）
+        """
+        self._stopping.set()
+        self._queue.put(None)
+        self._thread.join(timeout)
+        if revoke_pending and self._expiry:
+            now = time.monotonic()
+            self._apply([('del', ip, port, 0, now) for ip, port in list(self._expiry)])
+            self._timers = []
+            self._expiry = {}
+        if self.journal is not None:
+            try:
+                self.journal.close()
+            except OSError as e:
+                logger.error("写入授权日志失败: %s", e)
@@ -0,0 +1,171 @@
+# coding:utf-8
+"""
+端口敲门监听限流与封禁模块
+
+位于 KnockStateMachine 之前，对每个数据包做 O(1) 的准入检查：
+- 按源地址和源网段（IPv4 /24、IPv6 /64）分别做令牌桶限流
+- 统计源地址的失败次数（步骤错误、超时、密码错误），超过阈值后短期封禁
+
+令牌桶和失败计数都存放在固定大小、按哈希取槽的数组中，内存占用与来源数量无关；
+哈希冲突的来源会共享同一个槽，表足够大时对正常客户端的影响可以忽略。
+封禁表有上限，满时淘汰最早的封禁记录。
+
+源地址统一使用压缩的二进制形式（IPv4 4字节、IPv6 16字节，见 address_key()）作为键，
+IPv4和IPv6走同一条代码路径，取网段只需切片。
+"""
+
+import logging
+import socket
+from array import array
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+def address_key(ip):
+    """把文本形式的IPv4/IPv6地址转换为二进制形式的键"""
+    if ':' in ip:
+        return socket.inet_pton(socket.AF_INET6, ip)
+    return socket.inet_aton(ip)
+
+
+def format_address(key):
+    """address_key() 的逆操作，用于日志等非热路径"""
+    return socket.inet_ntop(socket.AF_INET6 if len(key) == 16 else socket.AF_INET, key)
+
+
+class HashedTokenBuckets:
+    """固定大小的哈希令牌桶表
+
+    Attributes:
+        rate: 每秒补充的令牌数
+        burst: 桶容量
+    """
+
+    def __init__(self, rate, burst, size=65536):
+        """
+        Args:
+            rate: 每秒补充的令牌数
+            burst: 桶容量（允许的突发量）
+            size: 槽数量，向上取整为2的幂
+        """
+        size = 1 << max(size - 1, 1).bit_length()
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.mask = size - 1
+        self.tokens = array('d', [self.burst]) * size
+        self.stamps = array('d', [0.0]) * size
+
+    def take(self, key, now, amount=1.0):
+        """尝试从key对应的桶中取出amount个令牌
+
+        Returns:
+            bool: 令牌充足返回True，否则返回False
+        """
+        i = hash(key) & self.mask
+        tokens = self.tokens[i] + (now - self.stamps[i]) * self.rate
+        if tokens > self.burst:
+            tokens = self.burst
+        self.stamps[i] = now
+        if tokens < amount:
+            self.tokens[i] = tokens
+            return False
+        self.tokens[i] = tokens - amount
+        return True
+
+
+class KnockGuard:
+    """敲门监听准入控制
+
+    Attributes:
+        rate_limited: 因限流丢弃的包数
+        ban_dropped: 因封禁丢弃的包数
+        bans: 累计封禁次数
+    """
+
+    def __init__(self, rate=20, burst=40, subnet_rate=200, subnet_burst=400,
+                 ban_threshold=10, ban_window=60, ban_time=300,
+                 table_size=65536, max_bans=4096):
+        """
+        Args:
+            rate: 单个源地址每秒允许的包数，0表示不限流
+            burst: 单个源地址允许的突发包数
+            subnet_rate: 单个源网段每秒允许的包数，0表示不限流
+            subnet_burst: 单个源网段允许的突发包数
+            ban_threshold: ban_window秒内允许的失败次数，超过后封禁，0表示不封禁
+            ban_window: 失败计数的时间窗口（秒）
+            ban_time: 封禁时长（秒）
+            table_size: 令牌桶表的槽数量
+            max_bans: 封禁表的最大条目数
+        """
+        self.ip_buckets = HashedTokenBuckets(rate, burst, table_size) if rate > 0 else None
+        self.subnet_buckets = HashedTokenBuckets(subnet_rate, subnet_burst, table_size) if subnet_rate > 0 else None
+        # 失败计数同样用令牌桶表示：每次失败消耗一个令牌，按 阈值/窗口 的速度恢复
+        self.failures = (HashedTokenBuckets(ban_threshold / ban_window, ban_threshold, table_size)
+                         if ban_threshold > 0 else None)
+        self.ban_time = ban_time
+        self.max_bans = max_bans
+        self.banned = OrderedDict()
+        self.rate_limited = 0
+        self.ban_dropped = 0
+        self.bans = 0
+
+    @staticmethod
+    def subnet_of(ip):
+        """返回源地址所属网段的键（IPv4 /24、IPv6 /64）"""
+        return ip[:3] if len(ip) == 4 else ip[:8]
+
+    def allow(self, ip, now):
+        """判断来自ip的数据包是否进入状态机
+
+        Args:
+            ip: 源地址（address_key() 的二进制形式，下同）
+            now: 当前时间戳
+
+        Returns:
+            bool: 允许处理返回True
+        """
+        if self.banned:
+            expires = self.banned.get(ip)
+            if expires is not None:
+                if expires > now:
+                    self.ban_dropped += 1
+                    return False
+                del self.banned[ip]
+
+        if self.subnet_buckets is not None and not self.subnet_buckets.take(self.subnet_of(ip), now):
+            self.rate_limited += 1
+            return False
+        if self.ip_buckets is not None and not self.ip_buckets.take(ip, now):
+            self.rate_limited += 1
+            return False
+        return True
+
+    def record_failure(self, ip, now):
+        """记录一次认证失败，超过阈值时封禁该源地址
+
+        Returns:
+            bool: 本次是否触发封禁
+        """
+        if self.failures is None or self.failures.take(ip, now):
+            return False
+        self.ban(ip, now)
+        return True
+
+    def ban(self, ip, now):
+        """封禁源地址 ban_time 秒"""
+        if ip not in self.banned and len(self.banned) >= self.max_bans:
+            self.banned.popitem(last=False)
+        self.banned[ip] = now + self.ban_time
+        self.banned.move_to_end(ip)
+        self.bans += 1
+        logger.warning("源地址 %s 失败次数过多，封禁 %s 秒", format_address(ip), self.ban_time)
+
+    def stats(self):
+        """准入控制统计快照"""
+        return {
+            'rate_limited': self.rate_limited,
+            'ban_dropped': self.ban_dropped,
+            'bans': self.bans,
+            'banned_now': len(self.banned),
+        }
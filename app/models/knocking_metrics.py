@@ -0,0 +1,219 @@
+# coding:utf-8
+"""
+端口敲门监听进程指标模块
+
+提供轻量的计数器、仪表和直方图，可按 Prometheus 文本格式输出，也可导出为JSON快照
+供管理端或多进程分片模式的主进程汇总，汇总后的快照可再用 render_snapshot 输出为文本格式。指标更新只涉及字典和列表操作，可以在数据包处理路径上调用。
+"""
+
+import bisect
+from threading import Lock
+
+
+def _label_text(names, values):
+    if not names:
+        return ''
+    pairs = ','.join(f'{name}="{value}"' for name, value in zip(names, values))
+    return '{' + pairs + '}'
+
+
+class Metric:
+    """指标基类
+
+    Attributes:
+        name: 指标名称
+        help: 指标说明
+        labels: 标签名元组
+    """
+    type = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+
+    def samples(self):
+        """返回 [(标签值元组, 数值)] 列表"""
+        raise NotImplementedError
+
+    def render(self):
+        return _render_samples(self.name, self.help, self.type, self.snapshot())
+
+    def snapshot(self):
+        return [{'labels': dict(zip(self.labels, values)), 'value': value}
+                for values, value in self.samples()]
+
+
+class Counter(Metric):
+    """单调递增计数器
+
+    数据包处理线程递增计数时可能新增标签组合，控制接口线程同时在遍历输出，两者共用一把锁。
+    """
+    type = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        super().__init__(name, help, labels)
+        self.values = {}
+        self.lock = Lock()
+
+    def inc(self, *labelvalues, amount=1):
+        with self.lock:
+            self.values[labelvalues] = self.values.get(labelvalues, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            items = list(self.values.items())
+        return sorted(items)
+
+
+class CallbackMetric(Metric):
+    """取值时调用函数的指标，用于暴露其他组件已经维护的统计量
+
+    回调返回单个数值，或 {标签值元组: 数值} 字典。
+    """
+
+    def __init__(self, name, help, fn, labels=(), type='gauge'):
+        super().__init__(name, help, labels)
+        self.fn = fn
+        self.type = type
+
+    def samples(self):
+        value = self.fn()
+        if isinstance(value, dict):
+            return sorted(value.items())
+        return [((), value)]
+
+
+class Histogram(Metric):
+    """固定分桶的直方图"""
+    type = 'histogram'
+
+    DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+    def __init__(self, name, help, buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help)
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.lock = Lock()
+
+    def observe(self, value):
+        with self.lock:
+            self.counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.count += 1
+            self.sum += value
+
+    def samples(self):
+        return [((), self.count)]
+
+    def render(self):
+        return _render_histogram(self.name, self.help, self.snapshot())
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'count': self.count,
+                'sum': self.sum,
+                'buckets': dict(zip([str(b) for b in self.buckets + ('+Inf',)], self.counts)),
+            }
+
+
+class MetricsRegistry:
+    """指标注册表"""
+
+    def __init__(self, prefix='knock_'):
+        self.prefix = prefix
+        self.metrics = []
+
+    def _register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self._register(Counter(self.prefix + name, help, labels))
+
+    def gauge_fn(self, name, help, fn, labels=()):
+        return self._register(CallbackMetric(self.prefix + name, help, fn, labels, 'gauge'))
+
+    def counter_fn(self, name, help, fn, labels=()):
+        return self._register(CallbackMetric(self.prefix + name, help, fn, labels, 'counter'))
+
+    def histogram(self, name, help, buckets=Histogram.DEFAULT_BUCKETS):
+        return self._register(Histogram(self.prefix + name, help, buckets))
+
+    def render(self):
+        """按Prometheus文本格式输出全部指标"""
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+    def snapshot(self):
+        """导出 {指标名: {type, help, value}} 形式的JSON快照"""
+        return {metric.name: {'type': metric.type, 'help': metric.help, 'value': metric.snapshot()}
+                for metric in self.metrics}
+
+
+def _render_samples(name, help, type, samples):
+    lines = [f"# HELP {name} {help}", f"# TYPE {name} {type}"]
+    for sample in samples:
+        labels = sample['labels']
+        lines.append(f"{name}{_label_text(labels.keys(), labels.values())} {sample['value']}")
+    return lines
+
+
+def _render_histogram(name, help, value):
+    lines = [f"# HELP {name} {help}", f"# TYPE {name} histogram"]
+    cumulative = 0
+    for bound, count in value['buckets'].items():
+        cumulative += count
+        lines.append(f'{name}_bucket{{le="{bound}"}} {cumulative}')
+    lines.append(f"{name}_sum {value['sum']}")
+    lines.append(f"{name}_count {value['count']}")
+    return lines
+
+
+def render_snapshot(snapshot):
+    """把 snapshot()/merge_snapshots() 的结果输出为Prometheus文本格式"""
+    lines = []
+    for name, metric in snapshot.items():
+        help = metric.get('help', '')
+        if metric['type'] == 'histogram':
+            lines.extend(_render_histogram(name, help, metric['value']))
+        else:
+            lines.extend(_render_samples(name, help, metric['type'], metric['value']))
+    return '\n'.join(lines) + '\n'
+
+
+def merge_snapshots(snapshots):
+    """合并多个监听进程的JSON快照，同名同标签的数值相加
+
+    Args:
+        snapshots: MetricsRegistry.snapshot() 结果的列表
+
+    Returns:
+        dict: 与单个快照格式相同的汇总结果
+    """
+    merged = {}
+    for snapshot in snapshots:
+        for name, metric in snapshot.items():
+            value = metric['value']
+            if metric['type'] == 'histogram':
+                total = merged.setdefault(name, {'type': 'histogram', 'help': metric.get('help', ''),
+                                                 'value': {'count': 0, 'sum': 0.0, 'buckets': {}}})['value']
+                total['count'] += value['count']
+                total['sum'] += value['sum']
+                for bound, count in value['buckets'].items():
+                    total['buckets'][bound] = total['buckets'].get(bound, 0) + count
+                continue
+            entry = merged.setdefault(name, {'type': metric['type'], 'help': metric.get('help', ''), 'value': []})
+            index = {tuple(sorted(s['labels'].items())): s for s in entry['value']}
+            for sample in value:
+                key = tuple(sorted(sample['labels'].items()))
+                if key in index:
+                    index[key]['value'] += sample['value']
+                else:
+                    index[key] = {'labels': dict(sample['labels']), 'value': sample['value']}
+                    entry['value'].append(index[key])
+    return merged
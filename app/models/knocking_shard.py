@@ -0,0 +1,356 @@
+# coding:utf-8
+"""
+端口敲门监听多进程分片模块
+
+单个Python进程的抓包回调只能用满一个CPU核。分片模式（knocking_cmd.py --workers N）下：
+- 主进程只负责抓包：从原始套接字读取以太网帧，不做scapy解析，按源地址所在的网段（IPv4 /24、IPv6 /64）
+  哈希到 N 个工作进程之一，同一批次的帧合并后通过管道发送
+- 每个工作进程持有一个完整的 KnockStateMachine，负责解析数据包、推进状态机和开放防火墙，
+  各自只看到自己那部分来源，客户端状态表天然互不相交，同一来源的包保持原有顺序
+- 按网段而不是单个地址分片，使按源网段限流（knocking_guard.py）在分片后依然准确
+
+内核的 PACKET_FANOUT_HASH 按完整流（源、目的地址和端口）计算哈希，同一客户端敲不同端口的包会
+落到不同套接字上，无法保证状态机所需的按来源有序，因此这里由主进程显式分发。
+
+主进程的控制套接字把 /reload、/pause、/resume 等请求转发给每个工作进程的控制套接字
+（<控制套接字路径>.<分片号>），并把 /stats、/metrics、/grants 的结果合并后返回，
+管理端无需区分是否启用了分片。
+
+本模块只依赖标准库，既被 knocking_cmd.py 以脚本方式导入，也可以包方式导入。
+"""
+
+import logging
+import multiprocessing
+import select
+import socket
+import struct
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from logging.handlers import QueueListener
+from urllib.parse import urlencode
+
+try:
+    from .knocking_control import ControlClient, ControlError
+    from .knocking_metrics import merge_snapshots, render_snapshot
+except ImportError:
+    # 作为 knocking_cmd.py 的同目录模块导入
+    from knocking_control import ControlClient, ControlError
+    from knocking_metrics import merge_snapshots, render_snapshot
+
+logger = logging.getLogger(__name__)
+
+_ETH_IPV4 = b'\x08\x00'
+_ETH_IPV6 = b'\x86\xdd'
+_ETH_VLAN = (b'\x81\x00', b'\x88\xa8')
+_LENGTH = struct.Struct('!I')
+
+
+class ShardError(Exception):
+    """工作进程异常退出"""
+
+
+def shard_key(frame):
+    """取以太网帧的分片键：IPv4源地址的前3个字节（/24网段）或IPv6源地址的前8个字节（/64网段），
+    其他帧返回None"""
+    offset = 12
+    ethertype = frame[offset:offset + 2]
+    while ethertype in _ETH_VLAN:
+        offset += 4
+        ethertype = frame[offset:offset + 2]
+    if ethertype == _ETH_IPV4:
+        src, size, prefix = offset + 2 + 12, 4, 3
+    elif ethertype == _ETH_IPV6:
+        src, size, prefix = offset + 2 + 8, 16, 8
+    else:
+        return None
+    if len(frame) < src + size:
+        return None
+    return frame[src:src + prefix]
+
+
+def shard_of_address(ip, shards):
+    """文本形式的源地址所属的分片号，与 ShardDispatcher.dispatch() 的分发结果一致"""
+    packed = socket.inet_pton(socket.AF_INET6, ip) if ':' in ip else socket.inet_aton(ip)
+    return zlib.crc32(packed[:3] if len(packed) == 4 else packed[:8]) % shards
+
+
+def encode_batch(frames):
+    """把一批帧编码为 长度+内容 的连续字节串"""
+    return b''.join(_LENGTH.pack(len(frame)) + frame for frame in frames)
+
+
+def decode_batch(data):
+    """encode_batch 的逆操作"""
+    view = memoryview(data)
+    offset = 0
+    while offset < len(view):
+        (length,) = _LENGTH.unpack_from(view, offset)
+        offset += _LENGTH.size
+        yield bytes(view[offset:offset + length])
+        offset += length
+
+
+def receive_frames(conn):
+    """工作进程从管道读取帧，主进程发送空消息或管道关闭时结束"""
+    while True:
+        try:
+            data = conn.recv_bytes()
+        except (EOFError, OSError):
+            return
+        if not data:
+            return
+        yield from decode_batch(data)
+
+
+class _ForwardHandler(logging.Handler):
+    """把工作进程经队列送来的日志记录交给主进程的同名日志器处理"""
+
+    def emit(self, record):
+        logging.getLogger(record.name).handle(record)
+
+
+class ShardDispatcher:
+    """主进程侧的抓包分发器
+
+    Attributes:
+        shards: 工作进程数
+        dispatched: 已分发的帧数
+        skipped: 非IP等无法分片而丢弃的帧数
+    """
+
+    def __init__(self, target, args, shards, batch_size=64):
+        """
+        Args:
+            target: 工作进程入口 target(分片号, args, 接收管道, 日志队列)，须为模块级函数
+            args: 传给工作进程的命令行参数
+            shards: 工作进程数
+            batch_size: 单个分片攒够多少帧立即发送，否则在套接字读空时发送
+        """
+        self.target = target
+        self.args = args
+        self.shards = shards
+        self.batch_size = batch_size
+        self.dispatched = 0
+        self.skipped = 0
+        # spawn方式启动，避免fork时复制主进程中日志等后台线程持有的锁
+        self._ctx = multiprocessing.get_context('spawn')
+        self.log_queue = self._ctx.Queue()
+        self._log_listener = QueueListener(self.log_queue, _ForwardHandler())
+        self._procs = []
+        self._conns = []
+        self._buffers = [[] for _ in range(shards)]
+
+    def start(self):
+        self._log_listener.start()
+        for index in range(self.shards):
+            reader, writer = self._ctx.Pipe(duplex=False)
+            proc = self._ctx.Process(target=self.target, args=(index, self.args, reader, self.log_queue),
+                                     name=f'knock-shard-{index}')
+            proc.start()
+            reader.close()
+            self._procs.append(proc)
+            self._conns.append(writer)
+        logger.info("已启动 %s 个分片工作进程: %s", self.shards, ', '.join(str(p.pid) for p in self._procs))
+        return self
+
+    def dispatch(self, frame):
+        key = shard_key(frame)
+        if key is None:
+            self.skipped += 1
+            return
+        index = zlib.crc32(key) % self.shards
+        buffer = self._buffers[index]
+        buffer.append(frame)
+        self.dispatched += 1
+        if len(buffer) >= self.batch_size:
+            self._send(index)
+
+    def _send(self, index):
+        buffer = self._buffers[index]
+        if buffer:
+            self._conns[index].send_bytes(encode_batch(buffer))
+            buffer.clear()
+
+    def flush(self):
+        for index in range(self.shards):
+            self._send(index)
+
+    def check(self):
+        """工作进程退出时抛出 ShardError，由主进程整体退出后交给进程管理重启"""
+        for index, proc in enumerate(self._procs):
+            if not proc.is_alive():
+                raise ShardError(f"分片工作进程 {index}({proc.pid}) 已退出，退出码 {proc.exitcode}")
+
+    def serve(self, sock, check_interval=1.0):
+        """从抓包套接字读取帧并分发，直到工作进程异常或主进程被中断
+
+        Args:
+            sock: scapy的 L2listen 套接字，使用其底层原始套接字 sock.ins
+            check_interval: 检查工作进程存活的间隔（秒）
+        """
+        ins = sock.ins
+        ins.setblocking(False)
+        next_check = time.monotonic() + check_interval
+        while True:
+            readable, _, _ = select.select([ins], [], [], check_interval)
+            if readable:
+                # 读空套接字后统一发送，负载高时自然形成批次，空闲时不增加延迟
+                for _ in range(4096):
+                    try:
+                        frame, address = ins.recvfrom(65535)
+                    except (BlockingIOError, InterruptedError):
+                        break
+                    if address[2] != socket.PACKET_OUTGOING:
+                        self.dispatch(frame)
+                self.flush()
+            if time.monotonic() >= next_check:
+                self.check()
+                next_check = time.monotonic() + check_interval
+
+    def close(self, timeout=10):
+        """通知工作进程退出并等待，超时后强制结束"""
+        for index, conn in enumerate(self._conns):
+            try:
+                self._send(index)
+                conn.send_bytes(b'')
+            except OSError:
+                pass
+            conn.close()
+        deadline = time.monotonic() + timeout
+        for proc in self._procs:
+            proc.join(max(0.0, deadline - time.monotonic()))
+        for proc in self._procs:
+            if proc.is_alive():
+                logger.error("分片工作进程 %s 未按时退出，强制结束", proc.pid)
+                proc.kill()
+                proc.join()
+        self._log_listener.stop()
+
+
+def sum_stats(items):
+    """逐项相加多个统计字典中的数值，非数值字段取第一个"""
+    result = {}
+    for item in items:
+        for key, value in item.items():
+            if key not in result:
+                result[key] = dict(value) if isinstance(value, dict) else value
+            elif isinstance(value, dict):
+                result[key] = sum_stats([result[key], value])
+            elif isinstance(value, (int, float)) and not isinstance(value, bool):
+                result[key] += value
+    return result
+
+
+class ShardedControl:
+    """主进程控制接口：转发给各工作进程并合并结果"""
+
+    def __init__(self, sockets, paused=False, paused_filter=None, on_filter_changed=None):
+        """
+        Args:
+            sockets: 各工作进程的控制套接字路径
+            paused: 启动时是否处于停用状态
+            paused_filter: 停用时抓包套接字使用的BPF过滤器
+            on_filter_changed: 过滤器变化时的回调 on_filter_changed(新过滤器)
+        """
+        self.clients = [ControlClient(path) for path in sockets]
+        self.paused = paused
+        self.paused_filter = paused_filter
+        self.on_filter_changed = on_filter_changed
+        self.started = time.time()
+        self._pool = ThreadPoolExecutor(max_workers=len(self.clients), thread_name_prefix='shard-control')
+
+    def _all(self, method, path, body=None):
+        """并发向全部工作进程发送请求"""
+        return list(self._pool.map(lambda client: client.request(method, path, body), self.clients))
+
+    @staticmethod
+    def _route(fn):
+        def handler(query, body):
+            try:
+                return 200, fn(query, body)
+            except ControlError as e:
+                return e.status or 502, {'msg': str(e)}
+        return handler
+
+    def _filter_changed(self, bpf):
+        if self.on_filter_changed is not None:
+            self.on_filter_changed(bpf)
+
+    def stats(self, query=None, body=None):
+        shards = self._all('GET', '/stats')
+        return {
+            'rule_id': shards[0].get('rule_id'),
+            'pid': [shard['pid'] for shard in shards],
+            'uptime': round(time.time() - self.started, 1),
+            'paused': self.paused,
+            'rules': shards[0].get('rules'),
+            'paused_rules': shards[0].get('paused_rules'),
+            'shards': len(shards),
+            'metrics': merge_snapshots([shard['metrics'] for shard in shards]),
+            'guard': sum_stats([shard['guard'] for shard in shards]),
+            'firewall': sum_stats([shard['firewall'] for shard in shards]),
+        }
+
+    def metrics(self, query, body):
+        return render_snapshot(self.stats()['metrics'])
+
+    def _apply(self, result, paused):
+        """按工作进程返回的状态更新停用标志和抓包过滤器，paused 为工作进程未返回状态时的默认值"""
+        self.paused = result.get('paused', paused)
+        self._filter_changed(self.paused_filter if self.paused else result['bpf_filter'])
+        return result
+
+    def reload(self, query, body):
+        return self._apply(sum_stats(self._all('POST', '/reload', body or {})), self.paused)
+
+    def pause(self, query, body):
+        return self._apply(sum_stats(self._all('POST', '/pause', body or {})), True)
+
+    def resume(self, query, body):
+        return self._apply(sum_stats(self._all('POST', '/resume', body or {})), False)
+
+    def remove(self, query, body):
+        return self._apply(sum_stats(self._all('DELETE', '/rules?' + urlencode(
+            [('rule_id', rule_id) for rule_id in query.get('rule_id', [])[:1]]))), self.paused)
+
+    def grants(self, query, body):
+        try:
+            offset = int(query.get('offset', ['0'])[0])
+            limit = int(query['limit'][0]) if 'limit' in query else None
+        except ValueError:
+            raise ControlError('offset和limit必须为整数', 400)
+        if offset < 0 or (limit is not None and limit < 0):
+            raise ControlError('offset和limit不能为负数', 400)
+        params = {key: query[key][0] for key in ('ip', 'rule_id') if query.get(key)}
+        if limit is not None:
+            # 每个分片都可能贡献前 offset+limit 条，合并排序后再分页
+            params['limit'] = offset + limit
+        shards = self._all('GET', '/grants?' + urlencode(params) if params else '/grants')
+        grants = sorted((grant for shard in shards for grant in shard['grants']),
+                        key=lambda grant: grant['expires_at'])
+        end = None if limit is None else offset + limit
+        return {'total': sum(shard['total'] for shard in shards), 'grants': grants[offset:end]}
+
+    def revoke(self, query, body):
+        ips = query.get('ip', [])
+        if not ips:
+            raise ControlError('缺少参数ip', 400)
+        params = [('ip', ip) for ip in ips] + [('rule_id', rule_id) for rule_id in query.get('rule_id', [])[:1]]
+        return sum_stats(self._all('DELETE', '/grants?' + urlencode(params)))
+
+    def routes(self):
+        """控制接口路由表，与单进程模式的 KnockStateMachine.control_routes() 一致"""
+        return {
+            ('GET', '/metrics'): self._route(self.metrics),
+            ('GET', '/stats'): self._route(self.stats),
+            ('POST', '/reload'): self._route(self.reload),
+            ('POST', '/pause'): self._route(self.pause),
+            ('POST', '/resume'): self._route(self.resume),
+            ('DELETE', '/rules'): self._route(self.remove),
+            ('GET', '/grants'): self._route(self.grants),
+            ('DELETE', '/grants'): self._route(self.revoke),
+        }
+
+    def close(self):
+        self._pool.shutdown(wait=False)
@@ -9,68 +9,57 @@
 - 添加新的敲门规则
 - 删除现有规则
 - 查询所有规则
-- 管理规则进程的生命周期
+- 批量启用/停用规则
+- 通过 KnockingSupervisor 管理规则监听进程的生命周期
+- 汇总各监听进程的运行指标
+- 查询和立即撤销规则当前开放的授权
+- 分页查询敲门审计事件
+- 单个或批量下载客户端脚本
 
 """
 
 # 导入所需的模块和依赖
-from .. import db
+from .. import db, supervisor, script_generator
 from ..base import base
-from flask import request, jsonify, send_file
+from flask import Response, request, jsonify, stream_with_context
 from flask_login import login_required, current_user
 from werkzeug.security import generate_password_hash
-import subprocess
-import os
-import psutil
 import logging
 import hashlib
-import signal
+from datetime import datetime
+from urllib.parse import urlencode
 from ..models.KnockingRule import KnockingRule
-from ..models.ScriptGenerator import ScriptGenerator
+from ..models.KnockingEvent import KnockingEvent
+from ..models.knocking_control import ControlClient, ControlError
+from ..models.knocking_metrics import merge_snapshots
 from .. import permission
-from psutil import Process, NoSuchProcess
 
-# 进程信息存储路径
-PID_FILE_DIR = '/var/run/authbase_knocking/'  # 存储规则进程PID的目录
-LOG_FILE = '/var/log/authbase/knocking.log'   # 日志文件路径
+# 支持的最终包认证方式
+AUTH_MODES = ('md5', 'totp')
 
-# 确保PID文件目录和日志目录存在，并设置正确的权限
-def ensure_directories():
-    """确保必要的目录存在并具有正确的权限
-    
-    该函数负责创建和配置端口敲门服务所需的目录结构，包括：
-    1. PID文件存储目录 (/var/run/authbase_knocking/)
-    2. 日志文件目录 (/var/log/authbase/)
-    
-    目录权限设置：
-    - PID目录: 755 (用户完全访问，组和其他用户只读和执行)
-    - 日志文件: 644 (用户读写，组和其他用户只读)
-    
-    Raises:
-        OSError: 当目录创建或权限设置失败时抛出
-        Exception: 其他未预期的错误
-    """
-    try:
-        # 创建PID文件目录
-        if not os.path.exists(PID_FILE_DIR):
-            os.makedirs(PID_FILE_DIR, mode=0o755, exist_ok=True)
-        
-        # 创建日志目录
-        log_dir = os.path.dirname(LOG_FILE)
-        if not os.path.exists(log_dir):
-            os.makedirs(log_dir, mode=0o755, exist_ok=True)
-            
-        # 设置日志文件权限
-        if not os.path.exists(LOG_FILE):
-            open(LOG_FILE, 'a').close()
-        os.chmod(LOG_FILE, 0o644)
-        
-    except Exception as e:
-        logging.error(f"创建目录失败: {str(e)}")
-        raise
+# 规则状态（0停用 1正常）
+RULE_STATUSES = ('0', '1')
+
+# 客户端脚本类型
+SCRIPT_TYPES = ('python', 'exe', 'bash')
+# 批量下载客户端脚本时单次最多生成的脚本数
+MAX_BUNDLE_SCRIPTS = 500
 
-# 初始化目录
-ensure_directories()
+
+def get_internal_ip():
+    """获取服务器内网IP地址，失败时返回127.0.0.1"""
+    import socket
+    try:
+        # 创建一个UDP socket
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        # 连接一个外部地址（不需要真实连接）
+        s.connect(("8.8.8.8", 80))
+        # 获取本地socket的IP地址
+        ip = s.getsockname()[0]
+        s.close()
+        return ip
+    except Exception:
+        return "127.0.0.1"
 
 
 @base.route('/addrules', methods=['POST'])
@@ -89,11 +78,13 @@ def add_knocking_rule():
         time_window (int): 完成端口序列的最大等待时间（秒）
         timeout (int): 认证成功后规则的有效期（秒）
         password (str): 认证密码，将被安全哈希存储
+        authMode (str, optional): 认证方式，md5（默认，静态密码哈希）或totp（时间片一次性令牌）
+        status (str, optional): 规则状态，1正常（默认，立即启动监听）或0停用
         remark (str, optional): 规则说明备注
         
     Returns:
         JSON响应：
-        - 成功：{"status": "success", "pid": 进程ID}
+        - 成功：{"status": "success", "pid": 进程ID}，停用的规则pid为null
         - 失败：{"error": 错误信息}
         
     Status Codes:
@@ -109,13 +100,19 @@ def add_knocking_rule():
         'target_port': data.get('targetPort'),
         'time_window': data.get('timeWindow'),
         'timeout': data.get('timeout'),
-        'password': hashlib.md5(data.get('password', '').encode('utf-8')).hexdigest()
+        'password': hashlib.md5(data.get('password', '').encode('utf-8')).hexdigest(),
+        'auth_mode': data.get('authMode') or 'md5',
+        'status': str(data.get('status') or '1')
     }
 
     # 参数验证
     required_fields = ['portSequence', 'targetPort', 'timeWindow', 'timeout', 'password']
     if not all(field in data for field in required_fields):
         return jsonify({"error": "Missing required fields"}), 400
+    if mapped_data['auth_mode'] not in AUTH_MODES:
+        return jsonify({'code': 400, 'msg': '无效的认证方式'}), 400
+    if mapped_data['status'] not in RULE_STATUSES:
+        return jsonify({'code': 400, 'msg': '无效的规则状态'}), 400
 
     try:
         # 生成安全密码
@@ -141,6 +138,8 @@ def add_knocking_rule():
             time_window=mapped_data['time_window'],
             timeout=mapped_data['timeout'],
             password_hash=mapped_data['password'],
+            auth_mode=mapped_data['auth_mode'],
+            status=mapped_data['status'],
             create_by=current_user.LOGINNAME,
             remark=data.get('remark')
         )
@@ -149,57 +148,15 @@ def add_knocking_rule():
         # 记录操作日志（带用户信息）
         logging.info(f"用户 {current_user.LOGINNAME} 添加敲门规则：{data}")
 
-        # 构造命令
-        cmd = [
-            # 'sudo',  # 需要root权限
-            'python3',
-            os.path.join(os.path.dirname(os.path.dirname(__file__)), 'models', 'knocking_cmd.py'),
-            '-pl', mapped_data['port_sequence'],
-            '-p', str(mapped_data['target_port']),
-            '-w', str(mapped_data['time_window']),
-            '-t', str(mapped_data['timeout']),
-            '-passwd', mapped_data['password']
-        ]
-
-        pid_file = os.path.join(PID_FILE_DIR, f"{rule_id}.pid")
-        
-        # 检查是否已有相同规则的进程在运行
-        if os.path.exists(pid_file):
-            try:
-                with open(pid_file, 'r') as f:
-                    pid = int(f.read().strip())
-                process = psutil.Process(pid)
-                # 如果进程存在且在运行，直接返回成功
-                return jsonify({
-                    "status": "success",
-                    "message": "规则已在运行中",
-                    "pid": pid
-                }), 200
-            except (psutil.NoSuchProcess, FileNotFoundError):
-                # 如果进程不存在，删除过期的PID文件
-                os.remove(pid_file)
-
-        # 启动新进程
-        process = subprocess.Popen(
-            cmd,
-            stdout=open(LOG_FILE, 'a'),
-            stderr=subprocess.STDOUT,
-            # 在Windows系统中使用CREATE_NEW_PROCESS_GROUP替代setsid
-            creationflags=subprocess.CREATE_NEW_PROCESS_GROUP if os.name == 'nt' else 0
-        )
-
-        # 记录PID
-        with open(pid_file, 'w') as f:
-            f.write(str(process.pid))
-
-        # 提交数据库事务
+        # 提交数据库事务后由监听进程管理器启动监听进程，停用的规则不启动
         db.session.commit()
+        pid = supervisor.start(rule) if rule.status == '1' else None
 
         return jsonify({
             'code': 200,
             'msg': '规则添加成功',
             'data': {
-                'pid': process.pid
+                'pid': pid
             }
         }), 201
 
@@ -210,140 +167,25 @@ def add_knocking_rule():
         return jsonify({"error": str(e)}), 500
 
 
-def stop_knocking_service(pid_file=None):
+def stop_knocking_service(rule_id=None, wait=False, revoke=False):
     """停止运行中的服务
-    
-    停止指定的端口敲门认证服务进程，或者停止所有运行中的服务进程。
-    该函数会尝试优雅地终止进程，并清理相关的PID文件。
-    
+
+    停止指定规则的监听进程，或者并行停止所有监听进程。停止后监听进程管理器不再自动拉起。
+    默认在后台完成SIGTERM、有界等待和SIGKILL，不阻塞当前请求。
+
     Args:
-        pid_file: 特定规则的PID文件路径，如果为None则停止所有规则进程
-        
-    Note:
-        - 如果指定的进程不存在，会清理对应的PID文件
-        - 对于所有进程的停止操作都会记录到日志中
-        - 进程终止使用SIGTERM信号，给予进程清理资源的机会
-    """
-    def kill_process(pid):
-        """实际执行进程终止的内部函数"""
-        try:
-            # 1. 首先尝试优雅终止(SIGTERM)
-            os.kill(pid, signal.SIGTERM)
-            logging.info(f"向进程 {pid} 发送SIGTERM信号请求优雅退出")
-            
-            # 等待最多5秒让进程自行退出
-            for _ in range(10):
-                try:
-                    os.kill(pid, 0)  # 检查进程是否存在
-                except ProcessLookupError:
-                    logging.info(f"进程 {pid} 已正常退出")
-                    return True
-            
-            # 2. 如果5秒后仍未退出，强制终止(SIGKILL)
-            logging.warning(f"进程 {pid} 未响应SIGTERM，将发送SIGKILL强制终止")
-            os.kill(pid, 9)  # 使用数字9代替SIGKILL,在Windows和Linux上都有效
-            
-            # 再次检查是否终止
-            try:
-                os.kill(pid, 0)
-                logging.error(f"无法终止进程 {pid}")
-                return False
-            except ProcessLookupError:
-                logging.info(f"进程 {pid} 已被强制终止")
-                return True
-                
-        except ProcessLookupError:
-            logging.info(f"进程 {pid} 已不存在")
-            return True
-        except PermissionError:
-            logging.error(f"权限不足，无法终止进程 {pid}")
-            return False
-        except Exception as e:
-            logging.error(f"终止进程 {pid} 时发生意外错误: {str(e)}")
-            return False
+        rule_id: 规则ID，如果为None则停止所有规则进程
+        wait: 是否等待进程全部退出
+        revoke: 是否先撤销指定规则已开放的授权（删除规则时使用）
 
+    Returns:
+        bool: wait为True时表示进程是否均已退出，否则表示停止请求是否已提交
+    """
     try:
-        # 情况1: 停止指定PID文件对应的进程
-        if pid_file and os.path.exists(pid_file):
-            with open(pid_file, 'r') as f:
-                pid = int(f.read().strip())
-            
-            logging.info(f"准备停止进程 {pid} (来自PID文件: {pid_file})")
-            
-            # 检查进程是否确实存在且是我们的敲门服务
-            try:
-                proc = Process(pid)
-                cmdline = ' '.join(proc.cmdline())
-                if 'knocking_cmd.py' not in cmdline:
-                    logging.warning(f"PID {pid} 不是敲门服务进程，实际命令: {cmdline}")
-                    os.remove(pid_file)
-                    return False
-            except NoSuchProcess:
-                logging.info(f"进程 {pid} 已不存在，清理PID文件")
-                os.remove(pid_file)
-                return True
-            
-            # 实际终止进程
-            result = kill_process(pid)
-            
-            # 无论成功与否都尝试清理PID文件
-            try:
-                os.remove(pid_file)
-            except:
-                pass
-                
-            return result
-        
-        # 情况2: 停止所有敲门服务进程
-        elif pid_file is None and os.path.exists(PID_FILE_DIR):
+        if rule_id is None:
             logging.info("准备停止所有敲门服务进程")
-            success = True
-            for filename in os.listdir(PID_FILE_DIR):
-                if filename.endswith('.pid'):
-                    pid_path = os.path.join(PID_FILE_DIR, filename)
-                    try:
-                        with open(pid_path, 'r') as f:
-                            pid = int(f.read().strip())
-                        
-                        logging.info(f"准备停止进程 {pid} (来自PID文件: {filename})")
-                        
-                        # 检查进程是否属于我们的服务
-                        try:
-                            proc = Process(pid)
-                            cmdline = ' '.join(proc.cmdline())
-                            if 'knocking_cmd.py' not in cmdline:
-                                logging.warning(f"跳过非敲门服务进程 {pid}")
-                                continue
-                        except NoSuchProcess:
-                            logging.info(f"进程 {pid} 已不存在，清理PID文件")
-                            try:
-                                os.remove(pid_path)
-                            except:
-                                pass
-                            continue
-                        
-                        # 终止进程
-                        if not kill_process(pid):
-                            success = False
-                        
-                        # 清理PID文件
-                        try:
-                            os.remove(pid_path)
-                        except:
-                            pass
-                            
-                    except Exception as e:
-                        logging.error(f"处理PID文件 {filename} 时出错: {str(e)}")
-                        success = False
-                        continue
-            
-            return success
-        
-        # 情况3: 无效参数
-        else:
-            logging.warning("无效的PID文件路径或PID目录不存在")
-            return False
-            
+            return supervisor.stop_all(wait=wait)
+        return supervisor.stop(rule_id, wait=wait, revoke=revoke)
     except Exception as e:
         logging.error(f"停止服务时发生未预期错误: {str(e)}")
         return False
@@ -373,34 +215,22 @@ def delete_knocking_rule(rule_id):
     try:
         # 查找并删除数据库记录
         rule = KnockingRule.query.get(rule_id)
-        if rule:
-            db.session.delete(rule)
-
-        # 构造PID文件路径
-        pid_file = os.path.join(PID_FILE_DIR, f"{rule_id}.pid")
-        
-        # 检查规则是否存在
-        if not os.path.exists(pid_file):
-            if not rule:
-                return jsonify({
-                    'code': 404,
-                    'msg': '规则不存在'
-                }), 404
-            # 如果数据库记录存在但进程不存在，只删除数据库记录
-            db.session.commit()
+        if not rule:
             return jsonify({
-                'code': 200,
-                'msg': '规则已删除'
-            }), 200
-            
-        # 停止进程并删除PID文件
-        stop_knocking_service(pid_file)
-        
+                'code': 404,
+                'msg': '规则不存在'
+            }), 404
+        db.session.delete(rule)
+
+        # 撤销已开放的授权并停止监听进程
+        stop_knocking_service(rule_id, revoke=True)
+
         # 记录操作日志
         logging.info(f"用户 {current_user.LOGINNAME} 删除敲门规则：{rule_id}")
         
         # 提交数据库事务
         db.session.commit()
+        script_generator.invalidate(rule_id)
         
         return jsonify({
             'code': 200,
@@ -432,6 +262,7 @@ def list_knocking_rules():
             - timeout: 超时时间
             - status: 规则状态
             - create_time: 创建时间
+            - process: 监听进程状态（alive、pid、uptime、restarts、lastExitCode）
             等完整信息
         - 失败：{"error": 错误信息}
         
@@ -444,20 +275,232 @@ def list_knocking_rules():
         return jsonify({
             'code': 200,
             'msg': '获取成功',
-            'data': [rule.to_json() for rule in rules]
+            'data': [dict(rule.to_json(), process=supervisor.status(rule.id)) for rule in rules]
         })
     except Exception as e:
         logging.error(f"获取规则列表失败: {str(e)}")
         return jsonify({'code': 500, 'msg': str(e)}), 500
 
 
+@base.route('/knocking/events', methods=['GET'])
+@login_required
+@permission('monitor:knocking:list')
+def list_knocking_events():
+    """分页查询敲门审计事件
+
+    按事件时间倒序返回，过滤条件均命中 sys_knocking_event 上以 event_time 结尾的联合索引。
+
+    Query Parameters:
+        ruleId: 规则ID，可选
+        sourceIp: 源地址，可选，精确匹配
+        eventType: 事件类型，可选（success/auth_failed/timeout/invalid_step/banned/revoked）
+        beginTime: 开始时间，可选，格式YYYY-MM-DD HH:MM:SS
+        endTime: 结束时间，可选，格式YYYY-MM-DD HH:MM:SS
+        pageNum: 页码，默认1
+        pageSize: 每页记录数，默认10
+
+    Returns:
+        JSON响应：
+        - 成功：{"code": 200, "rows": [...], "total": 总数}
+        - 失败：{"code": 错误码, "msg": 错误信息}
+
+    Status Codes:
+        200: 获取成功
+        400: 时间格式错误
+        500: 服务器内部错误
+    """
+    filters = []
+    if request.args.get('ruleId'):
+        filters.append(KnockingEvent.rule_id == request.args['ruleId'])
+    if request.args.get('sourceIp'):
+        filters.append(KnockingEvent.source_ip == request.args['sourceIp'])
+    if request.args.get('eventType'):
+        filters.append(KnockingEvent.event_type == request.args['eventType'])
+    try:
+        if request.args.get('beginTime'):
+            filters.append(KnockingEvent.event_time >= datetime.strptime(request.args['beginTime'], '%Y-%m-%d %H:%M:%S'))
+        if request.args.get('endTime'):
+            filters.append(KnockingEvent.event_time <= datetime.strptime(request.args['endTime'], '%Y-%m-%d %H:%M:%S'))
+    except ValueError:
+        return jsonify({'code': 400, 'msg': '时间格式应为YYYY-MM-DD HH:MM:SS'}), 400
+
+    page = request.args.get('pageNum', 1, type=int)
+    rows = request.args.get('pageSize', 10, type=int)
+    try:
+        pagination = KnockingEvent.query.filter(*filters).order_by(
+            KnockingEvent.event_time.desc(), KnockingEvent.id.desc()).paginate(
+            page=page, per_page=rows, error_out=False)
+        return jsonify({
+            'code': 200,
+            'msg': '获取成功',
+            'rows': [event.to_json() for event in pagination.items],
+            'total': pagination.total
+        })
+    except Exception as e:
+        logging.error(f"查询敲门事件失败: {str(e)}")
+        return jsonify({'code': 500, 'msg': str(e)}), 500
+
+
+@base.route('/knocking/metrics', methods=['GET'])
+@login_required
+@permission('monitor:knocking:list')
+def knocking_metrics():
+    """汇总各规则监听进程的运行指标
+
+    依次访问每条规则所在监听进程的控制套接字读取 /stats，返回逐条规则的统计和全部规则的合计。
+    共用一个监听进程的规则只读取一次，统计为整个监听进程的数据，合计中只计入一次。
+    未运行或无法访问的规则在结果中标记为不可达，不影响其他规则。
+
+    Returns:
+        JSON响应：
+        - 成功：{"code": 200, "data": {"rules": [...], "totals": {...}}}
+            rules中每项包含 ruleId、reachable，可达时还包含 pid、uptime、paused（该规则是否已停用）、
+            rules（同一监听进程服务的规则ID）、metrics、guard、firewall
+            totals为所有可达规则的指标合计，格式与单条规则的metrics相同
+        - 失败：{"code": 500, "msg": 错误信息}
+
+    Status Codes:
+        200: 获取成功
+        500: 服务器内部错误
+    """
+    try:
+        rules = KnockingRule.query.all()
+        results = []
+        listeners = {}
+        for rule in rules:
+            path = supervisor.control_socket_path(rule.id)
+            if path not in listeners:
+                try:
+                    stats = ControlClient(path, timeout=1.0).get('/stats')
+                    stats.pop('rule_id', None)
+                except ControlError as e:
+                    logging.debug(f"读取规则 {rule.id} 指标失败: {str(e)}")
+                    stats = None
+                listeners[path] = stats
+            stats = listeners[path]
+            if stats is None:
+                results.append({'ruleId': rule.id, 'reachable': False})
+                continue
+            paused_rules = stats.get('paused_rules')
+            paused = stats['paused'] if paused_rules is None else rule.id in paused_rules
+            results.append(dict(stats, ruleId=rule.id, reachable=True, paused=paused))
+
+        return jsonify({
+            'code': 200,
+            'msg': '获取成功',
+            'data': {
+                'rules': results,
+                'totals': merge_snapshots([stats['metrics'] for stats in listeners.values() if stats is not None])
+            }
+        })
+    except Exception as e:
+        logging.error(f"获取敲门指标失败: {str(e)}")
+        return jsonify({'code': 500, 'msg': str(e)}), 500
+
+
+def format_timestamp(ts):
+    return datetime.fromtimestamp(ts).strftime('%Y-%m-%d %H:%M:%S') if ts else None
+
+
+@base.route('/rules/<rule_id>/grants', methods=['GET'])
+@login_required
+@permission('monitor:knocking:list')
+def list_rule_grants(rule_id):
+    """查询规则当前开放的授权
+
+    数据来自监听进程内存中的授权记录（控制套接字 GET /grants），不查询防火墙。
+    多条规则共用一个监听进程时只返回该规则开放的授权。
+
+    Args:
+        rule_id: 规则ID
+
+    Query Parameters:
+        ip: 源地址前缀，可选
+        pageNum: 页码，默认1
+        pageSize: 每页记录数，默认10
+
+    Returns:
+        JSON响应：
+        - 成功：{"code": 200, "rows": [...], "total": 总数}
+            rows中每项包含 sourceIp、targetPort、grantedAt、expiresAt、remaining（剩余秒数），
+            监听进程重启后接管的授权没有 grantedAt
+        - 失败：{"code": 错误码, "msg": 错误信息}
+
+    Status Codes:
+        200: 获取成功
+        404: 规则不存在
+        503: 监听进程未运行或无法访问
+    """
+    if KnockingRule.query.get(rule_id) is None:
+        return jsonify({'code': 404, 'msg': '规则不存在'}), 404
+    page = max(request.args.get('pageNum', 1, type=int), 1)
+    rows = max(request.args.get('pageSize', 10, type=int), 1)
+    query = {'rule_id': rule_id, 'offset': (page - 1) * rows, 'limit': rows}
+    if request.args.get('ip'):
+        query['ip'] = request.args['ip']
+    try:
+        result = ControlClient(supervisor.control_socket_path(rule_id)).get('/grants?' + urlencode(query))
+    except ControlError as e:
+        logging.warning(f"读取规则 {rule_id} 授权失败: {str(e)}")
+        return jsonify({'code': 503, 'msg': '监听进程未运行或无法访问'}), 503
+
+    now = datetime.now().timestamp()
+    return jsonify({
+        'code': 200,
+        'msg': '获取成功',
+        'rows': [{
+            'sourceIp': grant['ip'],
+            'targetPort': grant['port'],
+            'grantedAt': format_timestamp(grant['granted_at']),
+            'expiresAt': format_timestamp(grant['expires_at']),
+            'remaining': max(0, int(grant['expires_at'] - now)),
+        } for grant in result['grants']],
+        'total': result['total']
+    })
+
+
+@base.route('/rules/<rule_id>/grants/<ip>', methods=['DELETE'])
+@login_required
+@permission('monitor:knocking:edit')
+def revoke_rule_grant(rule_id, ip):
+    """立即撤销规则对某个源地址开放的授权
+
+    Args:
+        rule_id: 规则ID
+        ip: 源地址
+
+    Returns:
+        JSON响应：
+        - 成功：{"code": 200, "msg": "授权已撤销", "data": {"revoked": 撤销的授权数}}
+        - 失败：{"code": 错误码, "msg": 错误信息}
+
+    Status Codes:
+        200: 撤销成功
+        404: 规则不存在或该地址没有授权
+        503: 监听进程未运行或无法访问
+    """
+    if KnockingRule.query.get(rule_id) is None:
+        return jsonify({'code': 404, 'msg': '规则不存在'}), 404
+    try:
+        result = ControlClient(supervisor.control_socket_path(rule_id)).delete(
+            '/grants?' + urlencode({'ip': ip, 'rule_id': rule_id}))
+    except ControlError as e:
+        logging.warning(f"撤销规则 {rule_id} 授权失败: {str(e)}")
+        return jsonify({'code': 503, 'msg': '监听进程未运行或无法访问'}), 503
+    if not result['revoked']:
+        return jsonify({'code': 404, 'msg': '该地址没有开放的授权'}), 404
+
+    logging.info(f"用户 {current_user.LOGINNAME} 撤销规则 {rule_id} 对 {ip} 的授权")
+    return jsonify({'code': 200, 'msg': '授权已撤销', 'data': result})
+
+
 @base.route('/rules/<rule_id>', methods=['PUT'])
 @login_required
 @permission('monitor:knocking:edit')
 def update_knocking_rule(rule_id):
     """修改敲门规则
     
-    修改指定的端口敲门规则，包括更新规则参数和重启监听进程。
+    修改指定的端口敲门规则，更新规则参数后热更新监听进程（失败时回退为重启）。
     该操作需要登录权限，并且会记录操作日志。
     
     Args:
@@ -469,11 +512,13 @@ def update_knocking_rule(rule_id):
         time_window (int): 完成端口序列的最大等待时间（秒）
         timeout (int): 认证成功后规则的有效期（秒）
         password (str): 认证密码，将被安全哈希存储
+        authMode (str, optional): 认证方式，md5（静态密码哈希）或totp（时间片一次性令牌），不提供时保持不变
+        status (str, optional): 规则状态，1正常或0停用，不提供时保持不变
         remark (str, optional): 规则说明备注
         
     Returns:
         JSON响应：
-        - 成功：{"code": 200, "msg": "规则修改成功", "data": {"pid": 进程ID}}
+        - 成功：{"code": 200, "msg": "规则修改成功", "data": {"process": 监听进程状态}}
         - 失败：{"code": 错误码, "msg": 错误信息}
         
     Status Codes:
@@ -490,7 +535,8 @@ def update_knocking_rule(rule_id):
         'target_port': data.get('targetPort'),
         'time_window': data.get('timeWindow'),
         'timeout': data.get('timeout'),
-        'password': hashlib.md5(data.get('password', '').encode('utf-8')).hexdigest()
+        'password': hashlib.md5(data.get('password', '').encode('utf-8')).hexdigest(),
+        'auth_mode': data.get('authMode')
     }
     
     # 参数验证
@@ -500,6 +546,10 @@ def update_knocking_rule(rule_id):
             'code': 400,
             'msg': '缺少必要的参数'
         }), 400
+    if 'authMode' in data and mapped_data['auth_mode'] not in AUTH_MODES:
+        return jsonify({'code': 400, 'msg': '无效的认证方式'}), 400
+    if 'status' in data and str(data['status']) not in RULE_STATUSES:
+        return jsonify({'code': 400, 'msg': '无效的规则状态'}), 400
 
     try:
         # 查找规则
@@ -516,52 +566,27 @@ def update_knocking_rule(rule_id):
         rule.time_window = mapped_data['time_window']
         rule.timeout = mapped_data['timeout']
         rule.password_hash = mapped_data['password']
+        if 'authMode' in data:
+            rule.auth_mode = mapped_data['auth_mode']
         rule.update_by = current_user.LOGINNAME
+        if 'status' in data:
+            rule.status = str(data['status'])
         if 'remark' in data:
             rule.remark = data['remark']
 
-        # 构造PID文件路径
-        pid_file = os.path.join(PID_FILE_DIR, f"{rule_id}.pid")
-        
-        # 停止原有进程
-        if os.path.exists(pid_file):
-            stop_knocking_service(pid_file)
-
-        # 构造新的命令
-        cmd = [
-            # 'sudo',
-            'python3',
-            os.path.join(os.path.dirname(os.path.dirname(__file__)), 'models', 'knocking_cmd.py'),
-            '-pl', mapped_data['port_sequence'],
-            '-p', str(mapped_data['target_port']),
-            '-w', str(mapped_data['time_window']),
-            '-t', str(mapped_data['timeout']),
-            '-passwd', mapped_data['password']
-        ]
-
-        # 启动新进程
-        process = subprocess.Popen(
-            cmd,
-            stdout=open(LOG_FILE, 'a'),
-            stderr=subprocess.STDOUT,
-            creationflags=subprocess.CREATE_NEW_PROCESS_GROUP if os.name == 'nt' else 0
-        )
-
-        # 记录新的PID
-        with open(pid_file, 'w') as f:
-            f.write(str(process.pid))
-
         # 记录操作日志
         logging.info(f"用户 {current_user.LOGINNAME} 修改敲门规则：{rule_id}")
         
-        # 提交数据库事务
+        # 提交数据库事务后按规则状态热更新或暂停监听进程，无法热更新时在后台重启
         db.session.commit()
+        supervisor.sync(rule)
+        script_generator.invalidate(rule_id)
 
         return jsonify({
             'code': 200,
             'msg': '规则修改成功',
             'data': {
-                'pid': process.pid
+                'process': supervisor.status(rule_id)
             }
         })
 
@@ -575,6 +600,61 @@ def update_knocking_rule(rule_id):
         }), 500
 
 
+@base.route('/rules/status', methods=['PUT'])
+@login_required
+@permission('monitor:knocking:edit')
+def change_knocking_rules_status():
+    """批量启用或停用敲门规则
+
+    在同一个数据库事务中修改所有规则的状态，提交后由监听进程管理器并发地暂停或恢复
+    对应的监听进程。停用的规则保留监听进程但不再处理敲门，并撤销已开放的授权。
+
+    Json Parameters:
+        ids (list): 规则ID列表
+        status (str): 目标状态，1启用或0停用
+
+    Returns:
+        JSON响应：
+        - 成功：{"code": 200, "msg": "状态修改成功", "data": {"updated": 修改的规则数, "process": {规则ID: 监听进程状态}}}
+        - 失败：{"code": 错误码, "msg": 错误信息}
+
+    Status Codes:
+        200: 修改成功
+        400: 请求参数无效
+        500: 服务器内部错误
+    """
+    data = request.get_json() or {}
+    ids = data.get('ids')
+    status = str(data.get('status'))
+    if not isinstance(ids, list) or not ids:
+        return jsonify({'code': 400, 'msg': '缺少规则ID列表'}), 400
+    if status not in RULE_STATUSES:
+        return jsonify({'code': 400, 'msg': '无效的规则状态'}), 400
+
+    try:
+        rules = KnockingRule.query.filter(KnockingRule.id.in_(ids)).all()
+        for rule in rules:
+            rule.status = status
+            rule.update_by = current_user.LOGINNAME
+        db.session.commit()
+
+        supervisor.set_enabled(rules, status == '1')
+        logging.info(f"用户 {current_user.LOGINNAME} {'启用' if status == '1' else '停用'}敲门规则：{[r.id for r in rules]}")
+
+        return jsonify({
+            'code': 200,
+            'msg': '状态修改成功',
+            'data': {
+                'updated': len(rules),
+                'process': {rule.id: supervisor.status(rule.id) for rule in rules}
+            }
+        })
+    except Exception as e:
+        db.session.rollback()
+        logging.error(f"修改规则状态失败: {str(e)}")
+        return jsonify({'code': 500, 'msg': str(e)}), 500
+
+
 @base.route('/script/<rule_id>/<script_type>', methods=['GET'])
 @login_required
 @permission('monitor:knocking:script')
@@ -606,10 +686,11 @@ def generate_client_script(rule_id, script_type):
     Response Headers:
         Content-Type: application/octet-stream
         Content-Disposition: attachment; filename=<script_name>
+        Content-Length: 文件大小
     
     Status Codes:
         200: 脚本生成成功并开始下载
-        400: 无效的脚本类型
+        400: 无效的脚本类型或目标主机
         404: 指定的规则不存在
         500: 服务器内部错误
     
@@ -626,7 +707,7 @@ def generate_client_script(rule_id, script_type):
     """
     try:
         # 验证脚本类型
-        if script_type not in ['python', 'exe', 'bash']:
+        if script_type not in SCRIPT_TYPES:
             return jsonify({
                 'code': 400,
                 'msg': '无效的脚本类型'
@@ -640,49 +721,28 @@ def generate_client_script(rule_id, script_type):
                 'msg': '规则不存在'
             }), 404
 
-        # 获取服务器IP地址
-        def get_internal_ip():
-            import socket
-            try:
-                # 创建一个UDP socket
-                s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-                # 连接一个外部地址（不需要真实连接）
-                s.connect(("8.8.8.8", 80))
-                # 获取本地socket的IP地址
-                ip = s.getsockname()[0]
-                s.close()
-                return ip
-            except Exception:
-                return "127.0.0.1"
-
         # 优先使用请求参数中的host，如果没有则使用服务器内网IP
         host = request.args.get('host', get_internal_ip())
+        try:
+            host = script_generator.normalize_host(host)
+        except ValueError as e:
+            return jsonify({
+                'code': 400,
+                'msg': str(e)
+            }), 400
 
 
-        # 初始化脚本生成器
-        generator = ScriptGenerator()
-
-        # 根据类型生成脚本
-        if script_type == 'python':
-            script_path = generator.generate_python_script(host, rule.port_sequence)
-            filename = 'knockclient.py'
-        elif script_type == 'exe':
-            script_path = generator.generate_exe_package(host, rule.port_sequence)
-            filename = 'knockclient_exe.zip'
-        else:  # bash
-            script_path = generator.generate_bash_script(host, rule.port_sequence)
-            filename = 'knockclient.sh'
+        # 在内存中生成脚本，同一规则、主机和类型的结果会被缓存
+        parts, filename = script_generator.build(rule, host, script_type)
 
         # 记录操作日志
         logging.info(f"用户 {current_user.LOGINNAME} 下载了规则 {rule_id} 的 {script_type} 客户端脚本")
 
-        # 返回文件
-        return send_file(
-            script_path,
-            as_attachment=True,
-            download_name=filename,
-            mimetype='application/octet-stream'
-        )
+        # 返回文件，EXE程序包的公共部分直接输出，不再复制拼接
+        response = Response(parts, mimetype='application/octet-stream')
+        response.headers.set('Content-Disposition', 'attachment', filename=filename)
+        response.content_length = sum(len(part) for part in parts)
+        return response
 
     except Exception as e:
         logging.error(f"生成客户端脚本失败: {str(e)}")
@@ -690,3 +750,64 @@ def generate_client_script(rule_id, script_type):
             'code': 500,
             'msg': str(e)
         }), 500
+
+
+@base.route('/script/bundle', methods=['POST'])
+@login_required
+@permission('monitor:knocking:script')
+def generate_client_bundle():
+    """批量下载多条规则、多个目标主机的客户端脚本
+
+    为每个 (规则, 目标主机, 脚本类型) 组合并发生成客户端脚本，按完成顺序流式写入一个ZIP文件，
+    ZIP内路径为 <规则ID>/<目标主机>/<脚本文件名>，IPv6地址中的冒号替换为下划线；
+    目标主机必须是IP地址或主机名，否则返回400，不会出现在脚本和ZIP路径中。
+    生成失败的脚本不会中断下载，失败原因写入ZIP中的 errors.txt。
+
+    Json Parameters:
+        ids (list): 规则ID列表
+        hosts (list, optional): 目标服务器IP地址或主机名列表，默认为服务器内网IP
+        types (list, optional): 脚本类型列表，可选 python、exe、bash，默认为全部
+
+    Returns:
+        flask.Response: knockclient_bundle.zip 文件下载响应（分块传输）
+
+    Status Codes:
+        200: 开始下载
+        400: 请求参数无效或脚本数量超过上限
+        404: 部分规则不存在
+        500: 服务器内部错误
+    """
+    data = request.get_json() or {}
+    ids = data.get('ids')
+    hosts = data.get('hosts') or [get_internal_ip()]
+    script_types = data.get('types') or list(SCRIPT_TYPES)
+    if not isinstance(ids, list) or not ids:
+        return jsonify({'code': 400, 'msg': '缺少规则ID列表'}), 400
+    if not isinstance(hosts, list):
+        return jsonify({'code': 400, 'msg': '无效的目标主机列表'}), 400
+    # 目标主机会写入脚本和ZIP内路径，只接受IP地址或主机名，后续只使用规范化后的值
+    try:
+        hosts = [script_generator.normalize_host(host) for host in hosts]
+    except ValueError as e:
+        return jsonify({'code': 400, 'msg': str(e)}), 400
+    if not isinstance(script_types, list) or any(t not in SCRIPT_TYPES for t in script_types):
+        return jsonify({'code': 400, 'msg': '无效的脚本类型'}), 400
+    ids, hosts, script_types = list(dict.fromkeys(ids)), list(dict.fromkeys(hosts)), list(dict.fromkeys(script_types))
+    if len(ids) * len(hosts) * len(script_types) > MAX_BUNDLE_SCRIPTS:
+        return jsonify({'code': 400, 'msg': f'单次最多生成 {MAX_BUNDLE_SCRIPTS} 个脚本'}), 400
+
+    try:
+        rules = KnockingRule.query.filter(KnockingRule.id.in_(ids)).all()
+        missing = set(ids) - {rule.id for rule in rules}
+        if missing:
+            return jsonify({'code': 404, 'msg': f'规则不存在：{sorted(missing)}'}), 404
+
+        logging.info(f"用户 {current_user.LOGINNAME} 批量下载了规则 {ids} 在 {hosts} 上的 {script_types} 客户端脚本")
+
+        response = Response(stream_with_context(script_generator.iter_bundle(rules, hosts, script_types)),
+                            mimetype='application/zip')
+        response.headers.set('Content-Disposition', 'attachment', filename='knockclient_bundle.zip')
+        return response
+    except Exception as e:
+        logging.error(f"批量生成客户端脚本失败: {str(e)}")
+        return jsonify({'code': 500, 'msg': str(e)}), 500
@@ -1,17 +1,48 @@
 # coding:utf-8
-from scapy.all import *
+"""
+端口敲门客户端（命令行版本）
+
+两种发包方式（-e/--engine）：
+- socket: 普通套接字，不需要scapy、Npcap和管理员权限。TCP步骤用非阻塞 connect() 发出SYN，
+  UDP步骤用 sendto() 发送。SYN不能携带数据，因此最后一步为TCP的序列无法使用此方式
+- scapy: 原始套接字构造数据包（原有实现），最后一步可以是携带认证载荷的TCP包，需要管理员权限
+- auto（默认）: 最后一步为UDP时使用socket，否则使用scapy
+
+-H 可以用逗号分隔多个目标，所有目标在asyncio中并发敲门（--concurrency 限制同时进行的目标数），
+每个目标内部按顺序发送，相邻两步间隔 --delay 秒。
+
+--inventory 指定CSV或JSON格式的目标清单时进入批量模式，每个目标可以有各自的敲门序列、认证方式、
+密码来源和目标端口；敲门后对目标端口做TCP连接探测确认已开放，失败的目标按 --retries 重试，
+最后输出每个目标的结果和耗时汇总，有失败目标时退出码为1。清单格式见 load_inventory()。
+"""
+import asyncio
+import csv
+import errno
+import json
+import os
+import random
+import socket
 import time
 import hashlib
+import hmac
+import struct
 import argparse
 import sys
 import ctypes
 import traceback
+import unicodedata
 import logging
 from getpass import getpass
 
 # 配置Scapy日志级别
 logging.getLogger("scapy.runtime").setLevel(logging.ERROR)
 
+# 非阻塞connect()发出SYN后的正常返回值，WSAEWOULDBLOCK在Windows上即 errno.EWOULDBLOCK
+CONNECT_IN_PROGRESS = {0, errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY, errno.ECONNREFUSED}
+
+# 端口探测中单次连接尝试的最长等待时间（秒）
+PROBE_ATTEMPT_TIMEOUT = 1.0
+
 
 def check_admin():
     """检查Windows管理员权限"""
@@ -43,96 +74,463 @@ def parse_portlist(portlist_str):
     return sequence
 
 
+def parse_hosts(hosts_str):
+    """解析逗号分隔的目标列表，去除空项和重复项并保持顺序"""
+    hosts = list(dict.fromkeys(h.strip() for h in hosts_str.split(',') if h.strip()))
+    if not hosts:
+        raise ValueError("目标服务器不能为空")
+    return hosts
+
+
+def choose_engine(engine, knock_sequence):
+    """确定发包方式
+
+    Raises:
+        ValueError: socket方式无法发送最后一步的TCP认证载荷
+    """
+    final_tcp = knock_sequence[-1][1] == "TCP"
+    if engine == "auto":
+        return "scapy" if final_tcp else "socket"
+    if engine == "socket" and final_tcp:
+        raise ValueError("socket方式的TCP敲门只能发送SYN，无法携带认证载荷，最后一步为TCP时请使用 -e scapy")
+    return engine
+
+
 def build_packet(proto, server_ip, port, payload):
     """构建协议栈"""
+    from scapy.all import IP, TCP, UDP, Raw
+
     ip_layer = IP(
         dst=server_ip,
         proto=6 if proto == "TCP" else 17,
-        id=RandShort(),
+        id=random.getrandbits(16),
         flags="DF"
     )
 
     if proto == "TCP":
         transport_layer = TCP(
             dport=port,
-            sport=RandShort(),
+            sport=random.randint(1024, 65535),
             flags="PA" if payload else "S",
-            seq=RandInt(),
+            seq=random.getrandbits(32),
             window=2048
         )
     else:
         transport_layer = UDP(
             dport=port,
-            sport=RandShort()
+            sport=random.randint(1024, 65535)
         )
 
     return ip_layer / transport_layer / Raw(load=payload) if payload else ip_layer / transport_layer
 
 
-def send_knock(server_ip, knock_sequence, password_hash):
-    """执行端口敲门序列"""
-    try:
-        for i, (port, proto) in enumerate(knock_sequence):
-            try:
-                # 构造数据包
-                is_last = (i == len(knock_sequence) - 1)
-                payload = password_hash if is_last else (b"" if proto == "TCP" else b"knock_sequence")
+def build_auth_payload(password_hash, auth_mode="md5", totp_step=30):
+    """生成最终包认证载荷
+
+    md5模式直接发送密码MD5；totp模式发送 HMAC-SHA256(密码MD5, 当前时间片序号) 的前32位
+    """
+    if auth_mode == "totp":
+        counter = int(time.time() // totp_step)
+        return hmac.new(password_hash, struct.pack('>Q', counter), hashlib.sha256).hexdigest()[:32].encode()
+    return password_hash
+
+
+def send_knock(server_ip, knock_sequence, password_hash, auth_mode="md5", delay=0.3, verbose=True):
+    """使用scapy执行端口敲门序列
+
+    Raises:
+        OSError等: 发送失败，由调用方处理
+    """
+    from scapy.all import send
+
+    for i, (port, proto) in enumerate(knock_sequence):
+        if i:
+            time.sleep(delay)
+        is_last = (i == len(knock_sequence) - 1)
+        # totp令牌在发送最终包时才计算，避免跨越时间片
+        payload = build_auth_payload(password_hash, auth_mode) if is_last else None
+        send(build_packet(proto, server_ip, port, payload), verbose=0)
+        if verbose:
+            print(f"[✓] {proto} 端口 {port} 敲门成功")
 
-                pkt = build_packet(proto, server_ip, port, payload if is_last else None)
 
-                # 发送数据包
-                send(pkt, verbose=0)
-                print(f"[✓] {proto} 端口 {port} 敲门成功")
-                time.sleep(0.3)
+async def knock_host_socket(server, knock_sequence, password_hash, auth_mode="md5", delay=0.3, verbose=True):
+    """使用普通套接字执行端口敲门序列，支持IPv4和IPv6
 
-                pkt.show2()
+    TCP步骤只发出SYN，不等待连接结果：发出后立即以 SO_LINGER 0 关闭套接字，内核不再重传SYN，
+    避免重传的SYN在后续步骤之后到达服务端而被判为无效步骤。
+
+    Raises:
+        OSError: 域名解析或发送失败
+    """
+    loop = asyncio.get_running_loop()
+    family, _, _, _, sockaddr = (await loop.getaddrinfo(server, None, type=socket.SOCK_DGRAM))[0]
+    address, extra = sockaddr[0], sockaddr[2:]
+    for i, (port, proto) in enumerate(knock_sequence):
+        if i:
+            await asyncio.sleep(delay)
+        if proto == "TCP":
+            with socket.socket(family, socket.SOCK_STREAM) as sock:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+                sock.setblocking(False)
+                err = sock.connect_ex((address, port) + extra)
+                if err not in CONNECT_IN_PROGRESS:
+                    raise OSError(err, f"连接 {address}:{port} 失败")
+        else:
+            is_last = (i == len(knock_sequence) - 1)
+            payload = build_auth_payload(password_hash, auth_mode) if is_last else b''
+            with socket.socket(family, socket.SOCK_DGRAM) as sock:
+                sock.sendto(payload, (address, port) + extra)
+        if verbose:
+            print(f"[✓] {proto} 端口 {port} 敲门成功")
+
+
+async def knock_host(host, knock_sequence, password_hash, auth_mode="md5", engine="socket", delay=0.3,
+                     verbose=True):
+    """按指定发包方式对一个目标执行敲门序列，scapy方式在线程中执行"""
+    if engine == "socket":
+        await knock_host_socket(host, knock_sequence, password_hash, auth_mode, delay, verbose)
+    else:
+        await asyncio.to_thread(send_knock, host, knock_sequence, password_hash, auth_mode, delay, verbose)
 
+
+async def knock_all(hosts, knock_sequence, password_hash, auth_mode="md5", engine="socket",
+                    delay=0.3, concurrency=50):
+    """并发敲门多个目标，每个目标内部保持顺序
+
+    Returns:
+        dict: {目标: 错误信息}，成功的目标为None
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    verbose = len(hosts) == 1
+
+    async def knock(host):
+        async with semaphore:
+            try:
+                await knock_host(host, knock_sequence, password_hash, auth_mode, engine, delay, verbose)
             except Exception as e:
-                print(f"\n[×] {proto}/{port} 失败: {str(e)}")
-                print("可能原因排查:")
-                print("1. 检查Npcap/WinPcap驱动安装")
-                print("2. 确认防火墙允许原始套接字")
-                print("3. 验证目标IP和端口配置")
+                error = str(e) or e.__class__.__name__
+                print(f"[×] {host} 失败: {error}")
+                return host, error
+            if not verbose:
+                print(f"[✓] {host} 敲门序列已发送")
+            return host, None
+
+    return dict(await asyncio.gather(*(knock(host) for host in hosts)))
+
+
+def resolve_secret(ref, cache):
+    """按密码来源取得密码MD5，同一来源只读取一次
+
+    来源格式：
+    - 空或 prompt: 交互输入，所有使用该来源的目标共用
+    - prompt:<名称>: 按名称分别交互输入
+    - env:<变量名>: 读取环境变量中的明文密码
+    - file:<路径>: 读取文件第一行的明文密码
+
+    Raises:
+        ValueError: 来源无效或密码为空
+    """
+    ref = (ref or "prompt").strip()
+    if ref not in cache:
+        kind, _, name = ref.partition(":")
+        if kind == "prompt":
+            passwd = getpass(f"请输入{name + ' 的' if name else ''}认证密码(明文)：")
+        elif kind == "env":
+            if name not in os.environ:
+                raise ValueError(f"环境变量 {name} 未设置")
+            passwd = os.environ[name]
+        elif kind == "file":
+            try:
+                with open(name, encoding="utf-8") as f:
+                    passwd = f.readline()
+            except OSError as e:
+                raise ValueError(f"读取密码文件 {name} 失败: {str(e)}") from e
+        else:
+            raise ValueError(f"不支持的密码来源: {ref}")
+        passwd = passwd.strip()
+        if not passwd:
+            raise ValueError(f"密码来源 {ref} 的密码为空")
+        cache[ref] = hashlib.md5(passwd.encode()).hexdigest().encode()
+    return cache[ref]
+
+
+def load_inventory(path, auth_mode="md5", engine="auto", secrets=None):
+    """读取目标清单
+
+    CSV文件首行为列名，JSON文件为对象数组，字段：
+    - host: 目标IP地址或域名（必填）
+    - portlist: 敲门序列，格式同 -p（必填）
+    - secret: 密码来源，见 resolve_secret()，默认交互输入
+    - auth_mode: md5或totp，默认取 -m
+    - target_port: 敲门后探测的目标端口，为空时不探测
+
+    Returns:
+        list: 目标字典列表，包含 host、sequence、password_hash、auth_mode、engine、target_port
+
+    Raises:
+        ValueError: 清单格式或内容无效
+    """
+    secrets = {} if secrets is None else secrets
+    try:
+        with open(path, encoding="utf-8-sig", newline="") as f:
+            if path.lower().endswith(".json"):
+                rows = json.load(f)
+                if not isinstance(rows, list):
+                    raise ValueError("JSON清单必须为对象数组")
+            else:
+                rows = list(csv.DictReader(f))
+    except (OSError, json.JSONDecodeError, csv.Error) as e:
+        raise ValueError(f"读取清单 {path} 失败: {str(e)}") from e
+
+    targets = []
+    for index, row in enumerate(rows, 1):
+        try:
+            row = {str(k).strip(): str(v).strip() for k, v in row.items() if k is not None and v is not None}
+            if not row.get("host"):
+                raise ValueError("缺少host")
+            sequence = parse_portlist(row.get("portlist", ""))
+            mode = row.get("auth_mode") or auth_mode
+            if mode not in ("md5", "totp"):
+                raise ValueError(f"不支持的认证方式: {mode}")
+            target_port = int(row["target_port"]) if row.get("target_port") else None
+            targets.append({
+                "host": row["host"],
+                "sequence": sequence,
+                "password_hash": resolve_secret(row.get("secret"), secrets),
+                "auth_mode": mode,
+                "engine": choose_engine(engine, sequence),
+                "target_port": target_port,
+            })
+        except (AttributeError, ValueError) as e:
+            raise ValueError(f"清单第 {index} 项无效: {str(e)}") from e
+    if not targets:
+        raise ValueError("清单中没有目标")
+    return targets
+
+
+async def probe_port(host, port, timeout=3.0, interval=0.2):
+    """反复尝试TCP连接目标端口，直到连接成功或超时
+
+    服务端异步添加防火墙规则，敲门完成后端口可能稍晚才开放。规则生效前的SYN可能被丢弃，
+    等待内核重传会把检测推迟到1秒以后，因此每隔 interval 秒发起一次新的连接尝试，
+    之前的尝试继续等待，任一尝试成功即返回，检测到开放的时间与实际开放时间相差不超过 interval。
+    每次尝试最多等待 PROBE_ATTEMPT_TIMEOUT 秒，同时进行的尝试数有上限。
+
+    Returns:
+        bool: 是否在超时前连接成功
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    interval = max(interval, 0.01)
+    attempts = set()
+    try:
+        while True:
+            now = loop.time()
+            if now >= deadline:
                 return False
-        return True
-    except KeyboardInterrupt:
-        print("\n[!] 用户中止操作")
-        return False
+            attempts.add(asyncio.ensure_future(asyncio.wait_for(
+                asyncio.open_connection(host, port), min(deadline - now, PROBE_ATTEMPT_TIMEOUT))))
+            next_attempt = min(now + interval, deadline)
+            # 被拒绝的尝试很快结束，等到下一个间隔再发起新的尝试
+            while attempts and loop.time() < next_attempt:
+                done, attempts = await asyncio.wait(attempts, timeout=next_attempt - loop.time(),
+                                                    return_when=asyncio.FIRST_COMPLETED)
+                writers = [task.result()[1] for task in done if task.exception() is None]
+                for writer in writers:
+                    writer.close()
+                    try:
+                        await writer.wait_closed()
+                    except OSError:
+                        pass
+                if writers:
+                    return True
+            await asyncio.sleep(max(0.0, next_attempt - loop.time()))
+    finally:
+        for task in attempts:
+            task.cancel()
 
 
+async def run_inventory(targets, delay=0.3, concurrency=50, retries=2, deadline=3.0, progress=None):
+    """批量敲门：有界并发，失败重试，敲门后探测目标端口
 
-def main():
+    Args:
+        targets: 目标字典列表，见 load_inventory()
+        delay: 同一目标相邻两步的间隔（秒）
+        concurrency: 同时敲门的目标数
+        retries: 失败目标的重试次数
+        deadline: 最后一个敲门包发出后等待目标端口开放的最长时间（秒）
+        progress: 逐个目标输出进度的文件对象，默认标准输出
+
+    Returns:
+        list: 与targets顺序一致的结果字典，时间单位为毫秒：
+            host、target_port、engine、ok、attempts、error、
+            knock_ms（发送整个敲门序列的耗时）、open_ms（最后一个敲门包发出到端口可连接的耗时，
+            未探测时为None）、total_ms（开始敲门到确认成功的耗时）
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    progress = progress or sys.stdout
+
+    async def run(target):
+        host, port = target["host"], target["target_port"]
+        result = {"host": host, "target_port": port, "engine": target["engine"], "ok": False, "attempts": 0,
+                  "knock_ms": None, "open_ms": None, "total_ms": None, "error": None}
+        async with semaphore:
+            for attempt in range(retries + 1):
+                if attempt:
+                    await asyncio.sleep(min(2 ** (attempt - 1), 10))
+                result["attempts"] = attempt + 1
+                start = time.monotonic()
+                try:
+                    await knock_host(host, target["sequence"], target["password_hash"], target["auth_mode"],
+                                     target["engine"], delay, verbose=False)
+                except Exception as e:
+                    result["error"] = str(e) or e.__class__.__name__
+                    continue
+                sent = time.monotonic()
+                result["knock_ms"] = round((sent - start) * 1000, 1)
+                if port is not None and not await probe_port(host, port, deadline):
+                    result["error"] = f"目标端口 {port} 在 {deadline:g} 秒内未开放"
+                    continue
+                done = time.monotonic()
+                if port is not None:
+                    result["open_ms"] = round((done - sent) * 1000, 1)
+                result.update(ok=True, total_ms=round((done - start) * 1000, 1), error=None)
+                break
+        print(f"[{'✓' if result['ok'] else '×'}] {host}" + (f" {result['error']}" if result["error"] else ""),
+              file=progress)
+        return result
+
+    return await asyncio.gather(*(run(target) for target in targets))
+
+
+def percentile(values, q):
+    """取已排序列表的分位数（最近秩）"""
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+def display_width(text):
+    """终端显示宽度，中文等全角字符占两列"""
+    return sum(2 if unicodedata.east_asian_width(ch) in "WF" else 1 for ch in text)
+
+
+def format_summary(results):
+    """格式化批量敲门结果汇总表"""
+    def ms(value):
+        return f"{value:.0f}" if value is not None else "-"
+
+    header = ("目标", "结果", "次数", "敲门(ms)", "开放(ms)", "总耗时(ms)", "说明")
+    rows = [(r["host"], "成功" if r["ok"] else "失败", str(r["attempts"]),
+             ms(r["knock_ms"]), ms(r["open_ms"]), ms(r["total_ms"]), r["error"] or "")
+            for r in results]
+    widths = [max(display_width(row[i]) for row in [header] + rows) for i in range(len(header))]
+    lines = ["  ".join(cell + " " * (width - display_width(cell)) for cell, width in zip(row, widths)).rstrip()
+             for row in [header] + rows]
+    lines.insert(1, "  ".join("-" * width for width in widths))
+    ok = sum(1 for r in results if r["ok"])
+    lines.append(f"\n共 {len(results)} 个目标，成功 {ok}，失败 {len(results) - ok}")
+    opened = sorted(r["open_ms"] for r in results if r["open_ms"] is not None)
+    if opened:
+        lines.append(f"端口开放耗时: p50 {percentile(opened, 0.5):.0f}ms  p95 {percentile(opened, 0.95):.0f}ms  "
+                     f"最大 {opened[-1]:.0f}ms")
+    return "\n".join(lines)
+
+
+def run_batch(args, targets=None):
+    """批量模式入口，返回退出码
+
+    Args:
+        args: 命令行参数
+        targets: 已构造的目标列表（-H 配合 -t 或 --json 时），为None时读取 --inventory 清单
+    """
+    # JSON输出占用标准输出，进度和汇总改写到标准错误
+    out = sys.stderr if args.json else sys.stdout
     try:
-        # 检查Windows管理员权限
-        if sys.platform.startswith('win') and not check_admin():
-            print("[!] 请以管理员权限运行此程序")
-            input("按回车键退出...")
-            sys.exit(1)
+        if args.delay < 0 or args.concurrency < 1 or args.retries < 0 or args.deadline <= 0:
+            raise ValueError("--delay、--retries 不能为负数，--concurrency 至少为1，--deadline 必须大于0")
+        if targets is None:
+            targets = load_inventory(args.inventory, args.auth_mode, args.engine)
+    except ValueError as e:
+        print(f"[!] 参数错误: {str(e)}", file=out)
+        return 2
+
+    if any(t["engine"] == "scapy" for t in targets) and sys.platform.startswith('win') and not check_admin():
+        print("[!] 有目标需要scapy发包方式，请以管理员权限运行此程序", file=out)
+        return 1
 
+    print(f"\n🚪 开始批量敲门 {len(targets)} 个目标（并发 {args.concurrency}，重试 {args.retries} 次）...", file=out)
+    results = asyncio.run(run_inventory(targets, args.delay, args.concurrency, args.retries, args.deadline, out))
+    print(file=out)
+    print(format_summary(results), file=out)
+    if args.json:
+        json.dump(results, sys.stdout, ensure_ascii=False, indent=2)
+        print()
+    return 0 if all(r["ok"] for r in results) else 1
+
+
+def main():
+    try:
         # 命令行参数解析
         parser = argparse.ArgumentParser(
             description="安全端口敲门工具 - 支持TCP/UDP协议混合序列",
             add_help=False,
             formatter_class=argparse.RawTextHelpFormatter
         )
-        parser.add_argument("-H", "--host", dest="host", required=True,  # 修改短参数为-H
-                            help="目标服务器IP地址\n示例: 192.168.1.100")
-        parser.add_argument("-p", "--portlist", dest="portlist", required=True,
+        target = parser.add_mutually_exclusive_group(required=True)
+        target.add_argument("-H", "--host", dest="host",  # 修改短参数为-H
+                            help="目标服务器IP地址或域名，多个目标用逗号分隔\n示例: 192.168.1.100,192.168.1.101")
+        target.add_argument("-i", "--inventory", dest="inventory",
+                            help="批量模式的目标清单（.csv 或 .json）\n"
+                                 "字段: host,portlist,secret,auth_mode,target_port")
+        parser.add_argument("-p", "--portlist", dest="portlist",
                             help="敲门序列配置\n格式: 端口1:协议1,端口2:协议2\n示例: '4214:TCP,24161:UDP,6325:TCP'")
+        parser.add_argument("-m", "--auth-mode", dest="auth_mode", choices=("md5", "totp"), default="md5",
+                            help="认证方式（需与服务端规则一致）\nmd5: 静态密码哈希（默认）\ntotp: 时间片一次性令牌")
+        parser.add_argument("-e", "--engine", dest="engine", choices=("auto", "socket", "scapy"), default="auto",
+                            help="发包方式\nauto: 最后一步为UDP时使用socket，否则使用scapy（默认）\n"
+                                 "socket: 普通套接字，无需管理员权限\nscapy: 原始数据包，需要管理员权限")
+        parser.add_argument("-d", "--delay", dest="delay", type=float, default=0.3,
+                            help="同一目标相邻两步的间隔（秒），默认0.3")
+        parser.add_argument("-c", "--concurrency", dest="concurrency", type=int, default=50,
+                            help="同时敲门的目标数，默认50")
+        parser.add_argument("-r", "--retries", dest="retries", type=int, default=2,
+                            help="批量模式下失败目标的重试次数，默认2")
+        parser.add_argument("-t", "--target-port", dest="target_port", type=int,
+                            help="敲门后探测的目标端口，直到可以连接或超过 --deadline，\n"
+                                 "报告从最后一个敲门包到端口开放的耗时（批量模式下由清单指定）")
+        parser.add_argument("--deadline", "--probe-timeout", dest="deadline", type=float, default=3.0,
+                            help="最后一个敲门包发出后等待目标端口开放的最长时间（秒），默认3")
+        parser.add_argument("--json", dest="json", action="store_true",
+                            help="以JSON格式向标准输出输出每个目标的结果，进度信息改写到标准错误")
         parser.add_argument("--help", action="help", help="显示帮助信息")
 
         args = parser.parse_args()
 
-        # 解析敲门序列
+        if args.inventory:
+            sys.exit(run_batch(args))
+        if not args.portlist:
+            parser.error("使用 -H 时必须指定 -p/--portlist")
+
+        # 解析目标和敲门序列
         try:
+            hosts = parse_hosts(args.host)
             knock_sequence = parse_portlist(args.portlist)
+            engine = choose_engine(args.engine, knock_sequence)
+            if args.delay < 0 or args.concurrency < 1:
+                raise ValueError("--delay 不能为负数，--concurrency 至少为1")
         except ValueError as e:
             print(f"[!] 参数错误: {str(e)}")
             sys.exit(2)
 
+        # scapy方式在Windows上需要管理员权限
+        if engine == "scapy" and sys.platform.startswith('win') and not check_admin():
+            print("[!] 请以管理员权限运行此程序")
+            input("按回车键退出...")
+            sys.exit(1)
+
         # 密码处理（关键修改点）
         try:
-            print("为了安全考虑，输入的密码将不会显示在屏幕上")
+            print("为了安全考虑，输入的密码将不会显示在屏幕上", file=sys.stderr if args.json else sys.stdout)
             passwd = getpass("请输入认证密码(明文)：").strip()
             if not passwd:
                 raise ValueError("密码不能为空")
@@ -142,20 +540,40 @@ def main():
             print(f"[!] 密码处理失败: {str(e)}")
             sys.exit(3)
 
+        # 需要探测目标端口或输出JSON时按批量模式执行，逐个目标报告端口开放耗时
+        if args.target_port is not None or args.json:
+            sys.exit(run_batch(args, [
+                {"host": host, "sequence": knock_sequence, "password_hash": password_hash,
+                 "auth_mode": args.auth_mode, "engine": engine, "target_port": args.target_port}
+                for host in hosts]))
+
         # 执行敲门协议
-        print(f"\n🚪 开始执行 {len(knock_sequence)} 步敲门协议...")
-        success = send_knock(args.host, knock_sequence, password_hash)
+        print(f"\n🚪 开始对 {len(hosts)} 个目标执行 {len(knock_sequence)} 步敲门协议（{engine}）...")
+        try:
+            results = asyncio.run(knock_all(hosts, knock_sequence, password_hash, args.auth_mode, engine,
+                                            args.delay, args.concurrency))
+        except KeyboardInterrupt:
+            print("\n[!] 用户中止操作")
+            results = None
 
         # 结果处理
-        if success:
+        failed = [host for host, error in (results or {}).items() if error]
+        if results is None:
+            print("\n[×] 敲门流程中断")
+        elif not failed:
             print("\n[✓] 所有敲门包已发送，请检查服务端状态")
         else:
-            print("\n[×] 敲门流程中断")
+            print(f"\n[×] {len(failed)}/{len(hosts)} 个目标敲门失败: {', '.join(failed)}")
+            if engine == "scapy":
+                print("可能原因排查:")
+                print("1. 检查Npcap/WinPcap驱动安装")
+                print("2. 确认防火墙允许原始套接字")
+                print("3. 验证目标IP和端口配置")
 
         # 安全退出
         try:
             input("\n按回车键退出...")
-        except KeyboardInterrupt:
+        except (KeyboardInterrupt, EOFError):
             print("\n[!] 用户取消操作")
 
     except KeyboardInterrupt:
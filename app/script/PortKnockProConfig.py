@@ -2,6 +2,8 @@
 from scapy.all import *
 import time
 import hashlib
+import hmac
+import struct
 import sys
 import ctypes
 import traceback
@@ -71,16 +73,28 @@ def build_packet(proto, server_ip, port, payload):
     return ip_layer / transport_layer / Raw(load=payload) if payload else ip_layer / transport_layer
 
 
-def send_knock(server_ip, knock_sequence, password_hash):
+def build_auth_payload(password_hash, auth_mode="md5", totp_step=30):
+    """生成最终包认证载荷
+
+    md5模式直接发送密码MD5；totp模式发送 HMAC-SHA256(密码MD5, 当前时间片序号) 的前32位
+    """
+    if auth_mode == "totp":
+        counter = int(time.time() // totp_step)
+        return hmac.new(password_hash, struct.pack('>Q', counter), hashlib.sha256).hexdigest()[:32].encode()
+    return password_hash
+
+
+def send_knock(server_ip, knock_sequence, password_hash, auth_mode="md5"):
     """执行端口敲门序列"""
     try:
         for i, (port, proto) in enumerate(knock_sequence):
             try:
                 # 构造数据包
                 is_last = (i == len(knock_sequence) - 1)
-                payload = password_hash if is_last else (b"" if proto == "TCP" else b"knock_sequence")
+                # totp令牌在发送最终包时才计算，避免跨越时间片
+                payload = build_auth_payload(password_hash, auth_mode) if is_last else None
 
-                pkt = build_packet(proto, server_ip, port, payload if is_last else None)
+                pkt = build_packet(proto, server_ip, port, payload)
 
                 # 发送数据包
                 send(pkt, verbose=0)
@@ -101,7 +115,7 @@ def send_knock(server_ip, knock_sequence, password_hash):
 
 
 def read_config():
-    """从start.txt读取配置"""
+    """从start.txt读取配置（目标IP、端口序列、可选的认证方式）"""
     try:
         # 获取程序运行时的实际路径
         if getattr(sys, 'frozen', False):
@@ -123,8 +137,12 @@ def read_config():
 
         host = lines[0].strip()
         portlist = lines[1].strip()
+        # 第三行为认证方式，旧版配置文件没有该行时按md5处理
+        auth_mode = lines[2].strip().lower() if len(lines) > 2 and lines[2].strip() else "md5"
+        if auth_mode not in ("md5", "totp"):
+            raise ValueError(f"不支持的认证方式: {auth_mode}")
 
-        return host, portlist
+        return host, portlist, auth_mode
     except Exception as e:
         print(f"[!] 读取配置文件失败: {str(e)}")
         sys.exit(1)
@@ -140,9 +158,10 @@ def main():
 
         # 读取配置文件
         print("[*] 正在读取配置文件...")
-        host, portlist = read_config()
+        host, portlist, auth_mode = read_config()
         print(f"[✓] 目标主机: {host}")
         print(f"[✓] 端口序列: {portlist}")
+        print(f"[✓] 认证方式: {auth_mode}")
 
         # 解析敲门序列
         try:
@@ -165,7 +184,7 @@ def main():
 
         # 执行敲门协议
         print(f"\n🚪 开始执行 {len(knock_sequence)} 步敲门协议...")
-        success = send_knock(host, knock_sequence, password_hash)
+        success = send_knock(host, knock_sequence, password_hash, auth_mode)
 
         # 结果处理
         if success:
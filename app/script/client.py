@@ -3,6 +3,8 @@
 from scapy.all import *
 import time
 import hashlib
+import hmac
+import struct
 from getpass import getpass
 
 # 配置区域
@@ -13,6 +15,20 @@ KNOCK_SEQUENCE = [
     (6325, 'TCP'),
     (54221,'UDP')
 ]
+AUTH_MODE = 'md5'  # 认证方式：md5（静态密码哈希）或 totp（时间片一次性令牌）
+TOTP_STEP = 30  # totp时间片长度（秒），需与服务端一致
+
+
+def build_auth_payload(password):
+    """生成最终包认证载荷
+
+    md5模式直接发送密码MD5；totp模式发送 HMAC-SHA256(密码MD5, 当前时间片序号) 的前32位，
+    在发送最终包时才计算，避免跨越时间片。
+    """
+    if AUTH_MODE == 'totp':
+        counter = int(time.time() // TOTP_STEP)
+        return hmac.new(password, struct.pack('>Q', counter), hashlib.sha256).hexdigest()[:32].encode()
+    return password
 
 
 def send_knock():
@@ -24,13 +40,13 @@ def send_knock():
             if proto == 'TCP':
                 # TCP协议处理
                 if i == len(KNOCK_SEQUENCE) - 1:
-                    pkt = IP(dst=SERVER_IP) / TCP(dport=port, flags="PA") / Raw(load=password)
+                    pkt = IP(dst=SERVER_IP) / TCP(dport=port, flags="PA") / Raw(load=build_auth_payload(password))
                 else:
                     pkt = IP(dst=SERVER_IP) / TCP(dport=port, flags="S")
 
             elif proto == 'UDP':
                 # 修复UDP协议处理
-                payload = password if i == len(KNOCK_SEQUENCE) - 1 else b'google.com'
+                payload = build_auth_payload(password) if i == len(KNOCK_SEQUENCE) - 1 else b'google.com'
                 pkt = IP(dst=SERVER_IP) / UDP(dport=port) / Raw(load=payload)  # 三层结构
 
             send(pkt, verbose=0)
@@ -8,6 +8,8 @@ KNOCK_SEQUENCE=(
     "2453 tcp"
     "8823 udp"
 )
+AUTH_MODE="md5"  # 认证方式：md5（静态密码哈希）或 totp（时间片一次性令牌）
+TOTP_STEP=30     # totp时间片长度（秒），需与服务端一致
 FTP_DATA_PORT=20
 MD5_LENGTH=32
 
@@ -18,6 +20,9 @@ check_dependencies() {
         ["hping3"]="hping3"
         ["md5sum"]="coreutils"
     )
+    if [ "$AUTH_MODE" = "totp" ]; then
+        tools["openssl"]="openssl"
+    fi
 
     for cmd in "${!tools[@]}"; do
         if ! command -v $cmd &> /dev/null; then
@@ -85,6 +90,17 @@ get_password() {
     unset password
 }
 
+# 计算totp令牌：HMAC-SHA256(密码MD5, 8字节大端时间片序号) 的前32位
+totp_token() {
+    local counter=$(( $(date +%s) / TOTP_STEP ))
+    local bytes=""
+    local i
+    for i in 7 6 5 4 3 2 1 0; do
+        bytes+=$(printf '\\x%02x' $(( (counter >> (8 * i)) & 255 )))
+    done
+    printf "$bytes" | openssl dgst -sha256 -hmac "$md5_hash" | awk '{print $NF}' | cut -c1-32
+}
+
 # 主逻辑
 main() {
     check_dependencies
@@ -100,7 +116,11 @@ main() {
         
         # 构造载荷
         if [ $count -eq $total ]; then
-            payload=$md5_hash
+            if [ "$AUTH_MODE" = "totp" ]; then
+                payload=$(totp_token)
+            else
+                payload=$md5_hash
+            fi
             echo "[*] 正在发送认证载荷到$proto/$port"
         else
             payload="220 FTP server ready\r\n"
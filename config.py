@@ -18,6 +18,21 @@ class Config:
     - FLASKY_ADMIN: 管理员邮箱（从环境变量获取）
     - SQLALCHEMY_TRACK_MODIFICATIONS: 跟踪对象修改（默认：True）
     - SQLALCHEMY_ENGINE_OPTIONS: 数据库引擎选项，包含连接预检机制
+    - KNOCKING_FIREWALL_BACKEND: 敲门监听进程使用的防火墙后端（默认：'firewalld'，
+      可选 nftables/ipset/memory）
+    - KNOCKING_LOG_LEVEL: 敲门监听进程的日志级别（默认：'INFO'）
+    - KNOCKING_RUN_DIR: 敲门监听进程控制套接字所在目录（默认：'/var/run/authbase_knocking'）
+    - KNOCKING_LOG_FILE: 敲门监听进程输出日志文件（默认：'/var/log/authbase/knocking.log'）
+    - KNOCKING_STATE_DIR: 敲门监听进程授权日志目录，监听进程重启后据此接管未到期的授权
+      （默认：'/var/lib/authbase_knocking'）
+    - KNOCKING_LISTENER_WORKERS: 每个敲门监听进程的分片工作进程数，大于1时按源地址网段分发到多个CPU核处理
+      （默认：1）
+    - KNOCKING_EVENT_LOG: 敲门监听进程把敲门成功、失败、超时等审计事件批量写入 sys_knocking_event 表
+      （默认：True）
+    - KNOCKING_SUPERVISOR_AUTOSTART: 应用启动时按启用的规则对账并拉起监听进程（默认：True）
+    - KNOCKING_RESTART_BACKOFF: 监听进程异常退出后的初始重启间隔，按次数指数增长（默认：1秒）
+    - KNOCKING_RESTART_BACKOFF_MAX: 监听进程重启间隔上限（默认：60秒）
+    - KNOCKING_STOP_TIMEOUT: 停止监听进程时等待其自行退出的时间，超时后强制结束（默认：5秒）
     """
     SECRET_KEY = os.environ.get('SECRET_KEY') or 'hard to guess string'
     SQLALCHEMY_COMMIT_ON_TEARDOWN = True
@@ -28,6 +43,17 @@ class Config:
     SQLALCHEMY_ENGINE_OPTIONS = {
         'pool_pre_ping': True
     }
+    KNOCKING_FIREWALL_BACKEND = os.environ.get('KNOCKING_FIREWALL_BACKEND') or 'firewalld'
+    KNOCKING_LOG_LEVEL = os.environ.get('KNOCKING_LOG_LEVEL') or 'INFO'
+    KNOCKING_RUN_DIR = os.environ.get('KNOCKING_RUN_DIR') or '/var/run/authbase_knocking'
+    KNOCKING_LOG_FILE = os.environ.get('KNOCKING_LOG_FILE') or '/var/log/authbase/knocking.log'
+    KNOCKING_STATE_DIR = os.environ.get('KNOCKING_STATE_DIR') or '/var/lib/authbase_knocking'
+    KNOCKING_LISTENER_WORKERS = int(os.environ.get('KNOCKING_LISTENER_WORKERS') or 1)
+    KNOCKING_EVENT_LOG = os.environ.get('KNOCKING_EVENT_LOG', 'true').lower() == 'true'
+    KNOCKING_SUPERVISOR_AUTOSTART = os.environ.get('KNOCKING_SUPERVISOR_AUTOSTART', 'true').lower() == 'true'
+    KNOCKING_RESTART_BACKOFF = int(os.environ.get('KNOCKING_RESTART_BACKOFF') or 1)
+    KNOCKING_RESTART_BACKOFF_MAX = int(os.environ.get('KNOCKING_RESTART_BACKOFF_MAX') or 60)
+    KNOCKING_STOP_TIMEOUT = int(os.environ.get('KNOCKING_STOP_TIMEOUT') or 5)
 
     @staticmethod
     def init_app(app):
@@ -70,6 +96,7 @@ class TestingConfig(Config):
     - TESTING: 启用测试模式（默认：False）
     - SQLALCHEMY_DATABASE_URI: SQLite测试数据库路径
       （默认：项目目录下的data-test.sqlite）
+    - KNOCKING_SUPERVISOR_AUTOSTART: 测试时不拉起敲门监听进程（默认：False）
     
     建议通过环境变量覆盖配置：
     export TEST_DATABASE_URI='sqlite:////tmp/test.db'
@@ -77,6 +104,7 @@ class TestingConfig(Config):
     TESTING = False
     SQLALCHEMY_DATABASE_URI = os.environ.get('TEST_DATABASE_URI') or \
                               'sqlite:///' + os.path.join(basedir, 'data-test.sqlite')
+    KNOCKING_SUPERVISOR_AUTOSTART = False
 
 
 class ProductionConfig(Config):
@@ -447,6 +447,7 @@ CREATE TABLE IF NOT EXISTS `sys_knocking_rule` (
   `time_window` int NOT NULL COMMENT '等待时间(秒)',
   `timeout` int NOT NULL COMMENT '超时时间(秒)',
   `password_hash` varchar(255) NOT NULL COMMENT '密码哈希',
+  `auth_mode` varchar(16) NOT NULL DEFAULT 'md5' COMMENT '认证方式（md5静态 totp时间片）',
   `status` varchar(1) NOT NULL DEFAULT '1' COMMENT '状态（0停用 1正常）',
   `create_by` varchar(64) DEFAULT NULL COMMENT '创建者',
   `create_time` datetime DEFAULT CURRENT_TIMESTAMP COMMENT '创建时间',
@@ -459,3 +460,19 @@ CREATE TABLE IF NOT EXISTS `sys_knocking_rule` (
 -- 导出  表 authbase.sys_knocking_rule 的数据：~1 rows (大约)
 INSERT INTO `sys_knocking_rule` (`id`, `port_sequence`, `target_port`, `time_window`, `timeout`, `password_hash`, `status`, `create_by`, `create_time`, `remark`) VALUES
 	('ffa5ed8428b48adaa5bc040604fb9204', '2761:TCP,11041:UDP,5627:TCP', 22, 10, 300, '68bb336f08581e79277516f5b936495b', '1', 'admin', NOW(), '示例规则，并不生效');
+
+-- 导出  表 authbase.sys_knocking_event 结构
+CREATE TABLE IF NOT EXISTS `sys_knocking_event` (
+  `id` bigint NOT NULL AUTO_INCREMENT COMMENT '事件ID',
+  `rule_id` varchar(32) DEFAULT NULL COMMENT '规则ID',
+  `event_type` varchar(16) NOT NULL COMMENT '事件类型',
+  `source_ip` varchar(64) NOT NULL COMMENT '源地址',
+  `target_port` int DEFAULT NULL COMMENT '目标端口',
+  `detail` varchar(255) DEFAULT NULL COMMENT '详情',
+  `event_time` datetime NOT NULL COMMENT '事件时间',
+  PRIMARY KEY (`id`),
+  KEY `idx_knocking_event_time` (`event_time`),
+  KEY `idx_knocking_event_rule_time` (`rule_id`, `event_time`),
+  KEY `idx_knocking_event_ip_time` (`source_ip`, `event_time`),
+  KEY `idx_knocking_event_type_time` (`event_type`, `event_time`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci COMMENT='敲门审计事件表';
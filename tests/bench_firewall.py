@@ -0,0 +1,66 @@
+# coding:utf-8
+"""
+防火墙后端授权吞吐基准
+
+对指定后端连续执行授权（可按批次合并），统计每秒授权数，结束后撤销全部测试授权，
+并删除后端为测试端口创建的链、集合和规则。只有后端确认已生效的批次计入授权数，
+失败的批次单独统计。源地址取自基准测试保留网段 198.18.0.0/15。除 memory 外的后端需要root权限。
+
+使用方法：
+    python tests/bench_firewall.py -fw ipset -n 2000 -b 50
+"""
+
+import argparse
+import ipaddress
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'app', 'models'))
+
+from knocking_firewall import BACKENDS, FirewallError, create_backend
+
+
+def main():
+    parser = argparse.ArgumentParser(description="防火墙后端授权吞吐基准")
+    parser.add_argument('-fw', '--firewall', choices=sorted(BACKENDS), default='memory', help='防火墙后端')
+    parser.add_argument('-n', '--count', type=int, default=1000, help='授权次数')
+    parser.add_argument('-b', '--batch', type=int, default=1, help='每批授权数')
+    parser.add_argument('-p', '--port', type=int, default=65022, help='测试目标端口')
+    parser.add_argument('-t', '--timeout', type=int, default=60, help='授权有效期（秒）')
+    args = parser.parse_args()
+
+    backend = create_backend(args.firewall, timeout=args.timeout)
+    network = ipaddress.ip_network('198.18.0.0/15')
+    ips = [str(network[i + 1]) for i in range(args.count)]
+    granted = failed = 0
+
+    try:
+        backend.setup([args.port])
+        start = time.perf_counter()
+        for i in range(0, len(ips), args.batch):
+            batch = ips[i:i + args.batch]
+            try:
+                backend.apply([('add', ip, args.port, args.timeout) for ip in batch])
+                granted += len(batch)
+            except FirewallError as e:
+                # 后端能定位失败项时只有这些授权未生效
+                lost = len(e.failed) if e.failed is not None else len(batch)
+                granted += len(batch) - lost
+                failed += lost
+                print(f"批次失败: {e}", file=sys.stderr)
+        elapsed = time.perf_counter() - start
+    finally:
+        try:
+            backend.apply([('del', ip, args.port, 0) for ip in ips])
+        except FirewallError as e:
+            print(f"撤销测试授权失败: {e}", file=sys.stderr)
+        backend.teardown([args.port])
+        backend.close()
+
+    print(f"后端: {args.firewall}  授权数: {granted}  失败: {failed}  批大小: {args.batch}")
+    print(f"耗时: {elapsed:.3f}s  吞吐: {granted / elapsed:.1f} 次已确认授权/秒")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,257 @@
+# coding:utf-8
+"""
+敲门状态机回放基准
+
+不需要root和真实流量：把pcap文件或合成流量逐包交给 KnockStateMachine.process_packet，
+防火墙使用 memory 后端，统计吞吐、单包处理延迟分位数、峰值内存，并核对最终授权是否正确。
+
+合成流量由以下几类来源按随机顺序交错组成（同一来源内的包保持先后顺序）：
+- legit: 按正确顺序敲门并携带正确密码，应获得授权
+- scan: 对随机端口的扫描，偶尔命中敲门端口
+- flood: 伪造源地址的洪泛，只发送第一个敲门包或携带错误密码的完整序列
+- disorder: 携带正确密码但顺序错乱的敲门序列，不应获得授权
+合成包按以太网帧字节解析得到，与抓包得到的数据包结构一致；正常敲门的来源各占一个/24网段，
+避免被按网段限流误伤（最多16384个）。
+
+使用方法：
+    python tests/bench_knocking.py --legit 2000 --scan 200 --flood 20000 --disorder 500
+    python tests/bench_knocking.py --pcap knocks.pcap -pl "1201:TCP,2301:UDP" -passwd <密码MD5> --expect 10.0.0.5
+    python tests/bench_knocking.py --trace-memory   # 统计峰值内存，tracemalloc会拖慢处理速度
+"""
+
+import argparse
+import hashlib
+import ipaddress
+import os
+import random
+import socket
+import struct
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'app', 'models'))
+
+from scapy.all import IP, TCP, UDP, Ether, Raw, rdpcap
+from scapy.utils import checksum
+
+from knocking_cmd import KnockStateMachine, parse_arguments, parse_knock_sequence, setup_logging
+from knocking_firewall import MemoryBackend
+
+DEFAULT_SEQUENCE = '1201:TCP,2301:UDP,3401:TCP'
+DEFAULT_PASSWORD = hashlib.md5(b'bench').hexdigest()
+
+# 各类合成来源使用互不重叠的地址段，避免按网段限流时互相影响
+LEGIT_NET = ipaddress.ip_network('100.64.0.0/10')
+DISORDER_NET = ipaddress.ip_network('198.18.0.0/15')
+SCAN_NET = ipaddress.ip_network('172.16.0.0/12')
+FLOOD_NET = ipaddress.ip_network('10.0.0.0/8')
+
+# 以太网头14字节，IPv4校验和与源地址在帧中的偏移
+_IP_START, _IP_CHECKSUM, _IP_SRC = 14, 24, 26
+_templates = {}
+
+
+def frame(src, port, proto, payload=None):
+    """构造一个已解析的以太网帧
+
+    每种 (端口, 协议, 载荷) 只用scapy组包一次，之后替换源地址并重算IP头校验和，
+    比逐包组包快数倍。
+    """
+    key = (port, proto, payload)
+    template = _templates.get(key)
+    if template is None:
+        layer = TCP(dport=port) if proto == 'TCP' else UDP(dport=port)
+        pkt = Ether() / IP(src='0.0.0.0') / layer
+        if payload is not None:
+            pkt = pkt / Raw(payload)
+        template = _templates[key] = bytearray(bytes(pkt))
+    raw = bytearray(template)
+    raw[_IP_SRC:_IP_SRC + 4] = socket.inet_aton(src)
+    raw[_IP_CHECKSUM:_IP_CHECKSUM + 2] = b'\x00\x00'
+    header_end = _IP_START + (raw[_IP_START] & 0x0f) * 4
+    raw[_IP_CHECKSUM:_IP_CHECKSUM + 2] = struct.pack('!H', checksum(bytes(raw[_IP_START:header_end])))
+    return Ether(bytes(raw))
+
+
+def knock(src, sequence, payload):
+    """一个来源的完整敲门序列，最终包携带payload"""
+    last = len(sequence) - 1
+    return [frame(src, port, proto, payload if i == last else None)
+            for i, (port, proto) in enumerate(sequence)]
+
+
+def pick(network, index):
+    """网段中的第index个来源，相邻来源相隔一个/24"""
+    return str(network[(index * 256 + 1) % network.num_addresses])
+
+
+def synthetic_traffic(sequence, password, legit=1000, scan=100, scan_ports=50, flood=10000,
+                      disorder=200, seed=1):
+    """生成合成流量
+
+    Returns:
+        tuple: (数据包列表, 应获得授权的源地址集合)
+    """
+    rng = random.Random(seed)
+    secret = password.encode('utf-8')
+    streams = []
+
+    for i in range(legit):
+        streams.append(knock(pick(LEGIT_NET, i), sequence, secret))
+
+    knock_ports = [port for port, _ in sequence]
+    for i in range(scan):
+        src = pick(SCAN_NET, i)
+        ports = [rng.choice(knock_ports) if rng.random() < 0.1 else rng.randint(1, 65535)
+                 for _ in range(scan_ports)]
+        streams.append([frame(src, port, rng.choice(('TCP', 'UDP'))) for port in ports])
+
+    for i in range(flood):
+        src = str(FLOOD_NET[rng.randint(1, FLOOD_NET.num_addresses - 2)])
+        if rng.random() < 0.5:
+            port, proto = sequence[0]
+            streams.append([frame(src, port, proto)])
+        else:
+            streams.append(knock(src, sequence, b'0' * len(secret)))
+
+    if len(sequence) > 1:
+        for i in range(disorder):
+            shuffled = list(sequence)
+            while shuffled == list(sequence):
+                rng.shuffle(shuffled)
+            streams.append(knock(pick(DISORDER_NET, i), shuffled, secret))
+
+    # 按随机顺序交错各来源的包，来源内部保持原顺序
+    order = [i for i, stream in enumerate(streams) for _ in stream]
+    rng.shuffle(order)
+    cursors = [0] * len(streams)
+    packets = []
+    for i in order:
+        packets.append(streams[i][cursors[i]])
+        cursors[i] += 1
+    return packets, {pick(LEGIT_NET, i) for i in range(legit)}
+
+
+def build_listener(listener_argv):
+    """按命令行参数构造使用 memory 后端的状态机"""
+    args = parse_arguments(listener_argv + ['-fw', 'memory'])
+    backend = MemoryBackend()
+    backend.setup([args.target_port])
+    return KnockStateMachine(args, firewall=backend), backend
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return 0
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * q))]
+
+
+def replay(fsm, packets, trace_memory=False):
+    """逐包回放并统计吞吐和延迟
+
+    Returns:
+        dict: packets、elapsed、pps、p50_us、p99_us、max_us、peak_bytes（未开启内存统计时为None）
+    """
+    latencies = []
+    clock = time.perf_counter_ns
+    process = fsm.process_packet
+    if trace_memory:
+        tracemalloc.start()
+    start = clock()
+    for pkt in packets:
+        t = clock()
+        process(pkt)
+        latencies.append(clock() - t)
+    elapsed = (clock() - start) / 1e9
+    peak = None
+    if trace_memory:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    latencies.sort()
+    return {
+        'packets': len(packets),
+        'elapsed': elapsed,
+        'pps': len(packets) / elapsed if elapsed else 0,
+        'p50_us': percentile(latencies, 0.5) / 1000,
+        'p99_us': percentile(latencies, 0.99) / 1000,
+        'max_us': (latencies[-1] if latencies else 0) / 1000,
+        'peak_bytes': peak,
+    }
+
+
+def check_grants(fsm, backend, expected, timeout=10):
+    """等待防火墙工作线程处理完所有授权后核对结果
+
+    Returns:
+        dict: granted、missing、unexpected
+    """
+    worker = fsm.firewall_worker
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if worker.pending() == 0 and worker.applied + worker.failed >= len(fsm.firewall_rules):
+            break
+        time.sleep(0.01)
+    granted = {ip for ip, _ in backend.grants}
+    return {
+        'granted': len(granted),
+        'missing': sorted(expected - granted),
+        'unexpected': sorted(granted - expected),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="敲门状态机回放基准")
+    parser.add_argument('-pl', '--port-list', default=DEFAULT_SEQUENCE, help='敲门序列')
+    parser.add_argument('-p', '--target-port', type=int, default=22, help='目标开放端口')
+    parser.add_argument('-passwd', '--password', default=DEFAULT_PASSWORD, help='最终包密码')
+    parser.add_argument('--pcap', help='回放的pcap文件，不指定时使用合成流量')
+    parser.add_argument('--expect', default='', help='pcap回放时应获得授权的源地址，逗号分隔')
+    parser.add_argument('--legit', type=int, default=1000, help='正常敲门的来源数')
+    parser.add_argument('--scan', type=int, default=100, help='端口扫描的来源数')
+    parser.add_argument('--scan-ports', type=int, default=50, help='每个扫描来源的探测包数')
+    parser.add_argument('--flood', type=int, default=10000, help='伪造源地址的洪泛包组数')
+    parser.add_argument('--disorder', type=int, default=200, help='乱序敲门的来源数')
+    parser.add_argument('--seed', type=int, default=1, help='随机种子')
+    parser.add_argument('--trace-memory', action='store_true', help='统计峰值内存（会拖慢处理速度）')
+    parser.add_argument('--log-level', default='ERROR', help='状态机日志级别，WARNING及以下会计入日志开销')
+    args, listener_extra = parser.parse_known_args()
+
+    listener_argv = ['-pl', args.port_list, '-p', str(args.target_port), '-passwd', args.password,
+                     '-t', '3600'] + listener_extra
+    with tempfile.TemporaryDirectory() as tmpdir:
+        log_runtime = setup_logging(args.log_level, os.path.join(tmpdir, 'bench.log'))
+        try:
+            fsm, backend = build_listener(listener_argv)
+            build_start = time.perf_counter()
+            if args.pcap:
+                packets = rdpcap(args.pcap)
+                expected = {ip for ip in args.expect.split(',') if ip}
+            else:
+                packets, expected = synthetic_traffic(
+                    parse_knock_sequence(args.port_list), args.password, args.legit, args.scan,
+                    args.scan_ports, args.flood, args.disorder, args.seed)
+            build_time = time.perf_counter() - build_start
+
+            result = replay(fsm, packets, args.trace_memory)
+            grants = check_grants(fsm, backend, expected)
+            fsm.close()
+        finally:
+            log_runtime.stop()
+
+    print(f"数据包: {result['packets']}  准备耗时: {build_time:.1f}s")
+    print(f"处理耗时: {result['elapsed']:.3f}s  吞吐: {result['pps']:.0f} 包/秒")
+    print(f"单包延迟: p50 {result['p50_us']:.1f}us  p99 {result['p99_us']:.1f}us  max {result['max_us']:.1f}us")
+    if result['peak_bytes'] is not None:
+        print(f"峰值内存: {result['peak_bytes'] / 1024 / 1024:.1f} MiB")
+    print(f"授权: {grants['granted']}  期望: {len(expected)}  "
+          f"缺失: {len(grants['missing'])}  多余: {len(grants['unexpected'])}")
+    for label in ('missing', 'unexpected'):
+        if grants[label]:
+            print(f"  {label}: {', '.join(grants[label][:10])}{' ...' if len(grants[label]) > 10 else ''}")
+    return 1 if grants['missing'] or grants['unexpected'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
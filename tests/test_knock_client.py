@@ -0,0 +1,166 @@
+# coding:utf-8
+import asyncio
+import io
+import json
+import subprocess
+import os
+import socket
+import struct
+import sys
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'app', 'script'))
+
+from PortKnockPro import (choose_engine, format_summary, knock_all, load_inventory, parse_hosts, parse_portlist,
+                          probe_port, run_inventory)
+
+
+class KnockClientTestCase(unittest.TestCase):
+    """普通套接字方式向本机并发敲门"""
+
+    def setUp(self):
+        self.sockets = []
+
+    def tearDown(self):
+        for sock in self.sockets:
+            sock.close()
+
+    def listen(self, host, kind, port=0):
+        sock = socket.socket(socket.AF_INET6 if ':' in host else socket.AF_INET, kind)
+        self.sockets.append(sock)
+        sock.bind((host, port))
+        if kind == socket.SOCK_STREAM:
+            sock.listen(16)
+        sock.settimeout(2)
+        return sock
+
+    def test_engine_selection(self):
+        self.assertEqual(choose_engine('auto', parse_portlist('1:TCP,2:UDP')), 'socket')
+        self.assertEqual(choose_engine('auto', parse_portlist('1:UDP,2:TCP')), 'scapy')
+        with self.assertRaises(ValueError):
+            choose_engine('socket', parse_portlist('1:UDP,2:TCP'))
+        self.assertEqual(parse_hosts(' a, b,a ,'), ['a', 'b'])
+
+    def test_socket_knock_many_hosts(self):
+        hosts = ['127.0.0.1', '127.0.0.2']
+        if socket.has_ipv6:
+            hosts.append('::1')
+        try:
+            tcp = [self.listen(hosts[0], socket.SOCK_STREAM)]
+            udp = [self.listen(hosts[0], socket.SOCK_DGRAM)]
+            for host in hosts[1:]:
+                tcp.append(self.listen(host, socket.SOCK_STREAM, tcp[0].getsockname()[1]))
+                udp.append(self.listen(host, socket.SOCK_DGRAM, udp[0].getsockname()[1]))
+        except OSError as e:
+            self.skipTest(f'无法在回环地址上监听同一端口: {e}')
+        sequence = parse_portlist(f'{tcp[0].getsockname()[1]}:TCP,{udp[0].getsockname()[1]}:UDP')
+        outcome = asyncio.run(knock_all(hosts, sequence, b'secret', delay=0.05))
+        self.assertEqual(outcome, {host: None for host in hosts})
+        for listener, receiver in zip(tcp, udp):
+            listener.accept()[0].close()
+            self.assertEqual(receiver.recvfrom(100)[0], b'secret')
+
+    def test_tcp_socket_closed_before_next_step(self):
+        events = []
+
+        class RecordingSocket(socket.socket):
+            def setsockopt(self, level, option, value):
+                if option == socket.SO_LINGER:
+                    events.append(('linger', value))
+                return super().setsockopt(level, option, value)
+
+            def sendto(self, data, address):
+                events.append(('sendto', data))
+                return super().sendto(data, address)
+
+            def close(self):
+                if self.type == socket.SOCK_STREAM and self.fileno() != -1:
+                    events.append(('close', 'tcp'))
+                return super().close()
+
+        tcp = self.listen('127.0.0.1', socket.SOCK_STREAM)
+        udp = self.listen('127.0.0.1', socket.SOCK_DGRAM)
+        sequence = parse_portlist(f'{tcp.getsockname()[1]}:TCP,{udp.getsockname()[1]}:UDP')
+        with mock.patch('PortKnockPro.socket.socket', RecordingSocket):
+            outcome = asyncio.run(knock_all(['127.0.0.1'], sequence, b'secret', delay=0))
+        self.assertEqual(outcome, {'127.0.0.1': None})
+        # SYN发出后立即以 SO_LINGER 0 关闭，重传的SYN不会晚于后续步骤到达（之后是事件循环自身的套接字）
+        self.assertEqual(events[:3], [('linger', struct.pack('ii', 1, 0)), ('close', 'tcp'), ('sendto', b'secret')])
+
+    def test_unreachable_host_is_reported(self):
+        udp = self.listen('127.0.0.1', socket.SOCK_DGRAM)
+        sequence = parse_portlist(f'{udp.getsockname()[1]}:UDP')
+        outcome = asyncio.run(knock_all(['127.0.0.1', 'no-such-host.invalid'], sequence, b'x', delay=0))
+        self.assertIsNone(outcome['127.0.0.1'])
+        self.assertIsNotNone(outcome['no-such-host.invalid'])
+        self.assertEqual(udp.recvfrom(100)[0], b'x')
+
+    def test_inventory_batch_with_probe_and_retry(self):
+        udp = self.listen('127.0.0.1', socket.SOCK_DGRAM)
+        opened = self.listen('127.0.0.1', socket.SOCK_STREAM)
+        closed = self.listen('127.0.0.1', socket.SOCK_STREAM)
+        closed_port = closed.getsockname()[1]
+        closed.close()
+        knock = f'{udp.getsockname()[1]}:UDP'
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'hosts.csv')
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write('host,portlist,secret,target_port\n')
+                f.write(f'127.0.0.1,{knock},env:KNOCK_SECRET,{opened.getsockname()[1]}\n')
+                f.write(f'127.0.0.1,{knock},env:KNOCK_SECRET,{closed_port}\n')
+            with mock.patch.dict(os.environ, {'KNOCK_SECRET': 'pw'}):
+                targets = load_inventory(path)
+        self.assertEqual([t['engine'] for t in targets], ['socket', 'socket'])
+        self.assertIs(targets[0]['password_hash'], targets[1]['password_hash'])
+
+        results = asyncio.run(run_inventory(targets, delay=0, retries=1, deadline=0.3, progress=io.StringIO()))
+        self.assertTrue(results[0]['ok'])
+        self.assertEqual(results[0]['attempts'], 1)
+        self.assertFalse(results[1]['ok'])
+        self.assertEqual(results[1]['attempts'], 2)
+        self.assertIn(str(closed_port), results[1]['error'])
+        self.assertIsNotNone(results[0]['open_ms'])
+        self.assertIsNone(results[1]['total_ms'])
+        self.assertIn('成功 1，失败 1', format_summary(results))
+
+    def test_inventory_rejects_bad_rows(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'hosts.json')
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write('[{"host": "a", "portlist": "1:UDP", "secret": "env:NO_SUCH_VARIABLE_X"}]')
+            with self.assertRaisesRegex(ValueError, '第 1 项'):
+                load_inventory(path)
+
+    def test_json_output_reports_time_to_open(self):
+        udp = self.listen('127.0.0.1', socket.SOCK_DGRAM)
+        opened = self.listen('127.0.0.1', socket.SOCK_STREAM)
+        proc = subprocess.run(
+            [sys.executable, sys.modules[choose_engine.__module__].__file__, '-H', '127.0.0.1',
+             '-p', f'{udp.getsockname()[1]}:UDP', '-t', str(opened.getsockname()[1]), '--json', '--deadline', '1'],
+            input='pw\n', capture_output=True, text=True, timeout=30)
+        self.assertEqual(proc.returncode, 0, proc.stderr)
+        [result] = json.loads(proc.stdout)
+        self.assertEqual(result['host'], '127.0.0.1')
+        self.assertTrue(result['ok'])
+        self.assertGreaterEqual(result['open_ms'], 0)
+
+    def test_probe_starts_new_attempt_every_interval(self):
+        calls = []
+
+        async def open_connection(host, port):
+            calls.append(port)
+            if len(calls) == 1:
+                # 防火墙规则生效前的SYN被丢弃，这次尝试一直得不到响应
+                await asyncio.sleep(30)
+            writer = mock.Mock()
+            writer.wait_closed = mock.AsyncMock()
+            return None, writer
+
+        started = time.monotonic()
+        with mock.patch('PortKnockPro.asyncio.open_connection', open_connection):
+            self.assertTrue(asyncio.run(probe_port('127.0.0.1', 22, timeout=3, interval=0.1)))
+        self.assertLess(time.monotonic() - started, 0.5)
+        self.assertEqual(calls, [22, 22])
@@ -0,0 +1,81 @@
+# coding:utf-8
+import hashlib
+import unittest
+from sqlalchemy import create_engine, text
+from app.models.KnockingRule import KnockingRule
+from app.models.knocking_auth import (Md5HexVerifier, HmacTotpVerifier, create_verifier,
+                                      totp_token, trim_bounds)
+
+
+class KnockingAuthTestCase(unittest.TestCase):
+    def setUp(self):
+        self.secret = hashlib.md5(b'123456').hexdigest()
+        self.verifier = create_verifier('md5', self.secret)
+
+    def test_exact_payload(self):
+        self.assertTrue(self.verifier.verify(self.secret.encode()))
+
+    def test_padded_payload(self):
+        self.assertTrue(self.verifier.verify(self.secret.encode() + b'\x00\x00\x00\n'))
+        self.assertTrue(self.verifier.verify(b' ' + self.secret.encode() + b'\r\n'))
+
+    def test_wrong_payload(self):
+        self.assertFalse(self.verifier.verify(hashlib.md5(b'654321').hexdigest().encode()))
+        self.assertFalse(self.verifier.verify(self.secret.encode()[:-1]))
+        self.assertFalse(self.verifier.verify(self.secret.encode() + b'x'))
+
+    def test_length_rejection(self):
+        self.assertFalse(self.verifier.verify(b''))
+        self.assertFalse(self.verifier.verify(self.secret.encode() + b'\x00' * 200))
+
+    def test_trim_bounds(self):
+        self.assertEqual(trim_bounds(b'\x00ab \n'), (1, 3))
+        self.assertEqual(trim_bounds(b'\x00\x00'), (2, 2))
+
+    def test_unknown_scheme(self):
+        with self.assertRaises(ValueError):
+            create_verifier('sha1', self.secret)
+        self.assertIsInstance(self.verifier, Md5HexVerifier)
+
+
+class KnockingTotpTestCase(unittest.TestCase):
+    def setUp(self):
+        self.now = 1700000000.0
+        self.secret = hashlib.md5(b'123456').hexdigest()
+        self.verifier = HmacTotpVerifier(self.secret, step=30, clock=lambda: self.now, autostart=False)
+
+    def token(self, offset=0):
+        return totp_token(self.secret, int(self.now // 30) + offset)
+
+    def test_current_token_accepted_once(self):
+        token = self.token()
+        self.assertTrue(self.verifier.verify(token))
+        self.assertFalse(self.verifier.verify(token))
+
+    def test_adjacent_step_accepted(self):
+        self.assertTrue(self.verifier.verify(self.token(-1)))
+        self.assertTrue(self.verifier.verify(self.token(1) + b'\x00\x00'))
+
+    def test_expired_token_rejected_after_refresh(self):
+        token = self.token()
+        self.now += 90
+        self.verifier.refresh()
+        self.assertFalse(self.verifier.verify(token))
+
+    def test_static_md5_rejected(self):
+        self.assertFalse(self.verifier.verify(self.secret.encode()))
+
+
+class KnockingRuleSchemaTestCase(unittest.TestCase):
+    def test_upgrade_adds_auth_mode(self):
+        engine = create_engine('sqlite://')
+        self.assertEqual(KnockingRule.upgrade_schema(engine), [])
+        # 旧版本的规则表没有 auth_mode 列
+        with engine.begin() as conn:
+            conn.execute(text("CREATE TABLE sys_knocking_rule (id VARCHAR(32) PRIMARY KEY, "
+                              "port_sequence VARCHAR(255) NOT NULL, status VARCHAR(1) NOT NULL DEFAULT '1')"))
+            conn.execute(text("INSERT INTO sys_knocking_rule (id, port_sequence) VALUES ('r1', '1201:TCP')"))
+        self.assertEqual(KnockingRule.upgrade_schema(engine), ['auth_mode'])
+        self.assertEqual(KnockingRule.upgrade_schema(engine), [])
+        with engine.connect() as conn:
+            self.assertEqual(conn.execute(text("SELECT auth_mode FROM sys_knocking_rule")).scalar(), 'md5')
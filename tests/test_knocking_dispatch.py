@@ -0,0 +1,157 @@
+# coding:utf-8
+import hashlib
+import json
+import os
+import tempfile
+import unittest
+from types import SimpleNamespace
+from scapy.all import TCP, UDP, Ether, IPv6, Raw
+from tests.bench_knocking import build_listener, check_grants, frame, knock
+from app.models.knocking_dispatch import KnockTrie
+
+PASSWORD = hashlib.md5(b'dispatch').hexdigest()
+OTHER_PASSWORD = hashlib.md5(b'other').hexdigest()
+
+
+def rule(seq, window=10):
+    return SimpleNamespace(port_list=seq, window=window)
+
+
+class KnockTrieTestCase(unittest.TestCase):
+    def test_shared_prefix(self):
+        a = rule([(1201, 'TCP'), (2301, 'UDP')], window=5)
+        b = rule([(1201, 'TCP'), (2301, 'UDP'), (3401, 'TCP')], window=20)
+        c = rule([(1201, 'TCP'), (4501, 'UDP')])
+        trie = KnockTrie([a, b, c])
+        self.assertEqual(list(trie.root.children), [(1201, 'TCP')])
+        first = trie.root.children[(1201, 'TCP')]
+        self.assertEqual(set(first.children), {(2301, 'UDP'), (4501, 'UDP')})
+        self.assertEqual(first.window, 20)
+        node = trie.find([(1201, 'TCP'), (2301, 'UDP')])
+        self.assertEqual(node.rules, [a])
+        self.assertEqual(node.window, 20)
+        self.assertIs(node.rule, a)
+        self.assertEqual(trie.find([(1201, 'TCP'), (2301, 'UDP'), (3401, 'TCP')]).rules, [b])
+        self.assertIsNone(trie.find([(2301, 'UDP')]))
+        self.assertEqual(trie.steps, {(1201, 'TCP'), (2301, 'UDP'), (3401, 'TCP'), (4501, 'UDP')})
+
+
+class KnockDispatchTestCase(unittest.TestCase):
+    """同一进程服务共享前缀的多条规则"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        rules_file = os.path.join(self.tmpdir.name, 'rules.json')
+        with open(rules_file, 'w') as f:
+            json.dump([
+                {'rule_id': 'longer', 'port_list': '1201:TCP,2301:UDP,3401:TCP', 'target_port': 8080,
+                 'password': OTHER_PASSWORD},
+                {'rule_id': 'branch', 'port_list': '1201:TCP,4501:UDP', 'target_port': 3389},
+            ], f)
+        self.fsm, self.backend = build_listener(['-pl', '1201:TCP,2301:UDP', '-p', '22', '-passwd', PASSWORD,
+                                                 '--rule-id', 'short', '--rules-file', rules_file])
+
+    def tearDown(self):
+        self.fsm.close()
+        self.tmpdir.cleanup()
+
+    def replay(self, packets):
+        for pkt in packets:
+            self.fsm.process_packet(pkt)
+        check_grants(self.fsm, self.backend, set())
+        return self.backend.grants
+
+    def test_single_lookup_advances_all_rules(self):
+        grants = self.replay(
+            knock('100.64.0.1', [(1201, 'TCP'), (2301, 'UDP')], PASSWORD.encode())
+            + knock('100.64.1.1', [(1201, 'TCP'), (2301, 'UDP'), (3401, 'TCP')], OTHER_PASSWORD.encode())
+            + knock('100.64.2.1', [(1201, 'TCP'), (4501, 'UDP')], PASSWORD.encode()))
+        self.assertEqual(set(grants), {('100.64.0.1', 22), ('100.64.1.1', 8080), ('100.64.2.1', 3389)})
+        self.assertEqual(self.fsm.clients, {})
+        self.assertEqual(self.fsm.bpf_filter, '(tcp or udp) and (dst port 1201 or 2301 or 3401 or 4501)')
+
+    def test_wrong_password_and_invalid_step(self):
+        grants = self.replay(
+            knock('100.64.0.1', [(1201, 'TCP'), (2301, 'UDP'), (3401, 'TCP')], b'0' * 32)
+            + [frame('100.64.1.1', 1201, 'TCP'), frame('100.64.1.1', 3401, 'TCP')])
+        self.assertEqual(grants, {})
+        self.assertEqual(self.fsm.password_failures.values, {(): 1})
+        self.assertEqual(self.fsm.invalid_steps.values, {(): 1})
+        self.assertEqual(self.fsm.clients, {})
+
+    def test_reload_keeps_clients_on_shared_prefix(self):
+        self.replay([frame('100.64.0.1', 1201, 'TCP'), frame('100.64.1.1', 1201, 'TCP'),
+                     frame('100.64.1.1', 2301, 'UDP')])
+        result = self.fsm.reload({'port_list': '1201:TCP,5601:UDP'})
+        # 100.64.1.1 位于 1201,2301 节点，该前缀仍属于规则 longer
+        self.assertEqual(result['reset_clients'], 0)
+        grants = self.replay([frame('100.64.0.1', 5601, 'UDP', PASSWORD.encode())])
+        self.assertIn(('100.64.0.1', 22), grants)
+
+    def test_ipv6_and_ipv4_share_one_path(self):
+        v6 = [Ether(bytes(Ether() / IPv6(src='2001:db8::5') / TCP(dport=1201))),
+              Ether(bytes(Ether() / IPv6(src='2001:db8::5') / UDP(dport=2301) / Raw(PASSWORD.encode())))]
+        grants = self.replay([v6[0], frame('100.64.0.1', 1201, 'TCP')])
+        self.assertEqual(set(self.fsm.clients), {bytes.fromhex('20010db8000000000000000000000005'),
+                                                 bytes([100, 64, 0, 1])})
+        grants = self.replay(v6[1:])
+        self.assertEqual(grants.keys(), {('2001:db8::5', 22)})
+
+    def test_revoke_events_name_the_granting_rule(self):
+        recorded = []
+        self.fsm.events = SimpleNamespace(
+            record=lambda event_type, ip, port, detail=None, rule_id=None: recorded.append((event_type, ip, rule_id)),
+            stats=dict, close=lambda: None)
+        self.replay(knock('100.64.0.1', [(1201, 'TCP'), (2301, 'UDP')], PASSWORD.encode())
+                    + knock('100.64.2.1', [(1201, 'TCP'), (4501, 'UDP')], PASSWORD.encode())
+                    + knock('100.64.2.2', [(1201, 'TCP'), (4501, 'UDP')], PASSWORD.encode()))
+        # 手动撤销和停用规则都按开放授权的规则记录审计事件
+        self.fsm.revoke_grants(['100.64.2.1'])
+        self.fsm.pause(['short', 'branch'])
+        self.assertEqual([event for event in recorded if event[0] == 'revoked'], [
+            ('revoked', '100.64.2.1', 'branch'),
+            ('revoked', '100.64.0.1', 'short'),
+            ('revoked', '100.64.2.2', 'branch'),
+        ])
+
+    def test_rules_are_paused_and_removed_separately(self):
+        self.replay(knock('100.64.0.1', [(1201, 'TCP'), (2301, 'UDP')], PASSWORD.encode())
+                    + knock('100.64.2.1', [(1201, 'TCP'), (4501, 'UDP')], PASSWORD.encode()))
+        self.assertEqual([g['ip'] for g in self.fsm.list_grants(rule_id='branch')['grants']], ['100.64.2.1'])
+
+        # 停用一条规则只撤销它开放的授权，其余规则照常处理
+        filters = []
+        self.fsm.on_filter_changed = filters.append
+        self.assertEqual(self.fsm.pause('branch')['revoked'], 1)
+        self.assertFalse(self.fsm.paused)
+        self.assertEqual(filters, ['(tcp or udp) and (dst port 1201 or 2301 or 3401)'])
+        grants = self.replay(knock('100.64.3.1', [(1201, 'TCP'), (4501, 'UDP')], PASSWORD.encode()))
+        self.assertEqual(set(grants), {('100.64.0.1', 22)})
+
+        self.fsm.resume({'rule_id': 'branch'})
+        self.assertEqual(filters[-1], '(tcp or udp) and (dst port 1201 or 2301 or 3401 or 4501)')
+        self.fsm.remove_rule('longer')
+        self.assertEqual(list(self.fsm.rules), ['short', 'branch'])
+        with self.assertRaises(ValueError):
+            self.fsm.remove_rule('short')
+        with self.assertRaises(ValueError):
+            self.fsm.pause('longer')
+
+        # 热更新不存在的规则时按请求参数添加
+        with self.assertRaises(ValueError):
+            self.fsm.reload({'rule_id': 'added', 'port_list': '5601:UDP'})
+        self.fsm.reload({'rule_id': 'added', 'port_list': '5601:UDP', 'password': PASSWORD, 'target_port': 8443})
+        grants = self.replay(knock('100.64.4.1', [(5601, 'UDP')], PASSWORD.encode()))
+        self.assertIn(('100.64.4.1', 8443), grants)
+        self.assertEqual(self.fsm.list_grants(rule_id='added')['total'], 1)
+
+        # 批量切换：rule_id 为列表时一次停用或启用多条规则
+        self.fsm.pause(['branch', 'added'])
+        self.assertEqual(self.fsm.paused_rules, {'branch', 'added'})
+        self.assertEqual(self.fsm.list_grants(rule_id='added')['total'], 0)
+        with self.assertRaises(ValueError):
+            self.fsm.resume({'rule_id': ['branch', 'missing']})
+        with self.assertRaises(ValueError):
+            self.fsm.resume({'rule_id': ['branch', 'added'], 'window': 5})
+        self.fsm.resume({'rule_id': ['branch', 'added']})
+        self.assertEqual(self.fsm.paused_rules, set())
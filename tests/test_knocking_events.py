@@ -0,0 +1,61 @@
+# coding:utf-8
+import os
+import tempfile
+import unittest
+from sqlalchemy import MetaData, create_engine, event, func, select
+from app.models.knocking_events import EventWriter, event_table
+
+
+class KnockingEventWriterTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.url = f'sqlite:///{self.tmpdir.name}/events.db'
+        self.spill = os.path.join(self.tmpdir.name, 'r1.events')
+        self.metadata = MetaData()
+        self.table = event_table(self.metadata)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def count(self, engine):
+        with engine.connect() as conn:
+            return conn.execute(select(func.count()).select_from(self.table)).scalar()
+
+    def test_batched_multi_row_insert(self):
+        engine = create_engine(self.url)
+        self.metadata.create_all(engine)
+        statements = []
+        event.listen(engine, 'before_cursor_execute',
+                     lambda conn, cursor, statement, *args: statements.append(statement))
+        writer = EventWriter(None, rule_id='r1', batch_size=50, flush_interval=60, engine=engine)
+        for i in range(120):
+            writer.record('success', f'10.0.0.{i}', 22)
+        writer.start().close()
+        self.assertEqual(self.count(create_engine(self.url)), 120)
+        self.assertEqual(len([s for s in statements if s.startswith('INSERT')]), 3)
+        self.assertEqual(writer.stats()['written'], 120)
+
+    def test_spill_when_database_down_and_replay(self):
+        # 表不存在，写入失败
+        writer = EventWriter(self.url, rule_id='r1', spill_path=self.spill).start()
+        writer.record('auth_failed', '10.0.0.1', 22)
+        writer.record('banned', '10.0.0.1', 22, '封禁 300 秒')
+        writer.close()
+        self.assertEqual(writer.stats()['spilled'], 2)
+        self.assertTrue(os.path.exists(self.spill))
+
+        engine = create_engine(self.url)
+        self.metadata.create_all(engine)
+        writer = EventWriter(self.url, rule_id='r1', spill_path=self.spill).start()
+        writer.record('success', '10.0.0.2', 22)
+        writer.close()
+        self.assertEqual(self.count(engine), 3)
+        self.assertFalse(os.path.exists(self.spill))
+
+    def test_bounded_buffer_drops_oldest(self):
+        writer = EventWriter(self.url, max_buffer=3)
+        for i in range(5):
+            writer.record('timeout', f'10.0.0.{i}')
+        self.assertEqual(writer.dropped, 2)
+        self.assertEqual([e['source_ip'] for e in writer._buffer], ['10.0.0.2', '10.0.0.3', '10.0.0.4'])
+        writer._engine.dispose()
@@ -0,0 +1,243 @@
+# coding:utf-8
+import os
+import queue
+import tempfile
+import time
+import unittest
+from unittest import mock
+from app.models.knocking_firewall import (MemoryBackend, NftablesBackend, FirewalldBackend, FirewallError,
+                                          IpsetBackend, FirewallWorker, GrantJournal, create_backend)
+
+
+class FakeIpset:
+    """模拟 ipset 交互进程：出错的命令和 test 命令的结果逐行输出到标准错误"""
+
+    def __init__(self, bad=()):
+        self.bad = bad
+        self.silent = False
+        self.killed = False
+        self.lines = []
+        self.stdin = self
+        self._buffer = ''
+        self._stderr = queue.Queue()
+        self.stderr = iter(self._stderr.get, None)
+
+    def write(self, data):
+        self._buffer += data
+
+    def flush(self):
+        *lines, self._buffer = self._buffer.split('\n')
+        for line in lines:
+            self.lines.append(line)
+            if self.silent:
+                continue
+            if line.startswith('test '):
+                self._stderr.put(f'127.0.0.1 is NOT in set {line.split()[1]}.\n')
+            elif any(ip in line for ip in self.bad):
+                self._stderr.put('ipset v7.11: Syntax error: bad\n')
+
+    def poll(self):
+        return None
+
+    def kill(self):
+        self.killed = True
+
+
+class KnockingFirewallTestCase(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000.0
+
+    def clock(self):
+        return self.now
+
+    def test_memory_backend_grant_revoke(self):
+        backend = MemoryBackend(clock=self.clock)
+        backend.grant('10.0.0.1', 22, 30)
+        self.assertTrue(backend.active('10.0.0.1', 22))
+        backend.revoke('10.0.0.1', 22)
+        self.assertFalse(backend.active('10.0.0.1', 22))
+        self.assertEqual([op[0] for op in backend.history], ['add', 'del'])
+
+    def test_memory_backend_kernel_timeout(self):
+        backend = MemoryBackend(kernel_timeout=True, clock=self.clock)
+        backend.grant('10.0.0.1', 22, 30)
+        self.now += 31
+        self.assertFalse(backend.active('10.0.0.1', 22))
+
+    def test_nftables_batch_is_single_script(self):
+        backend = NftablesBackend(table='authbase')
+        script = backend.render([('add', '10.0.0.1', 22, 30), ('del', '10.0.0.2', 22, 0),
+                                 ('add', '2001:db8::1', 22, 30)])
+        self.assertEqual(script.splitlines(), [
+            'add element inet authbase knock_22 { 10.0.0.1 timeout 30s }',
+            'delete element inet authbase knock_22 { 10.0.0.2 }',
+            'add element inet authbase knock6_22 { 2001:db8::1 timeout 30s }',
+        ])
+        setup = backend.render_setup([22])
+        self.assertIn('flags timeout', setup)
+        self.assertIn('ip6 saddr @knock6_22 accept', setup)
+
+    def test_ipset_commands(self):
+        backend = IpsetBackend()
+        self.assertEqual(backend.render([('add', '10.0.0.1', 22, 30), ('del', '10.0.0.2', 22, 0)]),
+                         'add knock_22 10.0.0.1 timeout 30 -exist\ndel knock_22 10.0.0.2 -exist\n')
+        self.assertEqual(backend.render([('add', '2001:db8::1', 22, 30)]),
+                         'add knock6_22 2001:db8::1 timeout 30 -exist\n')
+
+    def test_ipset_batches_share_one_process(self):
+        proc = FakeIpset(bad={'10.0.0.2'})
+        backend = IpsetBackend()
+        with mock.patch('app.models.knocking_firewall.subprocess.Popen', return_value=proc) as popen:
+            backend.apply([('add', '10.0.0.1', 22, 30)])
+            with self.assertRaisesRegex(FirewallError, 'Syntax error') as ctx:
+                backend.apply([('add', '10.0.0.3', 22, 30), ('add', '10.0.0.2', 22, 30)])
+            backend.apply([('del', '10.0.0.1', 22, 0)])
+        # 按应答定位失败的变更
+        self.assertEqual(list(ctx.exception.failed), [1])
+        # 全部批次写入同一个交互进程，每条变更之后跟一条应答命令
+        popen.assert_called_once()
+        self.assertEqual(proc.lines, [
+            'create knock_ack hash:ip -exist',
+            'add knock_22 10.0.0.1 timeout 30 -exist', 'test knock_ack 127.0.0.1',
+            'add knock_22 10.0.0.3 timeout 30 -exist', 'test knock_ack 127.0.0.1',
+            'add knock_22 10.0.0.2 timeout 30 -exist', 'test knock_ack 127.0.0.1',
+            'del knock_22 10.0.0.1 -exist', 'test knock_ack 127.0.0.1',
+        ])
+
+        # 没有应答时重启交互进程
+        proc.silent = True
+        backend.reply_timeout = 0.05
+        with mock.patch('app.models.knocking_firewall.subprocess.Popen', return_value=proc):
+            with self.assertRaisesRegex(FirewallError, '应答超时'):
+                backend.apply([('add', '10.0.0.1', 22, 30)])
+        self.assertTrue(proc.killed)
+        self.assertIsNone(backend._proc)
+
+    def test_firewalld_rich_rule_format(self):
+        self.assertEqual(
+            FirewalldBackend.rich_rule('10.0.0.1', 22),
+            'rule family="ipv4" source address="10.0.0.1" port port="22" protocol="tcp" accept')
+        self.assertEqual(
+            FirewalldBackend.rich_rule('2001:db8::1', 22),
+            'rule family="ipv6" source address="2001:db8::1" port port="22" protocol="tcp" accept')
+
+    def test_create_backend_unknown(self):
+        with self.assertRaises(ValueError):
+            create_backend('iptables')
+
+    def test_worker_applies_grant_and_schedules_revoke(self):
+        backend = MemoryBackend()
+        revoked = []
+        worker = FirewallWorker(backend, on_revoked=lambda ip, port: revoked.append(ip)).start()
+        worker.submit_grant('10.0.0.1', 22, 0.05)
+        deadline = time.time() + 2
+        while not revoked and time.time() < deadline:
+            time.sleep(0.01)
+        worker.stop()
+        self.assertEqual(revoked, ['10.0.0.1'])
+        self.assertEqual([op[0] for op in backend.history], ['add', 'del'])
+        self.assertEqual(worker.stats()['grant_latency']['count'], 1)
+
+    def test_worker_stop_revokes_pending_grants(self):
+        backend = MemoryBackend()
+        worker = FirewallWorker(backend).start()
+        worker.submit_grant('10.0.0.1', 22, 300)
+        worker.stop()
+        self.assertEqual(backend.grants, {})
+
+    def test_worker_stale_timer_keeps_regrant(self):
+        backend = MemoryBackend()
+        worker = FirewallWorker(backend).start()
+        # 提前撤销后重新授权，以及未到期时续期，旧的到期撤销都不应撤销新的授权
+        worker.submit_grant('10.0.0.1', 22, 0.1)
+        worker.submit_revoke('10.0.0.1', 22)
+        worker.submit_grant('10.0.0.1', 22, 300)
+        worker.submit_grant('10.0.0.2', 22, 0.1)
+        worker.submit_grant('10.0.0.2', 22, 300)
+        time.sleep(0.3)
+        self.assertEqual(set(backend.grants), {('10.0.0.1', 22), ('10.0.0.2', 22)})
+        self.assertEqual(worker.stats()['scheduled_revocations'], 2)
+        worker.stop()
+        self.assertEqual(backend.grants, {})
+
+    def test_worker_retries_only_unlocated_failures(self):
+        calls = []
+
+        def apply(ops):
+            calls.append([op[1] for op in ops])
+            bad = [i for i, op in enumerate(ops) if op[1] == '10.0.0.2']
+            if bad and located:
+                raise FirewallError('bad', {i: 'bad' for i in bad})
+            if bad:
+                raise FirewallError('bad')
+
+        failed = []
+        worker = FirewallWorker(MemoryBackend(), on_failed=lambda ip, port: failed.append(ip))
+        worker.backend.apply = apply
+        items = [('add', ip, 22, 30, time.monotonic()) for ip in ('10.0.0.1', '10.0.0.2', '10.0.0.3')]
+        # 后端已定位失败项时不再重试，其余变更只应用一次
+        located = True
+        worker._apply(items)
+        self.assertEqual(calls, [['10.0.0.1', '10.0.0.2', '10.0.0.3']])
+        # 后端无法定位时（如整批回滚的nft事务）由工作线程逐条重试
+        located = False
+        calls.clear()
+        worker._apply(items)
+        self.assertEqual(calls, [['10.0.0.1', '10.0.0.2', '10.0.0.3'], ['10.0.0.1'], ['10.0.0.2'], ['10.0.0.3']])
+        self.assertEqual(failed, ['10.0.0.2', '10.0.0.2'])
+        self.assertEqual((worker.applied, worker.failed), (4, 2))
+
+    def test_firewalld_list_grants_parses_own_rules(self):
+        output = '\n'.join([
+            FirewalldBackend.rich_rule('10.0.0.1', 22),
+            FirewalldBackend.rich_rule('10.0.0.2', 2222),
+            FirewalldBackend.rich_rule('2001:db8::1', 22),
+            'rule family="ipv4" source address="10.0.0.3" port port="22" protocol="tcp" log accept',
+        ])
+        self.assertEqual(FirewalldBackend.parse_rich_rules(output, 22), {'10.0.0.1', '2001:db8::1'})
+
+    def test_journal_survives_restart(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'rule.grants')
+            backend = MemoryBackend()
+            worker = FirewallWorker(backend, journal=GrantJournal(path)).start()
+            worker.submit_grant('10.0.0.1', 22, 300)
+            worker.submit_grant('10.0.0.2', 22, 300)
+            worker.submit_revoke('10.0.0.2', 22)
+            worker.stop(revoke_pending=False)
+            self.assertIn(('10.0.0.1', 22), backend.grants)
+            # 崩溃时写了一半的行
+            with open(path, 'a') as f:
+                f.write('+ 10.0.0.9 2')
+
+            entries, known = GrantJournal(path).load()
+            self.assertEqual(set(entries), {('10.0.0.1', 22)})
+            self.assertGreater(entries[('10.0.0.1', 22)], time.time() + 200)
+            self.assertEqual(known, {('10.0.0.1', 22), ('10.0.0.2', 22)})
+
+    def test_worker_schedules_restored_revoke(self):
+        backend = MemoryBackend()
+        backend.grant('10.0.0.1', 22, 0)
+        worker = FirewallWorker(backend)
+        worker.schedule_revoke('10.0.0.1', 22, 0.05)
+        worker.start()
+        deadline = time.time() + 2
+        while backend.grants and time.time() < deadline:
+            time.sleep(0.01)
+        worker.stop()
+        self.assertEqual(backend.grants, {})
+
+    def test_journal_compaction(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'rule.grants')
+            journal = GrantJournal(path, compact_min=10)
+            for i in range(20):
+                journal.record_grant(f'10.0.0.{i}', 22, time.time() + 300)
+                journal.record_revoke(f'10.0.0.{i}', 22)
+                journal.flush()
+            journal.record_grant('10.0.0.100', 22, time.time() + 300)
+            journal.close()
+            with open(path) as f:
+                self.assertLessEqual(len(f.readlines()), 10)
+            entries, _ = GrantJournal(path).load()
+            self.assertEqual(set(entries), {('10.0.0.100', 22)})
@@ -0,0 +1,49 @@
+# coding:utf-8
+import unittest
+from app.models.knocking_guard import HashedTokenBuckets, KnockGuard, address_key, format_address
+
+
+class KnockingGuardTestCase(unittest.TestCase):
+    def test_token_bucket_refills(self):
+        buckets = HashedTokenBuckets(rate=1, burst=2, size=16)
+        self.assertTrue(buckets.take('a', 100.0))
+        self.assertTrue(buckets.take('a', 100.0))
+        self.assertFalse(buckets.take('a', 100.0))
+        self.assertTrue(buckets.take('a', 101.0))
+
+    def test_per_source_rate_limit(self):
+        guard = KnockGuard(rate=1, burst=3, subnet_rate=0, ban_threshold=0)
+        allowed = [guard.allow(address_key('10.0.0.1'), 100.0) for _ in range(5)]
+        self.assertEqual(allowed, [True, True, True, False, False])
+        self.assertTrue(guard.allow(address_key('10.0.0.2'), 100.0))
+        self.assertEqual(guard.rate_limited, 2)
+
+    def test_subnet_rate_limit(self):
+        guard = KnockGuard(rate=0, subnet_rate=1, subnet_burst=2, ban_threshold=0)
+        self.assertTrue(guard.allow(address_key('10.0.0.1'), 100.0))
+        self.assertTrue(guard.allow(address_key('10.0.0.2'), 100.0))
+        self.assertFalse(guard.allow(address_key('10.0.0.3'), 100.0))
+        self.assertTrue(guard.allow(address_key('10.0.1.1'), 100.0))
+
+    def test_ban_after_failures(self):
+        guard = KnockGuard(rate=0, subnet_rate=0, ban_threshold=3, ban_window=60, ban_time=10)
+        triggered = [guard.record_failure(address_key('10.0.0.1'), 100.0) for _ in range(4)]
+        self.assertEqual(triggered, [False, False, False, True])
+        self.assertFalse(guard.allow(address_key('10.0.0.1'), 105.0))
+        self.assertTrue(guard.allow(address_key('10.0.0.1'), 111.0))
+
+    def test_ban_table_is_bounded(self):
+        guard = KnockGuard(max_bans=2)
+        for i in range(3):
+            guard.ban(address_key(f'10.0.0.{i}'), 100.0)
+        self.assertEqual([format_address(ip) for ip in guard.banned], ['10.0.0.1', '10.0.0.2'])
+
+    def test_ipv6_subnet_is_64(self):
+        guard = KnockGuard(rate=0, subnet_rate=1, subnet_burst=2, ban_threshold=0)
+        self.assertTrue(guard.allow(address_key('2001:db8::1'), 100.0))
+        self.assertTrue(guard.allow(address_key('2001:db8::ffff:2'), 100.0))
+        self.assertFalse(guard.allow(address_key('2001:db8:0:0:1::3'), 100.0))
+        self.assertTrue(guard.allow(address_key('2001:db8:0:1::1'), 100.0))
+        # IPv4地址的网段键不会与IPv6冲突
+        self.assertTrue(guard.allow(address_key('32.1.13.1'), 100.0))
+        self.assertEqual(format_address(address_key('2001:db8::1')), '2001:db8::1')
@@ -0,0 +1,58 @@
+# coding:utf-8
+import os
+import shutil
+import tempfile
+import unittest
+from app.models.knocking_metrics import MetricsRegistry, merge_snapshots
+from app.models.knocking_control import ControlServer, ControlClient, ControlError
+
+
+class KnockingMetricsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.registry = MetricsRegistry()
+        self.packets = self.registry.counter('packets_total', '数据包数', ('port', 'proto'))
+        self.registry.gauge_fn('clients', '客户端数', lambda: 3)
+        self.latency = self.registry.histogram('grant_latency_seconds', '延迟', buckets=(0.01, 0.1))
+
+    def test_prometheus_text(self):
+        self.packets.inc(1201, 'TCP')
+        self.packets.inc(1201, 'TCP')
+        self.latency.observe(0.05)
+        lines = self.registry.render().splitlines()
+        self.assertIn('# TYPE knock_packets_total counter', lines)
+        self.assertIn('knock_packets_total{port="1201",proto="TCP"} 2', lines)
+        self.assertIn('knock_clients 3', lines)
+        self.assertIn('knock_grant_latency_seconds_bucket{le="0.01"} 0', lines)
+        self.assertIn('knock_grant_latency_seconds_bucket{le="0.1"} 1', lines)
+        self.assertIn('knock_grant_latency_seconds_count 1', lines)
+
+    def test_merge_snapshots(self):
+        self.packets.inc(1201, 'TCP')
+        self.latency.observe(0.05)
+        first = self.registry.snapshot()
+        self.packets.inc(2301, 'UDP')
+        merged = merge_snapshots([first, self.registry.snapshot()])
+        samples = {(s['labels']['port'], s['labels']['proto']): s['value']
+                   for s in merged['knock_packets_total']['value']}
+        self.assertEqual(samples, {(1201, 'TCP'): 2, (2301, 'UDP'): 1})
+        self.assertEqual(merged['knock_clients']['value'][0]['value'], 6)
+        self.assertEqual(merged['knock_grant_latency_seconds']['value']['count'], 2)
+
+    def test_control_socket_roundtrip(self):
+        tmpdir = tempfile.mkdtemp()
+        path = os.path.join(tmpdir, 'rule.sock')
+        server = ControlServer(path, {
+            ('GET', '/metrics'): lambda query, body: (200, self.registry.render()),
+            ('GET', '/stats'): lambda query, body: (200, {'metrics': self.registry.snapshot()}),
+        }).start()
+        try:
+            client = ControlClient(path)
+            self.assertIn('knock_clients 3', client.get('/metrics'))
+            self.assertIn('knock_clients', client.get('/stats')['metrics'])
+            with self.assertRaises(ControlError):
+                client.get('/missing')
+        finally:
+            server.close()
+            shutil.rmtree(tmpdir)
+        with self.assertRaises(ControlError):
+            ControlClient(path).get('/stats')
@@ -0,0 +1,23 @@
+# coding:utf-8
+import unittest
+from tests.bench_knocking import (DEFAULT_PASSWORD, DEFAULT_SEQUENCE, build_listener, check_grants,
+                                  replay, synthetic_traffic)
+from knocking_cmd import parse_knock_sequence
+
+
+class KnockingReplayTestCase(unittest.TestCase):
+    """用合成流量回放验证状态机只给正确敲门的来源授权"""
+
+    def test_synthetic_traffic_grants(self):
+        fsm, backend = build_listener(['-pl', DEFAULT_SEQUENCE, '-p', '22', '-passwd', DEFAULT_PASSWORD])
+        packets, expected = synthetic_traffic(parse_knock_sequence(DEFAULT_SEQUENCE), DEFAULT_PASSWORD,
+                                              legit=30, scan=5, scan_ports=20, flood=200, disorder=20)
+        try:
+            result = replay(fsm, packets)
+            grants = check_grants(fsm, backend, expected)
+        finally:
+            fsm.close()
+        self.assertEqual(result['packets'], len(packets))
+        self.assertEqual(grants['missing'], [])
+        self.assertEqual(grants['unexpected'], [])
+        self.assertEqual(grants['granted'], 30)
@@ -0,0 +1,153 @@
+# coding:utf-8
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+import zlib
+from types import SimpleNamespace
+from app.models.knocking_control import ControlServer
+from app.models.knocking_firewall import GrantJournal
+from app.models.knocking_shard import (ShardDispatcher, ShardedControl, decode_batch, encode_batch,
+                                       receive_frames, shard_key, shard_of_address)
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'app', 'models'))
+
+from knocking_cmd import adopt_journals, parse_arguments
+
+
+def frame(src, vlan=False, ethertype=b'\x08\x00'):
+    header = b'\xff' * 12 + (b'\x81\x00\x00\x01' if vlan else b'')
+    ip = b'\x45' + b'\x00' * 11 + bytes(int(x) for x in src.split('.')) + b'\x0a\x00\x00\x01'
+    return header + ethertype + ip
+
+
+def collect_frames(index, args, conn, log_queue):
+    """测试用分片入口：把收到的帧按顺序写入文件"""
+    with open(os.path.join(args.outdir, str(index)), 'wb') as f:
+        f.write(encode_batch(list(receive_frames(conn))))
+
+
+class KnockingShardTestCase(unittest.TestCase):
+    def test_shard_key_uses_source_subnet(self):
+        self.assertEqual(shard_key(frame('10.1.2.3')), bytes([10, 1, 2]))
+        self.assertEqual(shard_key(frame('10.1.2.3')), shard_key(frame('10.1.2.200')))
+        self.assertEqual(shard_key(frame('10.1.2.3', vlan=True)), bytes([10, 1, 2]))
+        v6 = b'\xff' * 12 + b'\x86\xdd' + b'\x60' + b'\x00' * 7 + bytes(range(1, 17)) + b'\x00' * 16
+        self.assertEqual(shard_key(v6), bytes(range(1, 9)))
+        self.assertIsNone(shard_key(frame('10.1.2.3', ethertype=b'\x08\x06')))
+        self.assertIsNone(shard_key(b'\x00' * 20))
+
+    def test_shard_of_address_matches_dispatch(self):
+        for ip in ('10.1.2.3', '192.168.7.1', '100.64.9.9'):
+            self.assertEqual(shard_of_address(ip, 4), zlib.crc32(shard_key(frame(ip))) % 4)
+        self.assertEqual(shard_of_address('2001:db8::1', 4), zlib.crc32(bytes.fromhex('20010db800000000')) % 4)
+
+    def test_orphan_journals_are_adopted(self):
+        state_dir = tempfile.mkdtemp()
+        try:
+            ips = [f'10.0.{i}.1' for i in range(8)] + ['2001:db8::1']
+            with open(os.path.join(state_dir, 'r1.grants'), 'w') as f:
+                f.writelines(f'+ {ip} 22 9999999999.000\n' for ip in ips[:5])
+            with open(os.path.join(state_dir, 'r1.3.grants'), 'w') as f:
+                f.writelines(f'+ {ip} 22 9999999999.000\n' for ip in ips[5:])
+                f.write(f'- {ips[5]} 22\n')
+            with open(os.path.join(state_dir, 'r10.grants'), 'w') as f:
+                f.write('+ 10.9.9.9 22 9999999999.000\n')
+
+            # 单进程切换为2个分片：旧的单进程日志和分片3的日志按源地址分给分片0、1
+            args = SimpleNamespace(state_dir=state_dir, rule_id='r1', target_port=22, workers=2)
+            self.assertEqual(adopt_journals(args), 10)
+            self.assertEqual(sorted(os.listdir(state_dir)), ['r1.0.grants', 'r1.1.grants', 'r10.grants'])
+            for index in range(2):
+                entries, _ = GrantJournal(os.path.join(state_dir, f'r1.{index}.grants')).load()
+                self.assertEqual(set(entries), {(ip, 22) for ip in ips[:5] + ips[6:]
+                                                if shard_of_address(ip, 2) == index})
+
+            # 再切回单进程
+            args.workers = 1
+            self.assertEqual(adopt_journals(args), 10)
+            self.assertEqual(sorted(os.listdir(state_dir)), ['r1.grants', 'r10.grants'])
+            entries, _ = GrantJournal(os.path.join(state_dir, 'r1.grants')).load()
+            self.assertEqual(len(entries), 8)
+            self.assertEqual(adopt_journals(args), 0)
+        finally:
+            shutil.rmtree(state_dir)
+
+    def test_batch_roundtrip(self):
+        frames = [b'a', b'', b'x' * 70000]
+        self.assertEqual(list(decode_batch(encode_batch(frames))), frames)
+
+    def test_dispatcher_keeps_sources_on_one_shard_in_order(self):
+        outdir = tempfile.mkdtemp()
+        try:
+            dispatcher = ShardDispatcher(collect_frames, SimpleNamespace(outdir=outdir), 3, batch_size=4).start()
+            sent = [frame(f'10.0.{i % 7}.{seq}') for seq in range(10) for i in range(7)]
+            for data in sent:
+                dispatcher.dispatch(data)
+            dispatcher.close()
+            received = {}
+            for index in range(3):
+                with open(os.path.join(outdir, str(index)), 'rb') as f:
+                    received[index] = list(decode_batch(f.read()))
+        finally:
+            shutil.rmtree(outdir)
+        self.assertEqual(sum(len(frames) for frames in received.values()), len(sent))
+        for subnet in range(7):
+            expected = [data for data in sent if data[28] == subnet]
+            owners = [index for index, frames in received.items() if expected[0] in frames]
+            self.assertEqual(len(owners), 1)
+            self.assertEqual([data for data in received[owners[0]] if data[28] == subnet], expected)
+
+    def test_sharded_control_merges_results(self):
+        tmpdir = tempfile.mkdtemp()
+        servers = []
+        try:
+            paths = []
+            for index in range(2):
+                path = os.path.join(tmpdir, f'rule.sock.{index}')
+                grants = [{'ip': f'10.0.{index}.{i}', 'port': 22, 'granted_at': None,
+                           'expires_at': 100 + i * 2 + index} for i in range(3)]
+                servers.append(ControlServer(path, {
+                    ('GET', '/grants'): lambda query, body, grants=grants: (200, {
+                        'total': len(grants), 'grants': grants[:int(query.get('limit', ['99'])[0])]}),
+                    ('POST', '/pause'): lambda query, body: (200, {'revoked': 3}),
+                    ('POST', '/reload'): lambda query, body: (400, {'msg': 'bad'}),
+                }).start())
+                paths.append(path)
+            filters = []
+            control = ShardedControl(paths, paused_filter='none', on_filter_changed=filters.append)
+            routes = control.routes()
+            status, result = routes[('GET', '/grants')]({'offset': ['1'], 'limit': ['3']}, None)
+            self.assertEqual(status, 200)
+            self.assertEqual(result['total'], 6)
+            self.assertEqual([g['expires_at'] for g in result['grants']], [101, 102, 103])
+            self.assertEqual(routes[('POST', '/pause')]({}, None), (200, {'revoked': 6}))
+            self.assertEqual(filters, ['none'])
+            self.assertEqual(routes[('POST', '/reload')]({}, {})[0], 400)
+            control.close()
+        finally:
+            for server in servers:
+                server.close()
+            shutil.rmtree(tmpdir)
+
+    def test_group_member_journals_are_adopted(self):
+        state_dir = tempfile.mkdtemp()
+        try:
+            with open(os.path.join(state_dir, 'm2.grants'), 'w') as f:
+                f.write('+ 10.0.0.1 22 9999999999.000\n')
+            with open(os.path.join(state_dir, 'old.grants'), 'w') as f:
+                f.write('+ 10.0.0.2 22 9999999999.000\n')
+            rules_file = os.path.join(state_dir, 'rules.json')
+            with open(rules_file, 'w') as f:
+                f.write('[{"rule_id": "m2", "port_list": "2301:UDP"}]')
+
+            # 合并进规则组的成员和改名前的名称留下的授权日志并入本进程的日志
+            args = parse_arguments(['-pl', '1201:TCP', '-p', '22', '-passwd', 'x', '--rule-id', 'm1', '--state-dir', state_dir,
+                                    '--rules-file', rules_file, '--adopt-journal', 'old'])
+            self.assertEqual(adopt_journals(args), 2)
+            self.assertEqual(sorted(os.listdir(state_dir)), ['m1.grants', 'rules.json'])
+            entries, _ = GrantJournal(os.path.join(state_dir, 'm1.grants')).load()
+            self.assertEqual(set(entries), {('10.0.0.1', 22), ('10.0.0.2', 22)})
+        finally:
+            shutil.rmtree(state_dir)
@@ -0,0 +1,200 @@
+# coding:utf-8
+import json
+import os
+import sys
+import tempfile
+import time
+import unittest
+from types import SimpleNamespace
+import psutil
+from flask import Flask
+from app.models.KnockingSupervisor import KnockingSupervisor, group_rules, static_args
+
+MODELS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'app', 'models')
+
+# 模拟监听进程：在控制套接字上响应控制请求，并把请求和其中的规则ID（列表以逗号连接）写入文件
+CONTROL_SCRIPT = (
+    "import sys, json, time; sys.path.insert(0, {models!r});"
+    "from knocking_control import ControlServer;"
+    "log = open({log!r}, 'a');"
+    "ids = lambda r: ','.join(r) if isinstance(r, list) else r;"
+    "record = lambda name: lambda q, b: (log.write(name + ' ' + ids((b or {{}}).get('rule_id') or"
+    " q.get('rule_id', [''])[0]) + chr(10)), log.flush(), (200, {{}}))[-1];"
+    "ControlServer({sock!r}, {{('POST', '/pause'): record('pause'), ('POST', '/resume'): record('resume'),"
+    " ('POST', '/reload'): record('reload'), ('DELETE', '/rules'): record('remove')}}).start();"
+    "time.sleep(30)"
+)
+
+
+class FakeSupervisor(KnockingSupervisor):
+    """用任意命令代替 knocking_cmd.py，避免测试依赖root和抓包"""
+
+    def command(self, rule):
+        return [sys.executable, '-c', rule.script]
+
+    def reload_payload(self, rule):
+        # 只有脚本的规则没有敲门端口，不与其他规则合并
+        if not hasattr(rule, 'port_sequence'):
+            return {'rule_id': rule.id, 'port_list': ''}
+        return super().reload_payload(rule)
+
+
+def knock_rule(rule_id, port_sequence, script, status='1'):
+    return SimpleNamespace(id=rule_id, status=status, port_sequence=port_sequence, target_port=22,
+                           time_window=10, timeout=30, password_hash='x', auth_mode='md5', script=script)
+
+
+class KnockingSupervisorTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        app = Flask(__name__)
+        app.config.update(
+            KNOCKING_RUN_DIR=self.tmpdir.name,
+            KNOCKING_LOG_FILE=self.tmpdir.name + '/knocking.log',
+            KNOCKING_SUPERVISOR_AUTOSTART=False,
+            KNOCKING_RESTART_BACKOFF=0,
+        )
+        self.supervisor = FakeSupervisor(app)
+        self.supervisor.poll_interval = 0.05
+
+    def tearDown(self):
+        self.supervisor.stop_all(wait=True)
+        self.tmpdir.cleanup()
+
+    def wait_for(self, predicate, timeout=5):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if predicate():
+                return True
+            time.sleep(0.05)
+        return False
+
+    def test_start_status_stop(self):
+        rule = SimpleNamespace(id='r1', script='import time; time.sleep(30)')
+        pid = self.supervisor.start(rule)
+        self.assertEqual(self.supervisor.start(rule), pid)
+        status = self.supervisor.status('r1')
+        self.assertTrue(status['alive'])
+        self.assertEqual(status['pid'], pid)
+        self.assertTrue(self.supervisor.stop('r1', wait=True))
+        self.assertFalse(self.supervisor.status('r1')['alive'])
+
+    def test_crashed_listener_is_restarted(self):
+        rule = SimpleNamespace(id='r2', script='import sys; sys.exit(3)')
+        self.supervisor.start(rule)
+        self.assertTrue(self.wait_for(lambda: self.supervisor.status('r2')['restarts'] >= 1))
+        self.assertEqual(self.supervisor.status('r2')['lastExitCode'], 3)
+
+    def test_stop_all_is_parallel_and_bounded(self):
+        self.supervisor.stop_timeout = 0.3
+        script = 'import signal, time; signal.signal(signal.SIGTERM, signal.SIG_IGN); time.sleep(30)'
+        pids = [self.supervisor.start(SimpleNamespace(id=f'r{i}', script=script)) for i in range(3)]
+        time.sleep(0.3)
+        started = time.time()
+        self.assertTrue(self.supervisor.stop_all(wait=True))
+        # 三个进程并行等待，总耗时约为一次SIGTERM超时，而不是三次
+        self.assertLess(time.time() - started, 1.5)
+        for pid in pids:
+            self.assertFalse(psutil.pid_exists(pid))
+
+    def test_restart_replaces_process_after_old_exits(self):
+        rule = SimpleNamespace(id='r3', script='import time; time.sleep(30)')
+        old_pid = self.supervisor.start(rule)
+        self.supervisor.restart(rule)
+        self.assertTrue(self.wait_for(lambda: self.supervisor.status('r3')['alive']))
+        self.assertNotEqual(self.supervisor.status('r3')['pid'], old_pid)
+
+    def test_reload_falls_back_to_restart_without_control_socket(self):
+        rule = SimpleNamespace(id='r4', script='import time; time.sleep(30)', port_sequence='1201:TCP',
+                               target_port=22, time_window=10, timeout=30, password_hash='x', auth_mode='md5')
+        old_pid = self.supervisor.start(rule)
+        self.assertFalse(self.supervisor.reload(rule))
+        self.assertTrue(self.wait_for(lambda: self.supervisor.status('r4')['alive']))
+        self.assertNotEqual(self.supervisor.status('r4')['pid'], old_pid)
+
+    def test_static_args_ignore_reloadable_options(self):
+        old = ['python3', 'knocking_cmd.py', '-pl', '1201:TCP', '-p', '22', '-fw', 'nftables', '--rule-id', 'r']
+        new = ['python', 'knocking_cmd.py', '-pl', '2301:UDP', '-p', '2222', '-fw', 'nftables', '--rule-id', 'r']
+        self.assertEqual(static_args(old), static_args(new))
+        new[7] = 'ipset'
+        self.assertNotEqual(static_args(old), static_args(new))
+
+    def test_bulk_disable_and_enable_use_control_socket(self):
+        rules, pids = [], []
+        for i in range(3):
+            rule_id = f'b{i}'
+            log = os.path.join(self.tmpdir.name, rule_id + '.log')
+            rule = knock_rule(rule_id, f'12{i}1:TCP', CONTROL_SCRIPT.format(
+                models=MODELS_DIR, log=log, sock=self.supervisor.control_socket_path(rule_id)))
+            rules.append(rule)
+            pids.append(self.supervisor.start(rule))
+        self.assertTrue(self.wait_for(lambda: all(
+            os.path.exists(self.supervisor.control_socket_path(r.id)) for r in rules)))
+
+        self.supervisor.set_enabled(rules, False)
+        self.supervisor.set_enabled(rules, True)
+        for rule, pid in zip(rules, pids):
+            status = self.supervisor.status(rule.id)
+            self.assertEqual(status['pid'], pid)
+            self.assertFalse(status['paused'])
+            with open(os.path.join(self.tmpdir.name, rule.id + '.log')) as f:
+                self.assertEqual(f.read().split(), ['pause', rule.id, 'resume', rule.id])
+
+    def test_group_rules_by_shared_ports(self):
+        groups = group_rules({'a': {'1201'}, 'b': {'2301'}, 'c': {'3401'}, 'd': {'1201', '2301'}})
+        self.assertEqual(sorted(sorted(ids) for ids in groups), [['a', 'b', 'd'], ['c']])
+
+    def test_rules_sharing_ports_share_one_listener(self):
+        log = os.path.join(self.tmpdir.name, 'g1.log')
+        script = CONTROL_SCRIPT.format(models=MODELS_DIR, log=log, sock=self.supervisor.control_socket_path('g1'))
+        first = knock_rule('g1', '1201:TCP,2301:UDP', script)
+        second = knock_rule('g2', '1201:TCP,3401:TCP', script)
+        pid = self.supervisor.start(first)
+        self.assertTrue(self.wait_for(lambda: os.path.exists(self.supervisor.control_socket_path('g1'))))
+
+        # 端口重叠的规则热添加到运行中的监听进程，按规则暂停和移除
+        self.assertEqual(self.supervisor.start(second), pid)
+        self.assertEqual(self.supervisor.control_socket_path('g2'), self.supervisor.control_socket_path('g1'))
+        self.assertTrue(self.supervisor.pause(second))
+        self.assertTrue(self.supervisor.status('g2')['paused'])
+        self.assertFalse(self.supervisor.status('g1')['paused'])
+        self.assertEqual(self.supervisor.status('g2')['listenerId'], 'g1')
+        self.assertTrue(self.supervisor.stop('g2', revoke=True))
+        self.assertFalse(self.supervisor.status('g2')['alive'])
+        self.assertEqual(self.supervisor.status('g1')['pid'], pid)
+        with open(log) as f:
+            self.assertEqual(f.read().splitlines(), ['reload g2', 'pause g2', 'remove g2'])
+
+    def test_bulk_toggle_sends_one_request_per_listener(self):
+        log = os.path.join(self.tmpdir.name, 'k1.log')
+        script = CONTROL_SCRIPT.format(models=MODELS_DIR, log=log, sock=self.supervisor.control_socket_path('k1'))
+        rules = [knock_rule(f'k{i}', f'1201:TCP,{2300 + i}:UDP', script) for i in range(1, 4)]
+        pid = self.supervisor.start(rules[0])
+        self.assertTrue(self.wait_for(lambda: os.path.exists(self.supervisor.control_socket_path('k1'))))
+        for rule in rules[1:]:
+            self.assertEqual(self.supervisor.start(rule), pid)
+
+        # 同一监听进程中的规则合并为一次控制请求
+        self.supervisor.set_enabled(rules, False)
+        self.assertTrue(all(self.supervisor.status(rule.id)['paused'] for rule in rules))
+        self.supervisor.set_enabled(rules[1:], True)
+        self.assertEqual([self.supervisor.status(rule.id)['paused'] for rule in rules], [True, False, False])
+        self.assertEqual(self.supervisor.status('k1')['pid'], pid)
+        with open(log) as f:
+            self.assertEqual(f.read().splitlines(), ['reload k2', 'reload k3', 'pause k1,k2,k3', 'resume k2,k3'])
+
+    def test_overlapping_listeners_are_merged(self):
+        script = 'import time; time.sleep(30)'
+        old_pids = [self.supervisor.start(knock_rule('m1', '1201:TCP', script)),
+                    self.supervisor.start(knock_rule('m2', '2301:UDP', script))]
+        self.assertNotEqual(old_pids[0], old_pids[1])
+        # 新规则同时与两个监听进程重叠：停止两者后合并为以最小规则ID命名的一个进程
+        self.supervisor.start(knock_rule('m3', '1201:TCP,2301:UDP', script))
+        self.assertTrue(self.wait_for(lambda: self.supervisor.status('m3')['alive']))
+        pids = {self.supervisor.status(rule_id)['pid'] for rule_id in ('m1', 'm2', 'm3')}
+        self.assertEqual(len(pids), 1)
+        self.assertFalse(pids & set(old_pids))
+        self.assertEqual(self.supervisor.status('m3')['listenerId'], 'm1')
+        path = self.supervisor.rules_file_path('m1', ['m1', 'm2', 'm3'])
+        with open(path) as f:
+            self.assertEqual([item['rule_id'] for item in json.load(f)], ['m2', 'm3'])
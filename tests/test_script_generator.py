@@ -0,0 +1,132 @@
+# coding:utf-8
+import os
+import shutil
+import tempfile
+import unittest
+from io import BytesIO
+from types import SimpleNamespace
+from zipfile import ZipFile
+from app.models.ScriptGenerator import ScriptGenerator
+
+
+class ScriptGeneratorTestCase(unittest.TestCase):
+    """在内存中生成并缓存客户端脚本"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.generator = ScriptGenerator()
+        script_dir = os.path.join(self.tmpdir.name, 'script')
+        shutil.copytree(self.generator.SCRIPT_DIR, script_dir, ignore=shutil.ignore_patterns('__pycache__'))
+        with open(os.path.join(script_dir, 'PortKnockProConfig.exe'), 'wb') as f:
+            f.write(b'MZ' + bytes(range(256)))
+        self.generator.SCRIPT_DIR = script_dir
+        for name in ('PYTHON_TEMPLATE', 'EXE_TEMPLATE', 'BASH_TEMPLATE', 'START_TEMPLATE'):
+            setattr(self.generator, name, os.path.join(script_dir, os.path.basename(getattr(self.generator, name))))
+        self.rule = SimpleNamespace(id='r1', port_sequence='1201:TCP,2301:UDP', auth_mode='totp')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def touch(self, path, data):
+        """修改模板文件并保证修改时间变化"""
+        with open(path, 'ab') as f:
+            f.write(data)
+        mtime = os.stat(path).st_mtime_ns + 10 ** 9
+        os.utime(path, ns=(mtime, mtime))
+
+    def test_scripts_are_substituted(self):
+        parts, filename = self.generator.build(self.rule, '10.0.0.9', 'python')
+        self.assertEqual(filename, 'knockclient.py')
+        script = b''.join(parts).decode('utf-8')
+        self.assertIn("SERVER_IP = '10.0.0.9'\n", script)
+        self.assertIn("KNOCK_SEQUENCE = [\n    (1201, 'TCP'),\n    (2301, 'UDP')\n]", script)
+        self.assertIn("AUTH_MODE = 'totp'\n", script)
+
+        script = b''.join(self.generator.build(self.rule, '10.0.0.9', 'bash')[0]).decode('utf-8')
+        self.assertIn('KNOCK_SEQUENCE=("1201 tcp" "2301 udp")', script)
+        self.assertIn('AUTH_MODE="totp"\n', script)
+
+        parts, filename = self.generator.build(self.rule, '10.0.0.9', 'exe')
+        self.assertEqual(filename, 'knockclient_exe.zip')
+        with ZipFile(BytesIO(b''.join(parts))) as zipf:
+            self.assertIsNone(zipf.testzip())
+            self.assertEqual(zipf.namelist(), ['PortKnockProConfig.exe', 'instructions.txt', 'start.txt'])
+            self.assertEqual(zipf.read('start.txt').decode('utf-8'), '10.0.0.9\n"1201:TCP,2301:UDP"\ntotp')
+            self.assertEqual(zipf.read('PortKnockProConfig.exe'), b'MZ' + bytes(range(256)))
+
+    def test_normalize_host(self):
+        self.assertEqual(self.generator.normalize_host('2001:DB8::0:1'), '2001:db8::1')
+        self.assertEqual(self.generator.normalize_host('10.0.0.9'), '10.0.0.9')
+        self.assertEqual(self.generator.normalize_host('Knock.Example.com'), 'knock.example.com')
+        for host in ('../../x', "10.0.0.9'\nimport os", 'a/b', '-a.com', 'a..com', '', None, 'a' * 64):
+            with self.assertRaises(ValueError):
+                self.generator.normalize_host(host)
+        with self.assertRaises(ValueError):
+            self.generator.build(self.rule, "x'; rm -rf /; '", 'python')
+
+    def test_exe_base_is_shared(self):
+        first = self.generator.exe_package_parts('10.0.0.1', '1201:TCP', 'md5')
+        second = self.generator.exe_package_parts('2001:db8::1', '1201:TCP,2301:UDP', 'totp')
+        self.assertIs(first[0], second[0])
+        with ZipFile(BytesIO(b''.join(second))) as zipf:
+            self.assertEqual(zipf.read('start.txt'), b'2001:db8::1\n"1201:TCP,2301:UDP"\ntotp')
+
+        # EXE文件更新后重新生成公共部分
+        self.touch(self.generator.EXE_TEMPLATE, b'v2')
+        with ZipFile(BytesIO(self.generator.generate_exe_package('10.0.0.1', '1201:TCP'))) as zipf:
+            self.assertTrue(zipf.read('PortKnockProConfig.exe').endswith(b'v2'))
+
+    def test_cache_hit_and_invalidation(self):
+        first = self.generator.build(self.rule, '10.0.0.9', 'python')[0]
+        self.assertIs(self.generator.build(self.rule, '10.0.0.9', 'python')[0], first)
+
+        # 规则的端口序列变化后缓存失效，需要重新生成
+        self.rule.port_sequence = '1201:TCP,4501:UDP'
+        second = self.generator.build(self.rule, '10.0.0.9', 'python')[0]
+        self.assertIsNot(second, first)
+        self.assertIn(b'(4501, ', second[0])
+
+        # 模板文件修改后缓存失效
+        self.touch(self.generator.PYTHON_TEMPLATE, b'# v2\n')
+        self.assertTrue(self.generator.build(self.rule, '10.0.0.9', 'python')[0][0].endswith(b'# v2\n'))
+        self.touch(self.generator.BASH_TEMPLATE, b'# v2\n')
+        self.assertTrue(self.generator.build(self.rule, '10.0.0.9', 'bash')[0][0].endswith(b'# v2\n'))
+        exe = self.generator.build(self.rule, '10.0.0.9', 'exe')[0]
+        self.touch(self.generator.EXE_TEMPLATE, b'v2')
+        with ZipFile(BytesIO(b''.join(self.generator.build(self.rule, '10.0.0.9', 'exe')[0]))) as zipf:
+            self.assertTrue(zipf.read('PortKnockProConfig.exe').endswith(b'v2'))
+        self.assertIsNot(self.generator.build(self.rule, '10.0.0.9', 'exe')[0], exe)
+
+        bash = self.generator.build(self.rule, '10.0.0.9', 'bash')[0]
+        self.generator.invalidate('other')
+        self.assertIs(self.generator.build(self.rule, '10.0.0.9', 'bash')[0], bash)
+        self.generator.invalidate('r1')
+        self.assertIsNot(self.generator.build(self.rule, '10.0.0.9', 'bash')[0], bash)
+
+    def test_cache_is_bounded(self):
+        self.generator.max_cache_bytes = 3 * len(self.generator.build(self.rule, 'h0', 'bash')[0][0])
+        for i in range(1, 10):
+            self.generator.build(self.rule, f'h{i}', 'bash')
+        self.assertLessEqual(self.generator._cache_bytes, self.generator.max_cache_bytes)
+        self.assertEqual([key[1] for key in self.generator._artifacts], ['h7', 'h8', 'h9'])
+
+    def test_bundle_is_streamed(self):
+        rules = [self.rule, SimpleNamespace(id='r2', port_sequence='5601:UDP', auth_mode='md5')]
+        chunks = list(self.generator.iter_bundle(rules, ['10.0.0.9', '2001:db8::9'], ['python', 'exe'], workers=2))
+        self.assertGreater(len(chunks), 4)
+        with ZipFile(BytesIO(b''.join(chunks))) as zipf:
+            self.assertIsNone(zipf.testzip())
+            self.assertEqual(len(zipf.namelist()), 8)
+            with ZipFile(BytesIO(zipf.read('r2/2001_db8__9/knockclient_exe.zip'))) as exe:
+                self.assertEqual(exe.read('start.txt'), b'2001:db8::9\n"5601:UDP"\nmd5')
+            self.assertIn(b"SERVER_IP = '10.0.0.9'", zipf.read('r1/10.0.0.9/knockclient.py'))
+
+        # 无效的目标主机不会生成脚本，也不会出现在ZIP路径中
+        with ZipFile(BytesIO(b''.join(self.generator.iter_bundle([self.rule], ['../../x', 'Host-1.lan'], ['bash'])))) as zipf:
+            self.assertEqual(sorted(zipf.namelist()), ['errors.txt', 'r1/host-1.lan/knockclient.sh'])
+
+        # 生成失败的脚本记录在 errors.txt 中，其余脚本照常输出
+        os.remove(self.generator.BASH_TEMPLATE)
+        with ZipFile(BytesIO(b''.join(self.generator.iter_bundle(rules, ['h'], ['python', 'bash'])))) as zipf:
+            self.assertEqual(sorted(zipf.namelist()), ['errors.txt', 'r1/h/knockclient.py', 'r2/h/knockclient.py'])
+            self.assertEqual(zipf.read('errors.txt').count(b'\n'), 2)
@@ -35,6 +35,15 @@ export function updateRule(ruleId, data) {
   })
 }
 
+// 批量启用/停用敲门规则
+export function changeRuleStatus(ids, status) {
+  return request({
+    url: '/rules/status',
+    method: 'put',
+    data: { ids, status }
+  })
+}
+
 // 生成客户端脚本
 export function generateScript(ruleId, scriptType, host) {
   const params = host ? { host } : {}
@@ -43,4 +52,38 @@ export function generateScript(ruleId, scriptType, host) {
     method: 'get',
     params: params
   })
+}
+
+// 获取敲门监听运行指标
+export function getKnockingMetrics() {
+  return request({
+    url: '/knocking/metrics',
+    method: 'get'
+  })
+}
+
+// 查询规则当前开放的授权
+export function listGrants(ruleId, query) {
+  return request({
+    url: '/rules/' + ruleId + '/grants',
+    method: 'get',
+    params: query
+  })
+}
+
+// 立即撤销规则对某个源地址的授权
+export function revokeGrant(ruleId, ip) {
+  return request({
+    url: '/rules/' + ruleId + '/grants/' + encodeURIComponent(ip),
+    method: 'delete'
+  })
+}
+
+// 分页查询敲门审计事件
+export function listKnockingEvents(query) {
+  return request({
+    url: '/knocking/events',
+    method: 'get',
+    params: query
+  })
 }
\ No newline at end of file